@@ -23,8 +23,6 @@ function App() {
     const [synced, setSynced] = useState([])
     const [userLogged, setUserLogged] = useState(false)
 
-    let waitForResponse = false
-
     const updateFolders = () => {
         setUserFileTree(null)
         fetch('http://localhost:8000/files/tree?' + new URLSearchParams({only_folders: true}),
@@ -36,11 +34,9 @@ function App() {
     const updateFiles = () => {
         setUserFileTree(null)
         updateFolders()
-        waitForResponse = true
         fetch('http://localhost:8000/files/tree', {credentials: "include"})
             .then(res => res.json())
-            .then(() => {waitForResponse = false})
-        getSyncStatus()
+            .then(getSyncStatus)
     }
 
     const getSyncStatus = () => {
@@ -50,9 +46,8 @@ function App() {
                 .then(data => {
                     console.log(data)
                     colorFileTree(data)
-                })
-                .then(() => {
-                    if (waitForResponse) {
+                    // Sync job runs in background until all presentations are processed
+                    if (data.active) {
                         setTimeout(getSyncStatus, 2000)
                     }
                 })
@@ -11,7 +11,7 @@ const PreviewSlideCard = (props) => {
                 props.setFromIndex(props.previewIndex)
             }}
         >
-            <img className={props.slide.ratio} src={'data:image/png;base64,' + props.slide.thumbnail}
+            <img className={props.slide.ratio} src={'http://localhost:8000' + props.slide.thumbnails.medium}
                 onContextMenu={(e) => {
                     e.preventDefault()
                     props.setPreviewSlides(prev => prev.filter(slide => slide.id !== props.slide.id))
@@ -9,7 +9,8 @@ const SlideRatio = {
 
 const SlideCard = (props) => {
     let className = null
-    let imgSrc = 'data:image/png;base64,' + props.slide.thumbnail
+    // Cards of the grid get a downscaled thumbnail, full size is requested only for an expanded slide
+    let imgSrc = 'http://localhost:8000' + (props.expand ? props.slide.thumbnail : props.slide.thumbnails.medium)
 
     const ref = useRef()
 
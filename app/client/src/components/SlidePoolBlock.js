@@ -15,7 +15,7 @@ const PoolSlideCard = (props) => {
     return (
         <div className='PoolSlideCard'>
             <h5>{props.slide.label}</h5>
-            <img ref={ref} className={props.slide.ratio} src={'data:image/png;base64,' + props.slide.thumbnail}
+            <img ref={ref} className={props.slide.ratio} src={'http://localhost:8000' + props.slide.thumbnails.medium}
                 onClick={() => {
                     if (selected) {
                         ref.current.classList.remove('selected')
@@ -14,4 +14,22 @@ db_user = os.environ['PRESENTATION_CONFIGURATOR_DATABASE_USER']
 db_password = os.environ['PRESENTATION_CONFIGURATOR_DATABASE_PASSWORD']
 db_url = os.environ['PRESENTATION_CONFIGURATOR_DATABASE_URL']
 db_name = os.environ['PRESENTATION_CONFIGURATOR_DATABASE_NAME']
+# Connection pool should fit the request thread pool and background workers
+db_pool_size = int(os.environ.get('PRESENTATION_CONFIGURATOR_DATABASE_POOL_SIZE', 20))
+db_max_overflow = int(os.environ.get('PRESENTATION_CONFIGURATOR_DATABASE_MAX_OVERFLOW', 10))
+thumbnails_path = os.environ.get('PRESENTATION_CONFIGURATOR_THUMBNAILS_PATH', os.path.join(SERVER_ROOT, 'database/thumbnails'))
 
+drive_max_concurrent_downloads = int(os.environ.get('PRESENTATION_CONFIGURATOR_DRIVE_MAX_CONCURRENT_DOWNLOADS', 4))
+drive_cache_size_mb = int(os.environ.get('PRESENTATION_CONFIGURATOR_DRIVE_CACHE_SIZE_MB', 2048))
+
+# Slide renderer backend: 'powerpoint' (win32com, Windows only) or 'libreoffice' (headless soffice + pdftoppm)
+renderer_name = os.environ.get('PRESENTATION_CONFIGURATOR_RENDERER', 'powerpoint')
+renderer_workers = int(os.environ.get('PRESENTATION_CONFIGURATOR_RENDERER_WORKERS', 4))
+renderer_recycle_after = int(os.environ.get('PRESENTATION_CONFIGURATOR_RENDERER_RECYCLE_AFTER', 50))
+sync_workers = int(os.environ.get('PRESENTATION_CONFIGURATOR_SYNC_WORKERS', 2))
+# Finished sync jobs are kept for status this many days, the last job of every user is always kept
+sync_job_retention_days = int(os.environ.get('PRESENTATION_CONFIGURATOR_SYNC_JOB_RETENTION_DAYS', 7))
+# Number of slide images kept decoded for comparison at their native size, about 3 MB each for 1280x720 renders
+image_cache_size = int(os.environ.get('PRESENTATION_CONFIGURATOR_IMAGE_CACHE_SIZE', 64))
+# Slides of a built presentation with fingerprints within this distance are duplicates, -1 drops only exact copies
+duplicate_slide_distance = int(os.environ.get('PRESENTATION_CONFIGURATOR_DUPLICATE_SLIDE_DISTANCE', 2))
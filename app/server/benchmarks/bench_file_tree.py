@@ -0,0 +1,93 @@
+"""Benchmark of the Drive file tree builder against a fake Drive.
+
+Run from the repository root:
+    python -m app.server.benchmarks.bench_file_tree --folders 5000 --files 50000 --latency-ms 50 --legacy
+
+Round trips are counted on the fake Drive and multiplied by --latency-ms to
+estimate the network time the same listing would take against the real API.
+"""
+import argparse
+import random
+import time
+from multiprocessing.pool import ThreadPool
+
+from app.server.main.external_services.google.google_drive_handler import GoogleDriveHandler, \
+    FOLDER_MIME_TYPE, PRESENTATION_MIME_TYPE
+from app.server.tests.fake_drive import FakeDrive
+
+
+def create_fake_drive(folders_count, files_count, seed=0):
+    rnd = random.Random(seed)
+    drive = FakeDrive()
+    folder_ids = [drive.root_id]
+    for i in range(folders_count):
+        folder_id = f'FOLDER_{i}'
+        drive.add_folder(folder_id, f'Folder {i}', parent_id=rnd.choice(folder_ids))
+        folder_ids.append(folder_id)
+    for i in range(files_count):
+        drive.add_presentation(f'PRES_{i}', f'Presentation {i}', parent_id=rnd.choice(folder_ids))
+    return drive
+
+
+def legacy_file_tree(drive_service):
+    # Per-folder traversal used before the bulk builder, kept here for comparison
+    drive = drive_service.files().get(fileId='root', fields='id, name').execute()
+    folders = [drive]
+
+    presentations = drive_service.files().list(
+        q=f"mimeType='{PRESENTATION_MIME_TYPE}' and trashed = false",
+        pageSize=10 ** 9,
+        fields='files(id, name, modifiedTime, parents)').execute().get('files')
+
+    def traverse(node):
+        children = drive_service.files().list(
+            q=f"mimeType='{FOLDER_MIME_TYPE}' and not trashed and '{node.get('id')}' in parents",
+            fields='files(id, name)').execute().get('files')
+        for child in children:
+            traverse(child)
+            folders.append(child)
+        for pres in presentations:
+            if pres.get('parents')[0] == node.get('id'):
+                children.append(pres)
+                pres['type'] = 'presentation'
+        node['children'] = children
+        node['type'] = 'folder'
+
+    traverse(drive)
+    return folders, presentations, drive
+
+
+def run(name, drive, build, latency_ms):
+    drive.reset_calls()
+    start = time.perf_counter()
+    folders, presentations, _ = build()
+    elapsed = time.perf_counter() - start
+    round_trips = sum(drive.calls.values())
+    print(f'{name:<10} folders={len(folders):<6} presentations={len(presentations):<7} '
+          f'round trips={round_trips:<6} cpu={elapsed:8.3f}s '
+          f'estimated network={round_trips * latency_ms / 1000:8.1f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--folders', type=int, default=5000)
+    parser.add_argument('--files', type=int, default=50000)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--legacy', action='store_true',
+                        help='also run the per-folder traversal, O(folders x presentations)')
+    args = parser.parse_args()
+
+    drive = create_fake_drive(args.folders, args.files)
+    pool = ThreadPool(processes=1)
+    drive_handler = GoogleDriveHandler(pool=pool, build_drive_service=lambda user_flow: drive)
+
+    run('bulk', drive, lambda: drive_handler.get_user_file_tree(None), args.latency_ms)
+    if args.legacy:
+        run('legacy', drive, lambda: legacy_file_tree(drive), args.latency_ms)
+
+    drive_handler.close()
+    pool.close()
+
+
+if __name__ == '__main__':
+    main()
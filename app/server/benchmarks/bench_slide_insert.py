@@ -0,0 +1,100 @@
+"""Benchmark of slide ingestion, per-slide create() against bulk create_slides().
+
+Requires the database from docker/docker-compose.yml. Run from the repository root:
+    python -m app.server.benchmarks.bench_slide_insert --decks 10 --slides 100 --legacy
+
+Every deck is a presentation of --slides slides with --thumbnail-kb thumbnails,
+rows are removed after each run.
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+from app.definitions import db_user, db_password, db_url, db_name
+from app.server.main.database.database_handler import DatabaseHandler, Users, Presentations, Slides
+
+BENCH_USER_ID = 'BENCH_SLIDE_INSERT_USER_ID'
+
+
+def create_decks(db_handler, decks_count):
+    pres_ids = [f'BENCH_SLIDE_INSERT_PRES_{i}' for i in range(decks_count)]
+    for pres_id in pres_ids:
+        db_handler.create(
+            Presentations,
+            id=pres_id,
+            name=pres_id,
+            owner_id=BENCH_USER_ID,
+            modified_time=datetime.utcnow()
+        )
+    return pres_ids
+
+
+def remove_decks(db_handler, pres_ids):
+    for pres_id in pres_ids:
+        db_handler.delete(Presentations, pres_id)
+
+
+def make_slides(pres_id, slides_count, thumbnail_kb):
+    return [
+        {
+            'pres_id': pres_id,
+            'index': i,
+            'thumbnail': os.urandom(thumbnail_kb * 1024),
+            'text': f'Slide {i} of {pres_id}',
+            'ratio': Slides.Ratio.WIDESCREEN_16_TO_9
+        }
+        for i in range(slides_count)
+    ]
+
+
+def insert_legacy(db_handler, slides):
+    for slide in slides:
+        db_handler.create(Slides, **slide)
+
+
+def insert_bulk(db_handler, slides):
+    db_handler.create_slides(slides)
+
+
+def run(name, db_handler, insert, args):
+    pres_ids = create_decks(db_handler, args.decks)
+    decks = [make_slides(pres_id, args.slides, args.thumbnail_kb) for pres_id in pres_ids]
+    try:
+        start = time.perf_counter()
+        for slides in decks:
+            insert(db_handler, slides)
+        elapsed = time.perf_counter() - start
+    finally:
+        remove_decks(db_handler, pres_ids)
+
+    rows = args.decks * args.slides
+    print(f'{name:<7} decks={args.decks:<4} slides/deck={args.slides:<5} time={elapsed:8.3f}s '
+          f'rows/sec={rows / elapsed:10.1f}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--decks', type=int, default=10)
+    parser.add_argument('--slides', type=int, default=100)
+    parser.add_argument('--thumbnail-kb', type=int, default=100)
+    parser.add_argument('--legacy', action='store_true', help='also run per-slide create()')
+    args = parser.parse_args()
+
+    pool = ThreadPool(processes=1)
+    db_handler = DatabaseHandler(user=db_user, password=db_password, host=db_url, db=db_name, pool=pool, echo=False)
+    db_handler.create_db()
+    db_handler.find_or_create(Users, Users.id == BENCH_USER_ID, id=BENCH_USER_ID, name=BENCH_USER_ID)
+
+    try:
+        run('bulk', db_handler, insert_bulk, args)
+        if args.legacy:
+            run('legacy', db_handler, insert_legacy, args)
+    finally:
+        db_handler.delete(Users, BENCH_USER_ID)
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark of matching slides of a modified presentation by fingerprints, img_eq matrix and pairwise img_eq.
+
+Run from the repository root:
+    python -m app.server.benchmarks.bench_slide_matching --slides 300 --legacy
+
+Slides are generated images of --width pixels, the modified deck has them
+shuffled with a few slides replaced, so every old slide but the replaced
+ones has exactly one match.
+"""
+import argparse
+import random
+import time
+
+import cv2
+import numpy as np
+
+from app.server.main.utils import utils, fingerprint
+
+
+def create_slide(rnd, width):
+    height = width * 9 // 16
+    img = np.full((height, width, 3), 255, np.uint8)
+    for _ in range(rnd.randint(3, 8)):
+        x, y = rnd.randrange(width), rnd.randrange(height)
+        color = tuple(rnd.randrange(256) for _ in range(3))
+        cv2.rectangle(img, (x, y), (x + rnd.randrange(width // 3), y + rnd.randrange(height // 3)), color, -1)
+    cv2.putText(img, f'Slide {rnd.randrange(10 ** 6)}', (width // 10, height // 5),
+                cv2.FONT_HERSHEY_SIMPLEX, width / 600, (0, 0, 0), 2)
+    return cv2.imencode('.png', img)[1].tobytes()
+
+
+def create_decks(slides_count, replaced_count, width, seed=0):
+    rnd = random.Random(seed)
+    old = [create_slide(rnd, width) for _ in range(slides_count)]
+    new = old[replaced_count:] + [create_slide(rnd, width) for _ in range(replaced_count)]
+    rnd.shuffle(new)
+    return old, new
+
+
+def match_legacy(old, new):
+    return [[j for j, upd_thumb in enumerate(new) if utils.img_eq(db_thumb, upd_thumb)] for db_thumb in old]
+
+
+def match_matrix(old, new):
+    matrix = utils.img_eq_matrix(old, new)
+    return [[int(j) for j in np.flatnonzero(row)] for row in matrix]
+
+
+def match_fingerprints(old, new):
+    # Old fingerprints are stored at ingest, so only the new deck is hashed during sync
+    old_fingerprints = [fingerprint.phash(thumb) for thumb in old]
+
+    start = time.perf_counter()
+    tree = fingerprint.BKTree()
+    for j, upd_thumb in enumerate(new):
+        tree.add(fingerprint.phash(upd_thumb), j)
+    matches = []
+    for db_thumb, db_fingerprint in zip(old, old_fingerprints):
+        candidates = sorted(j for distance, j in tree.search(db_fingerprint, fingerprint.MATCH_DISTANCE))
+        if len(candidates) == 0:
+            matches.append([])
+            continue
+        confirmed = utils.img_eq_matrix([db_thumb], [new[j] for j in candidates])[0]
+        matches.append([j for j, match in zip(candidates, confirmed) if match])
+    return matches, time.perf_counter() - start
+
+
+def run(name, old, new, matches, elapsed):
+    matched = sum(1 for pair in matches if len(pair) == 1)
+    print(f'{name:<12} slides={len(old):<5} matched={matched:<5} time={elapsed:8.3f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slides', type=int, default=300)
+    parser.add_argument('--replaced', type=int, default=10)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--legacy', action='store_true', help='also compare images of every pair of slides')
+    args = parser.parse_args()
+
+    old, new = create_decks(args.slides, args.replaced, args.width)
+
+    matches, elapsed = match_fingerprints(old, new)
+    run('fingerprint', old, new, matches, elapsed)
+    if args.legacy:
+        for name, match in (('matrix', match_matrix), ('legacy', match_legacy)):
+            utils.image_cache.clear()
+            start = time.perf_counter()
+            compared_matches = match(old, new)
+            run(name, old, new, compared_matches, time.perf_counter() - start)
+            assert compared_matches == matches
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Benchmark of tag query filtering, per-slide regex substitution and eval against the SQL query of TagQuery.
+
+Requires the database from docker/docker-compose.yml. Run from the repository root:
+    python -m app.server.benchmarks.bench_tag_query --slides 20000 --links 100000 --legacy
+
+Slides and links of a benchmark user are inserted once and removed after the run,
+both filters are measured with fetching of their rows from the database.
+"""
+import argparse
+import random
+import re
+import time
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import insert
+
+from app.definitions import db_user, db_password, db_url, db_name
+from app.server.main.database.database_handler import DatabaseHandler, Users, Presentations, Slides, Tags, \
+    SlideLinks
+
+BENCH_USER_ID = 'BENCH_TAG_QUERY_USER_ID'
+BENCH_PRES_ID = 'BENCH_TAG_QUERY_PRES'
+
+QUERIES = (
+    'tag1',
+    'tag1 and not tag2',
+    'tag3 > 50 or tag4 and tag5 <= 20',
+    '(tag1 + tag3) * 2 >= 100 and not (tag6 or tag7)',
+)
+
+
+def create_links(slides_count, links_count, tags_count, seed=0):
+    rnd = random.Random(seed)
+    links = set()
+    while len(links) < links_count:
+        links.add((rnd.randrange(slides_count), f'tag{rnd.randrange(tags_count)}'))
+    return [
+        (slide_index, tag_name, rnd.choice([None, rnd.randrange(100)]))
+        for slide_index, tag_name in sorted(links)
+    ]
+
+
+def populate(db_handler, slides_count, links, tags_count):
+    db_handler.create(Presentations, id=BENCH_PRES_ID, name=BENCH_PRES_ID, owner_id=BENCH_USER_ID,
+                      modified_time=datetime.utcnow())
+    slide_ids = db_handler.create_slides([
+        {
+            'pres_id': BENCH_PRES_ID,
+            'index': i,
+            'thumbnail_hash': 'BENCH_THUMBNAIL_HASH',
+            'text': f'Slide {i}',
+            'ratio': Slides.Ratio.WIDESCREEN_16_TO_9
+        }
+        for i in range(slides_count)
+    ], batch_size=1000)
+
+    tag_ids = {}
+    for i in range(tags_count):
+        _, tag = db_handler.create(Tags, name=f'tag{i}', owner_id=BENCH_USER_ID)
+        tag_ids[tag.name] = tag.id
+
+    with db_handler.unit_of_work() as session:
+        rows = [
+            {'slide_id': slide_ids[slide_index], 'tag_id': tag_ids[tag_name], 'value': value}
+            for slide_index, tag_name, value in links
+        ]
+        for start in range(0, len(rows), 1000):
+            session.execute(insert(SlideLinks).values(rows[start:start + 1000]))
+
+
+def remove(db_handler):
+    db_handler.delete(Presentations, BENCH_PRES_ID)
+    with db_handler.unit_of_work() as session:
+        session.query(Tags).filter(Tags.owner_id == BENCH_USER_ID).delete(synchronize_session=False)
+    db_handler.delete(Users, BENCH_USER_ID)
+
+
+def legacy_filter(db_handler, query):
+    # Filtering used before TagQuery, links are fetched and the query is evaluated per slide
+    tag_names = re.findall('[a-z]+[a-z0-9]*', query)
+    tag_names = [tag.strip() for tag in tag_names if tag.strip() not in ['and', 'or', 'not']]
+
+    slide_tags_values = {}
+    for link, tag in db_handler.get_links_and_tags(SlideLinks, BENCH_USER_ID, tag_names):
+        if slide_tags_values.get(link.slide_id) is None:
+            slide_tags_values[link.slide_id] = {key: False for key in tag_names}
+        slide_tags_values[link.slide_id][tag.name] = link.value if link.value is not None else True
+
+    filtered_slides = []
+    for slide_id in slide_tags_values.keys():
+        eval_query = query
+        for tag in slide_tags_values[slide_id].keys():
+            eval_query = re.sub(rf"(^{tag}\s+)|( +{tag}\s+)|(\s+{tag}$)|({tag})",
+                                f" {str(slide_tags_values[slide_id][tag])} ", eval_query)
+        try:
+            if eval(eval_query):
+                filtered_slides.append(slide_id)
+        except:
+            filtered_slides = []
+    return filtered_slides
+
+
+def sql_filter(db_handler, query):
+    return db_handler.get_slide_ids_by_tag_query(query, BENCH_USER_ID)
+
+
+def run(name, db_handler, filter_slides, links_count):
+    for query in QUERIES:
+        start = time.perf_counter()
+        found = filter_slides(db_handler, query)
+        elapsed = time.perf_counter() - start
+        print(f'{name:<6} links={links_count:<7} found={len(found):<6} time={elapsed:8.3f}s  {query}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--slides', type=int, default=20000)
+    parser.add_argument('--links', type=int, default=100000)
+    parser.add_argument('--tags', type=int, default=10)
+    parser.add_argument('--legacy', action='store_true', help='also run regex substitution and eval per slide')
+    args = parser.parse_args()
+
+    pool = ThreadPool(processes=1)
+    db_handler = DatabaseHandler(user=db_user, password=db_password, host=db_url, db=db_name, pool=pool, echo=False)
+    db_handler.create_db()
+    db_handler.find_or_create(Users, Users.id == BENCH_USER_ID, id=BENCH_USER_ID, name=BENCH_USER_ID)
+
+    try:
+        populate(db_handler, args.slides, create_links(args.slides, args.links, args.tags), args.tags)
+        run('sql', db_handler, sql_filter, args.links)
+        if args.legacy:
+            run('legacy', db_handler, legacy_filter, args.links)
+    finally:
+        remove(db_handler)
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,33 @@
-import base64
-import re
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 import enum
-import os
-from threading import Lock
-
-from sqlalchemy import create_engine, ForeignKey, DateTime, Identity, text, update, select, asc, Boolean, Enum
-from sqlalchemy import Table, Column, Integer, String, MetaData, LargeBinary
-from sqlalchemy.exc import IntegrityError
+import difflib
+from collections import Counter
+from contextlib import contextmanager
+from threading import Lock, local
+
+from sqlalchemy import create_engine, ForeignKey, DateTime, Identity, text, update, select, asc, Boolean, Enum, \
+    insert, func, case, Index, inspect
+from sqlalchemy import Table, Column, Integer, BigInteger, String, MetaData
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import declarative_base, relationship, scoped_session
 from sqlalchemy.orm import sessionmaker
 
-from app.definitions import SERVER_ROOT
-from app.server.main.utils import utils
+from app.definitions import thumbnails_path
+from app.server.main.database import text_search
+from app.server.main.database.tag_query import TagQuery
+from app.server.main.utils import utils, fingerprint
+from app.server.main.utils.thumbnail_store import ThumbnailStore
+from app.server.main.utils.workspace import Workspace
 
 Base = declarative_base()
 
+# Format of modifiedTime of Google Drive files, e.g. 2023-05-01T00:00:00.000Z
+DRIVE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%fZ'
+# Modification time of presentations created before their slides are stored, older than any Drive file
+UNSYNCED_TIME = datetime(1970, 1, 1)
+
 
 class Users(Base):
     __tablename__ = 'users'
@@ -64,19 +76,27 @@ class Slides(Base):
     id = Column('id', Integer, Identity(start=1, increment=1), primary_key=True)
     pres_id = Column('pres_id', String, ForeignKey("presentations.id", ondelete='CASCADE'), nullable=False)
     index = Column('index', Integer, nullable=False)
-    thumbnail = Column('thumbnail', LargeBinary, nullable=False)
+    # Thumbnail bytes are kept in ThumbnailStore, so slide rows stay small
+    thumbnail_hash = Column('thumbnail_hash', String, nullable=False)
+    # Perceptual hash of the thumbnail, used to match slides of modified presentations
+    fingerprint = Column('fingerprint', BigInteger)
     text = Column('text', String, nullable=False)
     ratio = Column('ratio', Enum(Ratio), nullable=True)
 
     parent_pres = relationship('Presentations', backref='slides', cascade='all, delete')
     child_links = relationship('SlideLinks', backref='slides', cascade='delete', passive_deletes=True)
 
+    def thumbnail_url(self, size='full'):
+        # Versioned by content hash, so the URL changes whenever the thumbnail does
+        return f'/slides/{self.id}/thumbnail?size={size}&v={self.thumbnail_hash}'
+
     def json(self):
         return {
             'id': self.id,
             'pres_id': self.pres_id,
             'index': self.index,
-            'thumbnail': base64.b64encode(self.thumbnail),
+            'thumbnail': self.thumbnail_url(),
+            'thumbnails': {size: self.thumbnail_url(size) for size in ThumbnailStore.SIZES},
             'text': self.text,
             'ratio': self.ratio.value
         }
@@ -84,6 +104,7 @@ class Slides(Base):
 
 class Tags(Base):
     __tablename__ = 'tags'
+    __table_args__ = (Index('tags_owner_id_name_idx', 'owner_id', 'name'),)
 
     id = Column('id', Integer, Identity(start=1, increment=1), primary_key=True)
     name = Column('name', String, nullable=False)
@@ -99,6 +120,7 @@ class Tags(Base):
 
 class SlideLinks(Base):
     __tablename__ = 'slide_links'
+    __table_args__ = (Index('slide_links_tag_id_slide_id_idx', 'tag_id', 'slide_id'),)
 
     id = Column('id', Integer, Identity(start=1, increment=1), primary_key=True)
     slide_id = Column('slide_id', Integer, ForeignKey("slides.id", ondelete='CASCADE'), nullable=False)
@@ -109,6 +131,7 @@ class SlideLinks(Base):
 
 class PresentationLinks(Base):
     __tablename__ = 'presentation_links'
+    __table_args__ = (Index('presentation_links_tag_id_pres_id_idx', 'tag_id', 'pres_id'),)
 
     id = Column('id', Integer, Identity(start=1, increment=1), primary_key=True)
     pres_id = Column('pres_id', String, ForeignKey("presentations.id", ondelete='CASCADE'), nullable=False)
@@ -117,520 +140,872 @@ class PresentationLinks(Base):
     parent_slides = relationship('Presentations', backref='pres-links')
 
 
+class SyncJobs(Base):
+    __tablename__ = 'sync_jobs'
+
+    class State(enum.Enum):
+        QUEUED = 'queued'
+        RUNNING = 'running'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    id = Column('id', Integer, Identity(start=1, increment=1), primary_key=True)
+    owner_id = Column('owner_id', String, ForeignKey("users.id"), nullable=False)
+    state = Column('state', Enum(State), nullable=False)
+    error = Column('error', String)
+    created_time = Column('created_time', DateTime, nullable=False)
+    finished_time = Column('finished_time', DateTime)
+
+    child_items = relationship('SyncJobItems', backref='sync_jobs', cascade='all, delete', passive_deletes=True)
+
+    def json(self):
+        return {
+            'id': self.id,
+            'state': self.state.value,
+            'error': self.error,
+            'created_time': str(self.created_time),
+            'finished_time': str(self.finished_time) if self.finished_time is not None else None
+        }
+
+
+class SyncJobItems(Base):
+    __tablename__ = 'sync_job_items'
+
+    class State(enum.Enum):
+        QUEUED = 'queued'
+        DOWNLOADING = 'downloading'
+        RENDERING = 'rendering'
+        STORING = 'storing'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    class Delta(enum.Enum):
+        CREATED = 'created'
+        MODIFIED = 'modified'
+        SYNCED = 'synced'
+
+    id = Column('id', Integer, Identity(start=1, increment=1), primary_key=True)
+    job_id = Column('job_id', Integer, ForeignKey("sync_jobs.id", ondelete='CASCADE'), nullable=False)
+    # Not a foreign key, presentation can be removed from the drive while the job status is still shown
+    pres_id = Column('pres_id', String, nullable=False)
+    name = Column('name', String, nullable=False)
+    delta = Column('delta', Enum(Delta), nullable=False)
+    state = Column('state', Enum(State), nullable=False)
+    error = Column('error', String)
+
+    def json(self):
+        return {
+            'id': self.pres_id,
+            'name': self.name,
+            'delta': self.delta.value,
+            'state': self.state.value,
+            'error': self.error
+        }
+
+
 class DatabaseHandler:
-    def __init__(self, user, password, host, db, pool, echo=True):
+    def __init__(self, user, password, host, db, pool, echo=True, pool_size=20, max_overflow=10, pool_timeout=30,
+                 thumbnail_store=None):
         self.engine = create_engine(
             f"postgresql://{user}:{password}@{host}/{db}",
             echo=echo,
-            future=True)
-        self.Session = sessionmaker(bind=self.engine)
+            future=True,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_timeout=pool_timeout,
+            pool_pre_ping=True)
+        # Objects are used after their unit of work is committed and its session is closed
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
         self.pool = pool
         self.lock_mutex = Lock()
-        self.sync_query = {}
+        self.local = local()
+        # Whether slides text is searched by PostgreSQL, checked on first search
+        self.text_search_indexed = None
+        self.thumbnail_store = thumbnail_store or ThumbnailStore(thumbnails_path)
+
+    @contextmanager
+    def unit_of_work(self):
+        """Runs enclosed operations in one session and one transaction.
+
+        Nested units of work in the same thread join the outermost one, so handler
+        methods can be composed and committed once. Changes are rolled back on error.
+        """
+        session = getattr(self.local, 'session', None)
+        if session is not None:
+            yield session
+            return
+
+        session = self.Session()
+        self.local.session = session
+        try:
+            yield session
+            session.commit()
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            self.local.session = None
+            session.close()
+
+    def in_unit_of_work(self):
+        return getattr(self.local, 'session', None) is not None
 
     def create_db(self):
         Base.metadata.create_all(self.engine)
+        # create_all skips existing tables, indexes added later are created separately
+        for table in (Tags, SlideLinks, PresentationLinks):
+            for index in table.__table__.indexes:
+                index.create(self.engine, checkfirst=True)
+        if self.engine.dialect.name == 'postgresql':
+            with self.engine.begin() as connection:
+                self.__migrate_thumbnails(connection)
+                # Fingerprints of existing slides are computed on their next sync
+                connection.execute(text('ALTER TABLE slides ADD COLUMN IF NOT EXISTS fingerprint BIGINT'))
+            try:
+                with self.engine.begin() as connection:
+                    text_search.create_search_indexes(connection)
+                self.text_search_indexed = True
+            except DBAPIError as e:
+                # Roles without CREATE privilege can't install pg_trgm, slides are then matched by substring
+                print(f'Text search indexes are not created: {e}')
+                self.text_search_indexed = False
+        else:
+            self.text_search_indexed = False
+
+    def __migrate_thumbnails(self, connection, batch_size=100):
+        # Databases created before ThumbnailStore keep thumbnail bytes in slides.thumbnail
+        if 'thumbnail' not in [column['name'] for column in inspect(connection).get_columns('slides')]:
+            return
+        connection.execute(text('ALTER TABLE slides ADD COLUMN IF NOT EXISTS thumbnail_hash VARCHAR'))
+        while True:
+            rows = connection.execute(
+                text('SELECT id, thumbnail FROM slides WHERE thumbnail_hash IS NULL LIMIT :limit'),
+                {'limit': batch_size}
+            ).all()
+            if len(rows) == 0:
+                break
+            # Pyramids of migrated thumbnails are made on first request, not at startup
+            connection.execute(
+                text('UPDATE slides SET thumbnail_hash = :thumbnail_hash WHERE id = :id'),
+                [{'id': slide_id, 'thumbnail_hash': self.thumbnail_store.put(bytes(thumbnail), pyramid=False)}
+                 for slide_id, thumbnail in rows]
+            )
+        connection.execute(text('ALTER TABLE slides ALTER COLUMN thumbnail_hash SET NOT NULL'))
+        # Thumbnail bytes are kept until drop_legacy_thumbnails is run, new slides don't have them
+        connection.execute(text('ALTER TABLE slides ALTER COLUMN thumbnail DROP NOT NULL'))
+
+    def drop_legacy_thumbnails(self):
+        """Drops slides.thumbnail left by the migration to ThumbnailStore, returns whether it was dropped.
+
+        The column is dropped only if the thumbnail of every slide is in the store,
+        AttributeError is raised otherwise and the column is kept.
+        """
+        with self.engine.begin() as connection:
+            if 'thumbnail' not in [column['name'] for column in inspect(connection).get_columns('slides')]:
+                return False
+            missing = [
+                slide_id for slide_id, thumbnail_hash in connection.execute(select(Slides.id, Slides.thumbnail_hash))
+                if thumbnail_hash is None or not self.thumbnail_store.exists(thumbnail_hash)
+            ]
+            if len(missing) > 0:
+                raise AttributeError(f'Thumbnails of {len(missing)} slides are missing in the store, e.g. {missing[:10]}')
+            connection.execute(text('ALTER TABLE slides DROP COLUMN thumbnail'))
+        return True
 
     def clear_db(self):
-        session = self.Session()
-        session.execute('''TRUNCATE TABLE users CASCADE''')
-        session.execute('''TRUNCATE TABLE presentations CASCADE''')
-        session.execute('''TRUNCATE TABLE slides CASCADE''')
-        session.execute('''TRUNCATE TABLE tags CASCADE''')
-        session.execute('''TRUNCATE TABLE presentation_links CASCADE''')
-        session.execute('''TRUNCATE TABLE slide_links CASCADE''')
-        session.execute('''TRUNCATE TABLE folders CASCADE''')
-        session.commit()
-        session.close()
+        with self.unit_of_work() as session:
+            session.execute('''TRUNCATE TABLE users CASCADE''')
+            session.execute('''TRUNCATE TABLE presentations CASCADE''')
+            session.execute('''TRUNCATE TABLE slides CASCADE''')
+            session.execute('''TRUNCATE TABLE tags CASCADE''')
+            session.execute('''TRUNCATE TABLE presentation_links CASCADE''')
+            session.execute('''TRUNCATE TABLE slide_links CASCADE''')
+            session.execute('''TRUNCATE TABLE folders CASCADE''')
+            session.execute('''TRUNCATE TABLE sync_jobs CASCADE''')
+            session.execute('''TRUNCATE TABLE sync_job_items CASCADE''')
+        self.thumbnail_store.clear()
 
     # GENERAL CRUD
     def create(self, table, **kwargs):
-        session = self.Session()
-        obj = self.read(table, kwargs.get('id'))
-        if obj is None:
+        if table is Slides:
+            kwargs = self.__store_thumbnail(kwargs)
+        nested = self.in_unit_of_work()
+        with self.unit_of_work() as session:
+            obj = session.get(table, kwargs.get('id')) if kwargs.get('id') is not None else None
+            if obj is not None:
+                return False, obj
+
             obj = table(**kwargs)
-            session.add(obj)
-            session.commit()
-            session.refresh(obj)
-            session.close()
-            created = True
-        else:
-            created = False
-        return created, obj
+            if nested:
+                # Failed insert (e.g. concurrent create) must not abort the enclosing transaction
+                with session.begin_nested():
+                    session.add(obj)
+            else:
+                session.add(obj)
+                session.flush()
+            return True, obj
 
     def find_or_create(self, table, *criterion, **kwargs):
-        session = self.Session()
-        obj = self.find(table, *criterion)
-        if obj is None:
-            session.add(table(**kwargs))
-            session.commit()
-            session.close()
-            obj = self.find(table, *criterion)
-            return True, obj
-        return False, obj
+        with self.unit_of_work() as session:
+            obj = session.query(table).where(*criterion).first()
+            if obj is None:
+                obj = table(**kwargs)
+                session.add(obj)
+                session.flush()
+                return True, obj
+            return False, obj
 
     def read(self, table, obj_id):
-        session = self.Session()
-        obj = session.query(table).get(obj_id)
-        session.close()
-        return obj
+        with self.unit_of_work() as session:
+            return session.get(table, obj_id)
 
     def update(self, table, obj_id, **kwargs):
-        session = self.Session()
-        obj = session.query(table).filter(table.id == obj_id).first()
-        if obj is None:
-            updated = False
-        else:
+        with self.unit_of_work() as session:
+            obj = session.query(table).filter(table.id == obj_id).first()
+            if obj is None:
+                return False
             for kwarg, value in kwargs.items():
                 setattr(obj, kwarg, value)
-            session.commit()
-            session.close()
-            updated = True
-        return updated
+            session.flush()
+            return True
 
     def delete(self, table, obj_id):
-        session = self.Session()
-        session.query(table).filter(table.id == obj_id).delete()
-        session.commit()
-        session.close()
+        with self.unit_of_work() as session:
+            session.query(table).filter(table.id == obj_id).delete()
 
     def findall(self, table, *criterion):
-        session = self.Session()
-        result = session.query(table).where(*criterion).all()
-        session.close()
-        return result
+        with self.unit_of_work() as session:
+            return session.query(table).where(*criterion).all()
 
     def find(self, table, *criterion):
-        session = self.Session()
-        result = session.query(table).where(*criterion).first()
-        session.close()
-        return result
+        with self.unit_of_work() as session:
+            return session.query(table).where(*criterion).first()
+
+    def __store_thumbnail(self, slide):
+        # Slides given with thumbnail bytes reference them in the store by hash.
+        # Storing encodes the thumbnail pyramid, so it is done before a transaction is opened
+        slide = dict(slide)
+        if 'thumbnail' in slide:
+            thumbnail = slide.pop('thumbnail')
+            slide['thumbnail_hash'] = self.thumbnail_store.put(thumbnail)
+            if slide.get('fingerprint') is None:
+                slide['fingerprint'] = fingerprint.phash(thumbnail)
+        return slide
+
+    # BULK INSERT
+    @staticmethod
+    def __insert_slides(session, slides, batch_size):
+        slide_ids = {}
+        for start in range(0, len(slides), batch_size):
+            inserted = session.execute(
+                insert(Slides)
+                .values(slides[start:start + batch_size])
+                .returning(Slides.id, Slides.pres_id, Slides.index)
+            )
+            for slide_id, pres_id, index in inserted:
+                slide_ids[(pres_id, index)] = slide_id
+        return [slide_ids[(slide.get('pres_id'), slide.get('index'))] for slide in slides]
+
+    def create_slides(self, slides, batch_size=100):
+        """Inserts slides given as dicts of Slides columns in one transaction.
+
+        Rows are sent with multi-row INSERT statements of batch_size rows,
+        ids of created slides are returned in the order of given slides.
+        """
+        if len(slides) == 0:
+            return []
+        slides = [self.__store_thumbnail(slide) for slide in slides]
+        with self.unit_of_work() as session:
+            return self.__insert_slides(session, slides, batch_size)
+
+    def delete_unreferenced_thumbnails(self, grace_period=timedelta(hours=1)):
+        """Removes stored thumbnails of deleted slides and replaced thumbnails, returns their number.
+
+        Thumbnails are stored before the slides referencing them are committed,
+        so thumbnails stored or reused within grace_period are kept.
+        """
+        modified_before = time.time() - grace_period.total_seconds()
+        with self.unit_of_work() as session:
+            referenced = {thumbnail_hash for thumbnail_hash, in session.query(Slides.thumbnail_hash).distinct()}
+        return self.thumbnail_store.sweep(referenced, modified_before)
 
     def get_slides_index_asc(self, pres_id):
-        session = self.Session()
-        pres = self.read(Presentations, pres_id)
-        if pres is not None:
-            slides = session.query(Slides)\
-                .filter(Slides.pres_id == pres.id)\
-                .order_by(Slides.index)\
-                .all()
-            session.close()
-            return slides
-        else:
-            session.close()
-            return None
+        with self.unit_of_work() as session:
+            pres = self.read(Presentations, pres_id)
+            if pres is not None:
+                return session.query(Slides)\
+                    .filter(Slides.pres_id == pres.id)\
+                    .order_by(Slides.index)\
+                    .all()
+            else:
+                return None
 
     def get_links_and_tags(self, table, user_id, tag_names):
-        session = self.Session()
-        links_and_tags = session.query(table, Tags) \
-            .filter(Tags.name.in_(tag_names), Tags.owner_id == user_id) \
-            .filter(table.tag_id == Tags.id) \
-            .all()
-        session.close()
-        return links_and_tags
+        with self.unit_of_work() as session:
+            return session.query(table, Tags) \
+                .filter(Tags.name.in_(tag_names), Tags.owner_id == user_id) \
+                .filter(table.tag_id == Tags.id) \
+                .all()
 
     def get_slide_thumb_by_index(self, user_id, pres_id, index):
-        session = self.Session()
-        pres = self.read(Presentations, pres_id)
-        if pres is not None and pres.owner_id == user_id:
-            slide = session.query(Slides) \
-                .filter(Slides.pres_id == pres.id, Slides.index == index) \
-                .first()
-            session.close()
-            return slide.thumbnail
-        else:
-            session.close()
-            return None
+        with self.unit_of_work() as session:
+            pres = self.read(Presentations, pres_id)
+            if pres is not None and pres.owner_id == user_id:
+                slide = session.query(Slides) \
+                    .filter(Slides.pres_id == pres.id, Slides.index == index) \
+                    .first()
+                return self.thumbnail_store.get(slide.thumbnail_hash)
+            else:
+                return None
+
+    def get_slide_thumbnail_hash(self, slide_id, user_id):
+        """Returns hash of the slide thumbnail in the store, None if the slide is not found or not owned by user."""
+        with self.unit_of_work() as session:
+            return session.query(Slides.thumbnail_hash) \
+                .join(Presentations, Presentations.id == Slides.pres_id) \
+                .filter(Slides.id == slide_id, Presentations.owner_id == user_id) \
+                .scalar()
+
+    def get_slides_by_ids(self, slide_ids, user_id):
+        """Returns dict of slides by id fetched in one query, slides not owned by user are left out."""
+        if len(slide_ids) == 0:
+            return {}
+        with self.unit_of_work() as session:
+            user_slides = session.query(Slides) \
+                .join(Presentations, Presentations.id == Slides.pres_id) \
+                .filter(Slides.id.in_(set(slide_ids)), Presentations.owner_id == user_id) \
+                .all()
+            return {slide.id: slide for slide in user_slides}
+
+    @staticmethod
+    def __upsert(session, table, rows, update_columns, batch_size=1000):
+        for start in range(0, len(rows), batch_size):
+            statement = pg_insert(table).values(rows[start:start + batch_size])
+            session.execute(statement.on_conflict_do_update(
+                index_elements=[table.id],
+                set_={column: statement.excluded[column] for column in update_columns}
+            ))
 
     def sync_folders(self, user_id, actual_folders):
-        synced_folders = []
+        actual_by_id = {}
         for folder in actual_folders:
-            try:
-                _, db_folder = self.create(
-                    Folders,
+            parents = folder.get('parents')
+            actual_by_id[folder.get('id')] = {
+                'id': folder.get('id'),
+                'name': folder.get('name'),
+                'parent': parents[0] if parents else None,
+                'mark': False,
+                'owner_id': user_id
+            }
 
-                    id=folder.get('id'),
-                    name=folder.get('name'),
-                    mark=False,
-                    owner_id=user_id
-                )
-            except IntegrityError:
-                db_folder = self.read(Folders, folder.get('id'))
-            synced_folders.append(db_folder)
-
-        db_folders = self.findall(Folders, Folders.owner_id == user_id)
-
-        for db_folder in db_folders:
-            if len([folder for folder in actual_folders if folder.get('id') == db_folder.id]) == 0:
-                self.delete(Folders, db_folder.id)
-
-        return synced_folders
-
-    def sync_presentations(self, user_id, actual_presentations):
-        synced_presentations = []
-
-        db_presentations = self.findall(Presentations, Presentations.owner_id == user_id)
-        for db_pres in db_presentations:
-            removed = True
-            for actual_pres in actual_presentations:
-                if db_pres.id == actual_pres.get('id'):
-                    removed = False
-                    break
-            if removed:
-                self.delete(Presentations, db_pres.id)
-
-        # Presentation data which require download to sync
-        created_presentations = []
-        modified_presentations = []
-
-        for actual_pres in actual_presentations:
-            created, db_pres = self.create(
-                Presentations,
-
-                id=actual_pres.get('id'),
-                name=actual_pres.get('name'),
-                owner_id=user_id,
-                modified_time=actual_pres.get('modifiedTime')
-            )
+        with self.unit_of_work() as session:
+            db_by_id = {
+                db_folder.id: db_folder
+                for db_folder in session.query(Folders).filter(Folders.owner_id == user_id)
+            }
 
-            if created:
+            changed = [
+                row for folder_id, row in actual_by_id.items()
+                if folder_id not in db_by_id
+                or (db_by_id[folder_id].name, db_by_id[folder_id].parent) != (row.get('name'), row.get('parent'))
+            ]
+            removed = [folder_id for folder_id in db_by_id if folder_id not in actual_by_id]
+
+            # Marks are user preferences, conflicting rows only get Drive metadata updated
+            self.__upsert(session, Folders, changed, ('name', 'parent'))
+            if len(removed) > 0:
+                session.query(Folders) \
+                    .filter(Folders.owner_id == user_id, Folders.id.in_(removed)) \
+                    .delete(synchronize_session=False)
+
+            if len(changed) > 0:
+                changed_ids = [row.get('id') for row in changed]
+                for db_folder in session.query(Folders) \
+                        .filter(Folders.id.in_(changed_ids)) \
+                        .populate_existing():
+                    db_by_id[db_folder.id] = db_folder
+
+            return [db_by_id[folder_id] for folder_id in actual_by_id if folder_id in db_by_id]
+
+    def sync_presentations(self, user_id, actual_presentations, defer_modified_time=False):
+        """Stores actual presentations of the user, returns them with (created, modified) ones to sync slides of.
+
+        With defer_modified_time new modification times are not stored, created presentations get
+        UNSYNCED_TIME. They are set by finish_presentation_sync once slides are stored, so presentations
+        whose slides failed to sync are synced again next time.
+        """
+        actual_by_id = {pres.get('id'): pres for pres in actual_presentations}
+
+        with self.unit_of_work() as session:
+            db_by_id = {
+                pres_id: (name, modified_time)
+                for pres_id, name, modified_time in session.query(
+                    Presentations.id, Presentations.name, Presentations.modified_time
+                ).filter(Presentations.owner_id == user_id)
+            }
+            removed = [pres_id for pres_id in db_by_id if pres_id not in actual_by_id]
+
+            # Presentation shared with the user can be already stored for another owner
+            missing = [pres_id for pres_id in actual_by_id if pres_id not in db_by_id]
+            if len(missing) > 0:
+                for pres_id, name, modified_time in session.query(
+                        Presentations.id, Presentations.name, Presentations.modified_time
+                ).filter(Presentations.id.in_(missing)):
+                    db_by_id[pres_id] = (name, modified_time)
+
+            synced_presentations = []
+            # Presentation data which require download to sync
+            created_presentations = []
+            modified_presentations = []
+            upserted = []
+
+            for pres_id, actual_pres in actual_by_id.items():
                 synced_presentations.append(actual_pres)
-                created_presentations.append(actual_pres)
-            elif datetime.strptime(actual_pres.get('modifiedTime'), '%Y-%m-%dT%H:%M:%S.%fZ') > db_pres.modified_time:
-                    self.update(
-                        Presentations,
-
-                        obj_id=db_pres.id,
-
-                        id=actual_pres.get('id'),
-                        name=actual_pres.get('name'),
-                        owner_id=user_id,
-                        modified_time=actual_pres.get('modifiedTime')
-                    )
-                    synced_presentations.append(actual_pres)
+                row = {
+                    'id': pres_id,
+                    'name': actual_pres.get('name'),
+                    'owner_id': user_id,
+                    'modified_time': datetime.strptime(actual_pres.get('modifiedTime'), DRIVE_TIME_FORMAT)
+                }
+
+                if pres_id not in db_by_id:
+                    created_presentations.append(actual_pres)
+                    upserted.append(dict(row, modified_time=UNSYNCED_TIME) if defer_modified_time else row)
+                    continue
+
+                db_name, db_modified_time = db_by_id[pres_id]
+                if row.get('modified_time') > db_modified_time:
                     modified_presentations.append(actual_pres)
-            else:
-                synced_presentations.append(actual_pres)
-
-        self.set_sync_query(user_id, (created_presentations, modified_presentations), synced_presentations)
+                    upserted.append(dict(row, modified_time=db_modified_time) if defer_modified_time else row)
+                elif row.get('name') != db_name:
+                    # Renaming does not change slides, only the stored name is updated
+                    upserted.append(dict(row, modified_time=db_modified_time))
+
+            if len(removed) > 0:
+                session.query(Presentations) \
+                    .filter(Presentations.owner_id == user_id, Presentations.id.in_(removed)) \
+                    .delete(synchronize_session=False)
+            self.__upsert(session, Presentations, upserted, ('name', 'owner_id', 'modified_time'))
+
+            return synced_presentations, (created_presentations, modified_presentations)
+
+    def finish_presentation_sync(self, presentation):
+        """Stores modification time of presentation synced with defer_modified_time."""
+        with self.unit_of_work() as session:
+            session.execute(
+                update(Presentations)
+                .where(Presentations.id == presentation.get('id'))
+                .values(modified_time=datetime.strptime(presentation.get('modifiedTime'), DRIVE_TIME_FORMAT))
+            )
 
-        return synced_presentations, (created_presentations, modified_presentations)
+    def discard_presentation_sync(self, presentation):
+        """Removes presentation created by sync with defer_modified_time whose slides were not stored."""
+        with self.unit_of_work() as session:
+            session.query(Presentations) \
+                .filter(Presentations.id == presentation.get('id'), Presentations.modified_time == UNSYNCED_TIME) \
+                .delete(synchronize_session=False)
 
-    def __sync_created_presentation(self, presentation, presentation_ratio, presentation_text, user_id, max_slides=100):
+    def __sync_created_presentation(self, presentation, presentation_ratio, presentation_text, user_id, workspace,
+                                    max_slides=100):
+        slides = []
         for i in range(max_slides):
             try:
-                with open(os.path.join(SERVER_ROOT,
-                   f'presentation_processing/temp/{presentation.get("id")}/images/Слайд{i + 1}.png'), "rb") as image:
-                    img_bytes = image.read()
-
-                    self.create(
-                        Slides,
-
-                        pres_id=presentation.get('id'),
-                        index=i,
-                        thumbnail=img_bytes,
-                        text=presentation_text[i],
-                        ratio=presentation_ratio
-                    )
+                with open(workspace.image_path(presentation.get('id'), i), "rb") as image:
+                    slides.append({
+                        'pres_id': presentation.get('id'),
+                        'index': i,
+                        'thumbnail': image.read(),
+                        'text': presentation_text[i],
+                        'ratio': presentation_ratio
+                    })
 
             except FileNotFoundError:
                 break
-        self.lock_mutex.acquire()
-        self.sync_query[user_id]['created'] = [pres for pres in self.sync_query[user_id]['created'] if
-                                                pres.get('id') != presentation.get('id')]
-        self.lock_mutex.release()
-
-    def __sync_modified_presentation(self, presentation, presentation_ratio, presentation_text, user_id, max_slides=100):
 
+        self.create_slides(slides)
+
+    def __match_slide(self, db_slide, mdf_hashes, mdf_thumbnails, mdf_tree):
+        """Returns (distance, index) of slides of the modified presentation equal to the stored slide.
+
+        Slides equal byte for byte have distance -1, others the Hamming distance of fingerprints.
+        """
+        # Slides rendered the same way as before are equal byte for byte
+        if db_slide.thumbnail_hash in mdf_hashes:
+            return [(-1, j) for j in mdf_hashes[db_slide.thumbnail_hash]]
+
+        db_thumb = None
+        db_fingerprint = db_slide.fingerprint
+        if db_fingerprint is None:
+            # Slides stored before fingerprints were introduced get them on first sync
+            db_thumb = self.thumbnail_store.get(db_slide.thumbnail_hash)
+            db_fingerprint = fingerprint.phash(db_thumb)
+            self.update(Slides, obj_id=db_slide.id, fingerprint=db_fingerprint)
+
+        candidates = mdf_tree.search(db_fingerprint, fingerprint.MATCH_DISTANCE) if db_fingerprint is not None else []
+        if len(candidates) == 0:
+            return []
+
+        # Slides differing only in text can have fingerprints as close as renders of the same slide,
+        # so every candidate is confirmed by comparing images
+        db_thumb = db_thumb or self.thumbnail_store.get(db_slide.thumbnail_hash)
+        matches = utils.img_eq_matrix([db_thumb], [mdf_thumbnails[j] for distance, j in candidates])[0]
+        return [candidate for candidate, match in zip(candidates, matches) if match]
+
+    @staticmethod
+    def __assign_slides(db_slides, db_candidates, mdf_text):
+        """Returns dict of positions of stored slides to indices of slides of the modified presentation.
+
+        Every slide is assigned at most once, so copies of a slide are matched to
+        different copies. Pairs are taken greedily by distance, then by similarity
+        of text, then by how far the slide moved.
+        """
+        claims = Counter(j for candidates in db_candidates for distance, j in candidates)
+
+        pairs = []
+        for i, (db_slide, candidates) in enumerate(zip(db_slides, db_candidates)):
+            for distance, j in candidates:
+                text_similarity = 0
+                # Text is only compared when there is a choice
+                if len(candidates) > 1 or claims[j] > 1:
+                    text_similarity = difflib.SequenceMatcher(None, db_slide.text, mdf_text[j]).ratio()
+                pairs.append((distance, -text_similarity, abs(i - j), i, j))
+        pairs.sort()
+
+        assignment = {}
+        assigned = set()
+        for distance, text_similarity, moved, i, j in pairs:
+            if i not in assignment and j not in assigned:
+                assignment[i] = j
+                assigned.add(j)
+        return assignment
+
+    def __sync_modified_presentation(self, presentation, presentation_ratio, presentation_text, user_id, workspace,
+                                     max_slides=100):
         mdf_thumbnails = []
 
         for i in range(max_slides):
             try:
-                with open(os.path.join(SERVER_ROOT,
-                   f'presentation_processing/temp/{presentation.get("id")}/images/Слайд{i + 1}.png'), "rb") as image:
+                with open(workspace.image_path(presentation.get('id'), i), "rb") as image:
                     mdf_thumbnails.append(image.read())
 
             except FileNotFoundError:
                 break
 
-        db_slides = self.get_slides_index_asc(presentation.get('id'))
-        db_thumbnails = [slide.thumbnail for slide in db_slides]
-
-        upd_eq_count = [0] * len(mdf_thumbnails)
-
-        for i, db_thumb in enumerate(db_thumbnails):
-            pair = []
-            for j, upd_thumb in enumerate(mdf_thumbnails):
-                if utils.img_eq(db_thumb, upd_thumb):
-                    pair.append((j, upd_thumb))
-
-            # Совпадений нет - слайд удален
-            if len(pair) == 0:
-                self.delete(Slides, db_slides[i].id)
-
-            # Одно совпадение - слайд остался в презентации
-            # Если i == j - слайд остался на той же позиции
-            # Иначе его переместили на позицию j
-            elif len(pair) == 1:
-                j, _ = pair[0]
-                if i != j:
-                    self.update(
-                        Slides,
-                        obj_id=db_slides[i].id,
-                        index=j
-                    )
-                upd_eq_count[j] += 1
-
-            # Больше одного совпадения - в презентации несколько копий одного слайда
-            # TODO
-            else:
-                pass
+        # Slides are matched by fingerprints looked up in a BK-tree instead of comparing every pair of images.
+        # Thumbnails are stored before the transaction is opened, stored ones are not encoded again
+        mdf_hashes = {}
+        mdf_thumbnail_hashes = []
+        mdf_fingerprints = []
+        mdf_tree = fingerprint.BKTree()
+        for j, upd_thumb in enumerate(mdf_thumbnails):
+            mdf_thumbnail_hashes.append(self.thumbnail_store.put(upd_thumb))
+            mdf_hashes.setdefault(mdf_thumbnail_hashes[j], []).append(j)
+            mdf_fingerprints.append(fingerprint.phash(upd_thumb))
+            if mdf_fingerprints[j] is not None:
+                mdf_tree.add(mdf_fingerprints[j], j)
+
+        # Moves, deletes and inserts are applied in one transaction
+        with self.unit_of_work():
+            db_slides = self.get_slides_index_asc(presentation.get('id'))
+
+            db_candidates = [
+                self.__match_slide(db_slide, mdf_hashes, mdf_thumbnails, mdf_tree)
+                for db_slide in db_slides
+            ]
+            assignment = self.__assign_slides(db_slides, db_candidates, presentation_text)
+
+            for i, db_slide in enumerate(db_slides):
+                j = assignment.get(i)
+
+                # Совпадений нет - слайд удален
+                if j is None:
+                    self.delete(Slides, db_slide.id)
+                    continue
+
+                # Слайд остался в презентации
+                # Если i == j - слайд остался на той же позиции
+                # Иначе его переместили на позицию j
+                changes = {}
+                if db_slide.index != j:
+                    changes['index'] = j
+                # Slide matched by fingerprint may be slightly changed, its thumbnail and text are updated
+                if db_slide.thumbnail_hash != mdf_thumbnail_hashes[j]:
+                    changes.update({
+                        'thumbnail_hash': mdf_thumbnail_hashes[j],
+                        'fingerprint': mdf_fingerprints[j],
+                        'text': presentation_text[j]
+                    })
+                elif db_slide.fingerprint is None:
+                    changes['fingerprint'] = mdf_fingerprints[j]
+                if len(changes) > 0:
+                    self.update(Slides, obj_id=db_slide.id, **changes)
 
-        for i, occurrences in enumerate(upd_eq_count):
             # Если при сравнении со старой презентацией (из БД)
-            # не было ни одного совпадения со слайдом из новой презентации, то
+            # слайду из новой презентации не сопоставлен ни один слайд, то
             # этот слайд был добавлен
-            if occurrences == 0:
-                self.create(
-                    Slides,
-
-                    pres_id=presentation.get('id'),
-                    index=i,
-                    thumbnail=mdf_thumbnails[i],
-                    text=presentation_text[i],
-                    ratio=presentation_ratio
-                )
-        self.lock_mutex.acquire()
-        self.sync_query[user_id]['modified'] = [pres for pres in self.sync_query[user_id]['modified'] if pres.get('id') != presentation.get('id')]
-        self.lock_mutex.release()
-
-
-    def sync_presentation_slides(self, presentations, presentations_delta, presentations_ratio, presentations_text, user_id):
+            matched = set(assignment.values())
+            added_slides = []
+            for j in range(len(mdf_thumbnails)):
+                if j not in matched:
+                    added_slides.append({
+                        'pres_id': presentation.get('id'),
+                        'index': j,
+                        'thumbnail_hash': mdf_thumbnail_hashes[j],
+                        'fingerprint': mdf_fingerprints[j],
+                        'text': presentation_text[j],
+                        'ratio': presentation_ratio
+                    })
+
+            self.create_slides(added_slides)
+
+    def sync_presentation_slides(self, presentations, presentations_delta, presentations_ratio, presentations_text,
+                                 user_id, workspace=None):
+        workspace = workspace or Workspace.shared()
         created, modified = presentations_delta
 
         created_args = []
         modified_args = []
         for pres, ratio, text in zip(presentations, presentations_ratio, presentations_text):
             if pres in created:
-                created_args.append((pres, ratio, text, user_id))
+                created_args.append((pres, ratio, text, user_id, workspace))
             elif pres in modified:
-                modified_args.append((pres, ratio, text, user_id))
+                modified_args.append((pres, ratio, text, user_id, workspace))
 
         self.pool.starmap(self.__sync_created_presentation, created_args)
         self.pool.starmap(self.__sync_modified_presentation, modified_args)
 
     def set_folder_mark(self, user_id, folder_id, value):
-        folder = self.read(Folders, folder_id)
-        if folder.owner_id == user_id:
-            self.update(
-                Folders,
-                folder_id,
-                mark=value
-            )
+        with self.unit_of_work():
+            folder = self.read(Folders, folder_id)
+            if folder.owner_id == user_id:
+                self.update(
+                    Folders,
+                    folder_id,
+                    mark=value
+                )
 
     def get_slide_links(self, slide_id, user_id):
-        links = self.findall(SlideLinks, SlideLinks.slide_id == slide_id)
-        res = []
-        for link in links:
-            tag = self.find(Tags, Tags.id == link.tag_id, Tags.owner_id == user_id)
-            res.append({
-                'link_id': link.id,
-                'slide_id': link.slide_id,
-                'tag_id': tag.id,
-                'tag_name': tag.name,
-                'value': link.value
-            })
-        return res
+        with self.unit_of_work():
+            links = self.findall(SlideLinks, SlideLinks.slide_id == slide_id)
+            res = []
+            for link in links:
+                tag = self.find(Tags, Tags.id == link.tag_id, Tags.owner_id == user_id)
+                res.append({
+                    'link_id': link.id,
+                    'slide_id': link.slide_id,
+                    'tag_id': tag.id,
+                    'tag_name': tag.name,
+                    'value': link.value
+                })
+            return res
 
     def create_slide_link(self, slide_id, tag_name, value, user_id):
-        tag_created, tag = self.find_or_create(
-            Tags,
-            Tags.owner_id == user_id, Tags.name == tag_name,
-            name=tag_name,
-            owner_id=user_id
-        )
+        with self.unit_of_work():
+            tag_created, tag = self.find_or_create(
+                Tags,
+                Tags.owner_id == user_id, Tags.name == tag_name,
+                name=tag_name,
+                owner_id=user_id
+            )
 
-        link_created, link = self.find_or_create(
-            SlideLinks,
-            SlideLinks.slide_id == slide_id, SlideLinks.tag_id == tag.id,
-            slide_id=slide_id,
-            tag_id=tag.id,
-            value=value
-        )
+            link_created, link = self.find_or_create(
+                SlideLinks,
+                SlideLinks.slide_id == slide_id, SlideLinks.tag_id == tag.id,
+                slide_id=slide_id,
+                tag_id=tag.id,
+                value=value
+            )
 
-        if not link_created:
-            self.update(SlideLinks, link.id, value=value)
+            if not link_created:
+                self.update(SlideLinks, link.id, value=value)
 
     def remove_slide_link(self, slide_id, tag_name, user_id):
-        tag = self.find(Tags, Tags.owner_id == user_id, Tags.name == tag_name)
-        link = self.find(SlideLinks, SlideLinks.slide_id == slide_id, SlideLinks.tag_id == tag.id)
-        if tag and link:
-            self.delete(SlideLinks, link.id)
-        slide_links_with_tag = self.findall(SlideLinks, SlideLinks.tag_id == tag.id)
-        pres_links_with_tag = self.findall(PresentationLinks, PresentationLinks.tag_id == tag.id)
-        if len(slide_links_with_tag) == len(pres_links_with_tag) == 0:
-            self.delete(Tags, tag.id)
+        with self.unit_of_work():
+            tag = self.find(Tags, Tags.owner_id == user_id, Tags.name == tag_name)
+            link = self.find(SlideLinks, SlideLinks.slide_id == slide_id, SlideLinks.tag_id == tag.id)
+            if tag and link:
+                self.delete(SlideLinks, link.id)
+            slide_links_with_tag = self.findall(SlideLinks, SlideLinks.tag_id == tag.id)
+            pres_links_with_tag = self.findall(PresentationLinks, PresentationLinks.tag_id == tag.id)
+            if len(slide_links_with_tag) == len(pres_links_with_tag) == 0:
+                self.delete(Tags, tag.id)
 
     def get_presentation_links(self, presentation_id, user_id):
-        links = self.findall(PresentationLinks, PresentationLinks.pres_id == presentation_id)
-        res = []
-        for link in links:
-            tag = self.find(Tags, Tags.id == link.tag_id, Tags.owner_id == user_id)
-            res.append({
-                'link_id': link.id,
-                'presentation_id': link.pres_id,
-                'tag_id': tag.id,
-                'tag_name': tag.name,
-                'value': link.value
-            })
-        return res
+        with self.unit_of_work():
+            links = self.findall(PresentationLinks, PresentationLinks.pres_id == presentation_id)
+            res = []
+            for link in links:
+                tag = self.find(Tags, Tags.id == link.tag_id, Tags.owner_id == user_id)
+                res.append({
+                    'link_id': link.id,
+                    'presentation_id': link.pres_id,
+                    'tag_id': tag.id,
+                    'tag_name': tag.name,
+                    'value': link.value
+                })
+            return res
 
     def create_presentation_link(self, presentation_id, tag_name, value, user_id):
-        tag_created, tag = self.find_or_create(
-            Tags,
-            Tags.owner_id == user_id, Tags.name == tag_name,
-            name=tag_name,
-            owner_id=user_id
-        )
+        with self.unit_of_work():
+            tag_created, tag = self.find_or_create(
+                Tags,
+                Tags.owner_id == user_id, Tags.name == tag_name,
+                name=tag_name,
+                owner_id=user_id
+            )
 
-        link_created, link = self.find_or_create(
-            PresentationLinks,
-            PresentationLinks.pres_id == presentation_id, PresentationLinks.tag_id == tag.id,
-            pres_id=presentation_id,
-            tag_id=tag.id,
-            value=value
-        )
+            link_created, link = self.find_or_create(
+                PresentationLinks,
+                PresentationLinks.pres_id == presentation_id, PresentationLinks.tag_id == tag.id,
+                pres_id=presentation_id,
+                tag_id=tag.id,
+                value=value
+            )
 
-        if not link_created:
-            self.update(PresentationLinks, link.id, value=value)
+            if not link_created:
+                self.update(PresentationLinks, link.id, value=value)
 
     def remove_presentation_link(self, presentation_id, tag_name, user_id):
-        tag = self.find(Tags, Tags.owner_id == user_id, Tags.name == tag_name)
-        link = self.find(PresentationLinks,
-                         PresentationLinks.pres_id == presentation_id,
-                         PresentationLinks.tag_id == tag.id)
-        if tag and link:
-            self.delete(PresentationLinks, link.id)
-        slide_links_with_tag = self.findall(SlideLinks, SlideLinks.tag_id == tag.id)
-        pres_links_with_tag = self.findall(PresentationLinks, PresentationLinks.tag_id == tag.id)
-        if len(slide_links_with_tag) == len(pres_links_with_tag) == 0:
-            self.delete(Tags, tag.id)
-
-    def get_presentations_by_tag_query(self, query, user_id):
-        tag_names = re.findall('[a-z]+[a-z0-9]*', query)
-        tag_names = [tag.strip() for tag in tag_names if tag.strip() not in ['and', 'or', 'not']]
-
-        links_and_tags = self.get_links_and_tags(PresentationLinks, user_id, tag_names)
-
-        pres_tags_values = {}
-        for link, tag in links_and_tags:
-            if pres_tags_values.get(link.pres_id) is None:
-                pres_tags_values[link.pres_id] = {key: False for key in tag_names}
-
-            if link.value is not None:
-                pres_tags_values[link.pres_id][tag.name] = link.value
-            else:
-                pres_tags_values[link.pres_id][tag.name] = True
+        with self.unit_of_work():
+            tag = self.find(Tags, Tags.owner_id == user_id, Tags.name == tag_name)
+            link = self.find(PresentationLinks,
+                             PresentationLinks.pres_id == presentation_id,
+                             PresentationLinks.tag_id == tag.id)
+            if tag and link:
+                self.delete(PresentationLinks, link.id)
+            slide_links_with_tag = self.findall(SlideLinks, SlideLinks.tag_id == tag.id)
+            pres_links_with_tag = self.findall(PresentationLinks, PresentationLinks.tag_id == tag.id)
+            if len(slide_links_with_tag) == len(pres_links_with_tag) == 0:
+                self.delete(Tags, tag.id)
+
+    @staticmethod
+    def __select_by_tag_query(table, item_column, query, user_id):
+        """Returns select of ids of items matching the query, or None if the query is invalid.
+
+        Links of the queried tags are grouped by item, so every tag becomes a column
+        of its link value and the query is evaluated by the database in HAVING.
+        """
+        try:
+            tag_query = TagQuery(query)
+        except AttributeError:
+            return None
 
-        filtered_pres = []
+        item_id = getattr(table, item_column)
+        columns = {
+            tag_name: func.coalesce(
+                func.max(case((Tags.name == tag_name, func.coalesce(table.value, 1)))), 0
+            )
+            for tag_name in tag_query.tag_names
+        }
+        return select(item_id) \
+            .join(Tags, table.tag_id == Tags.id) \
+            .where(Tags.owner_id == user_id, Tags.name.in_(tag_query.tag_names)) \
+            .group_by(item_id) \
+            .having(tag_query.to_sql(columns))
 
-        for pres_id in pres_tags_values.keys():
-            eval_query = query
-            for tag in pres_tags_values[pres_id].keys():
-                eval_query = re.sub(rf"(^{tag}\s+)|( +{tag}\s+)|(\s+{tag}$)|({tag})",
-                                    f" {str(pres_tags_values[pres_id][tag])} ", eval_query)
-            try:
-                if eval(eval_query):
-                    filtered_pres.append(pres_id)
-            except:
-                filtered_pres = []
+    def get_presentations_by_tag_query(self, query, user_id):
+        filtered_pres = self.__select_by_tag_query(PresentationLinks, 'pres_id', query, user_id)
+        if filtered_pres is None:
+            return []
 
         found_presentations = self.findall(Presentations, Presentations.id.in_(filtered_pres))
 
         return [pres.json() for pres in found_presentations]
 
-    def get_slides_by_tag_query(self, query, user_id):
-        tag_names = re.findall('[a-z]+[a-z0-9]*', query)
-        tag_names = [tag.strip() for tag in tag_names if tag.strip() not in ['and', 'or', 'not']]
-
-        links_and_tags = self.get_links_and_tags(SlideLinks, user_id, tag_names)
-
-        slide_tags_values = {}
-        for link, tag in links_and_tags:
-            if slide_tags_values.get(link.slide_id) is None:
-                slide_tags_values[link.slide_id] = {key: False for key in tag_names}
-
-            if link.value is not None:
-                slide_tags_values[link.slide_id][tag.name] = link.value
-            else:
-                slide_tags_values[link.slide_id][tag.name] = True
+    def get_slide_ids_by_tag_query(self, query, user_id):
+        filtered_slides = self.__select_by_tag_query(SlideLinks, 'slide_id', query, user_id)
+        if filtered_slides is None:
+            return []
 
-        filtered_slides = []
+        with self.unit_of_work() as session:
+            return session.execute(filtered_slides).scalars().all()
 
-        for slide_id in slide_tags_values.keys():
-            eval_query = query
-            for tag in slide_tags_values[slide_id].keys():
-                eval_query = re.sub(rf"(^{tag}\s+)|( +{tag}\s+)|(\s+{tag}$)|({tag})",
-                                    f" {str(slide_tags_values[slide_id][tag])} ", eval_query)
-            try:
-                if eval(eval_query):
-                    filtered_slides.append(slide_id)
-            except:
-                filtered_slides = []
-
-        found_slides = self.findall(Slides, Slides.id.in_(filtered_slides))
+    def get_slides_by_tag_query(self, query, user_id):
+        filtered_slides = self.__select_by_tag_query(SlideLinks, 'slide_id', query, user_id)
+        if filtered_slides is None:
+            return []
 
-        return found_slides
+        return self.findall(Slides, Slides.id.in_(filtered_slides))
 
     def get_user_tags_list(self, user_id):
-        tags = self.findall(Tags, Tags.owner_id == user_id)
-        presentations_tags = []
-        slides_tags = []
-        for tag in tags:
-            presentation_link = self.find(PresentationLinks, PresentationLinks.tag_id == tag.id)
-            if presentation_link is not None:
-                presentations_tags.append(tag.json())
-
-            slide_link = self.find(SlideLinks, SlideLinks.tag_id == tag.id)
-            if slide_link is not None:
-                slides_tags.append(tag.json())
-
-        return presentations_tags, slides_tags
+        with self.unit_of_work():
+            tags = self.findall(Tags, Tags.owner_id == user_id)
+            presentations_tags = []
+            slides_tags = []
+            for tag in tags:
+                presentation_link = self.find(PresentationLinks, PresentationLinks.tag_id == tag.id)
+                if presentation_link is not None:
+                    presentations_tags.append(tag.json())
+
+                slide_link = self.find(SlideLinks, SlideLinks.tag_id == tag.id)
+                if slide_link is not None:
+                    slides_tags.append(tag.json())
+
+            return presentations_tags, slides_tags
+
+    @staticmethod
+    def __get_search_ratio(ratio):
+        if ratio == 'widescreen_16_to_9':
+            return Slides.Ratio.WIDESCREEN_16_TO_9
+        elif ratio == 'standard_4_to_3':
+            return Slides.Ratio.STANDARD_4_TO_3
+        else:
+            raise AttributeError('Unknown slide ratio')
 
-    def get_slides_by_filters(self, presentations, tag_query, text_phrase, ratio, user_id):
+    def __is_text_search_indexed(self, session):
+        if self.text_search_indexed is None:
+            self.text_search_indexed = self.engine.dialect.name == 'postgresql' and \
+                text_search.trigram_extension_exists(session)
+        return self.text_search_indexed
 
+    def get_slides_by_filters(self, presentations, tag_query, text_phrase, ratio, user_id, offset=0, limit=None):
         presentation_ids = [pres.id for pres in presentations]
-        slides = self.findall(Slides, Slides.pres_id.in_(presentation_ids))
-
-        # Filter by tag query
-        if tag_query != '':
-            filtered_by_tag = self.get_slides_by_tag_query(tag_query, user_id)
-            filtered_ids = [slide.id for slide in filtered_by_tag]
-            slides = [slide for slide in slides if slide.id in filtered_ids]
+        if len(presentation_ids) == 0:
+            return []
 
-        # Filter by text
-        if text_phrase != '':
-            slides = [slide for slide in slides if text_phrase.lower() in slide.text.lower()]
+        criterion = [Slides.pres_id.in_(presentation_ids)]
 
         # Filter by ratio
         if ratio != 'auto':
-            if ratio == 'widescreen_16_to_9':
-                search_ratio = Slides.Ratio.WIDESCREEN_16_TO_9
-            elif ratio == 'standard_4_to_3':
-                search_ratio = Slides.Ratio.STANDARD_4_TO_3
-            else:
-                raise AttributeError('Unknown slide ratio')
-            slides = [slide for slide in slides if slide.ratio == search_ratio]
+            criterion.append(Slides.ratio == self.__get_search_ratio(ratio))
+
+        order = [Slides.pres_id, Slides.id]
+
+        with self.unit_of_work() as session:
+            # Filter by tag query, evaluated by the database as a subquery
+            if tag_query != '':
+                filtered_slides = self.__select_by_tag_query(SlideLinks, 'slide_id', tag_query, user_id)
+                if filtered_slides is None:
+                    return []
+                criterion.append(Slides.id.in_(filtered_slides))
+
+            # Filter by text, matched slides are ranked by relevance
+            if text_phrase != '':
+                if self.__is_text_search_indexed(session):
+                    criterion.append(text_search.search_condition(Slides.text, text_phrase))
+                    order = [text_search.search_rank(Slides.text, text_phrase).desc()] + order
+                else:
+                    # Without pg_trgm slides are only matched by substring
+                    criterion.append(text_search.substring_condition(Slides.text, text_phrase))
+
+            # Labels are taken from the joined presentations, result is ordered and paged by the database
+            query = session.query(Slides, Presentations.name) \
+                .join(Presentations, Presentations.id == Slides.pres_id) \
+                .filter(*criterion) \
+                .order_by(*order) \
+                .offset(offset)
+            if limit is not None:
+                query = query.limit(limit)
+            rows = query.all()
 
         res_slides = []
 
-        for slide in slides:
+        for slide, pres_name in rows:
             res_slide = slide.json()
+            res_slide['highlights'] = text_search.find_highlights(slide.text, text_phrase) if text_phrase != '' else []
 
             # Adding label
-            presentation = self.find(Presentations, Presentations.id == slide.pres_id)
-            label = f"{presentation.name} {slide.index + 1}"
-            res_slide['label'] = label
+            res_slide['label'] = f"{pres_name} {slide.index + 1}"
 
             # Converting ratio
             if slide.ratio == Slides.Ratio.WIDESCREEN_16_TO_9:
@@ -640,53 +1015,164 @@ class DatabaseHandler:
 
             res_slides.append(res_slide)
 
-        return sorted(res_slides, key=lambda slide: (slide.get('pres_id'), slide.get('id')))
+        return res_slides
+
+    def pres_sync_uploaded(self, pres, pres_text, pres_thumbs, ratio, slides_from, user_id, batch_size=100):
+        slide_ratio = Slides.Ratio.WIDESCREEN_16_TO_9 if ratio == 'widescreen_16_to_9' else Slides.Ratio.STANDARD_4_TO_3
+        slides = [
+            self.__store_thumbnail({
+                'pres_id': pres.get('id'),
+                'index': i,
+                'thumbnail': thumb,
+                'text': text,
+                'ratio': slide_ratio
+            })
+            for i, (text, thumb) in enumerate(zip(pres_text, pres_thumbs))
+        ]
+
+        # Presentation, its slides and their tags are stored in a single transaction
+        with self.unit_of_work() as session:
+            if session.get(Presentations, pres.get('id')) is None:
+                session.add(Presentations(
+                    id=pres.get('id'),
+                    name=pres.get('name'),
+                    owner_id=user_id,
+                    modified_time=pres.get('modifiedTime')
+                ))
+                session.flush()
+
+            slide_ids = self.__insert_slides(session, slides, batch_size)
+
+            # Created slides have no links yet, so source links are copied without lookups.
+            # The same source slide can be used several times in a built presentation
+            migrated_ids = {}
+            for slide_from, slide_id in zip(slides_from, slide_ids):
+                migrated_ids.setdefault(slide_from.id, []).append(slide_id)
+            if len(migrated_ids) > 0:
+                source_links = session.query(SlideLinks) \
+                    .filter(SlideLinks.slide_id.in_(list(migrated_ids))) \
+                    .all()
+                links = [
+                    {'slide_id': slide_id, 'tag_id': link.tag_id, 'value': link.value}
+                    for link in source_links
+                    for slide_id in migrated_ids[link.slide_id]
+                ]
+                if len(links) > 0:
+                    session.execute(insert(SlideLinks), links)
 
-    def pres_sync_uploaded(self, pres, pres_text, pres_thumbs, ratio, slides_from, user_id):
+    def migrate_tags(self, slide_from, slide_to):
+        with self.unit_of_work():
+            slide_from_links = self.findall(SlideLinks, SlideLinks.slide_id == slide_from.id)
+            for link in slide_from_links:
+                self.find_or_create(
+                    SlideLinks,
+                    SlideLinks.slide_id == slide_to.id, SlideLinks.tag_id == link.tag_id,
+                    slide_id=slide_to.id,
+                    tag_id=link.tag_id,
+                    value=link.value
+                )
 
-        self.create(
-            Presentations,
-            id=pres.get('id'),
-            name=pres.get('name'),
+    # SYNC JOBS
+    def create_sync_job(self, user_id):
+        _, job = self.create(
+            SyncJobs,
             owner_id=user_id,
-            modified_time=pres.get('modifiedTime'),
+            state=SyncJobs.State.QUEUED,
+            created_time=datetime.utcnow()
+        )
+        return job
+
+    def get_active_sync_job(self, user_id):
+        return self.find(
+            SyncJobs,
+            SyncJobs.owner_id == user_id,
+            SyncJobs.state.in_([SyncJobs.State.QUEUED, SyncJobs.State.RUNNING])
         )
 
-        for i, (text, thumb) in enumerate(zip(pres_text, pres_thumbs)):
-            _, slide = self.create(
-                Slides,
-                pres_id=pres.get('id'),
-                index=i,
-                thumbnail=thumb,
-                text=text,
-                ratio=Slides.Ratio.WIDESCREEN_16_TO_9 if ratio == 'widescreen_16_to_9' else Slides.Ratio.STANDARD_4_TO_3
+    def set_sync_job_state(self, job_id, state, error=None):
+        finished_time = datetime.utcnow() if state in (SyncJobs.State.DONE, SyncJobs.State.FAILED) else None
+        with self.unit_of_work() as session:
+            session.execute(
+                update(SyncJobs)
+                .where(SyncJobs.id == job_id)
+                .values(state=state, error=error, finished_time=finished_time)
             )
-            self.migrate_tags(slides_from[i], slide)
+            if state == SyncJobs.State.FAILED:
+                session.execute(
+                    update(SyncJobItems)
+                    .where(SyncJobItems.job_id == job_id,
+                           SyncJobItems.state.not_in([SyncJobItems.State.DONE, SyncJobItems.State.FAILED]))
+                    .values(state=SyncJobItems.State.FAILED, error=error)
+                )
 
-    def migrate_tags(self, slide_from, slide_to):
-        slide_from_links = self.findall(SlideLinks, SlideLinks.slide_id == slide_from.id)
-        for link in slide_from_links:
-            self.find_or_create(
-                SlideLinks,
-                SlideLinks.slide_id == slide_to.id, SlideLinks.tag_id == link.tag_id,
-                slide_id=slide_to.id,
-                tag_id=link.tag_id,
-                value=link.value
+    def fail_unfinished_sync_jobs(self, error):
+        with self.unit_of_work() as session:
+            job_ids = session.scalars(
+                select(SyncJobs.id).where(SyncJobs.state.in_([SyncJobs.State.QUEUED, SyncJobs.State.RUNNING]))
+            ).all()
+            for job_id in job_ids:
+                self.set_sync_job_state(job_id, SyncJobs.State.FAILED, error)
+
+    def delete_finished_sync_jobs(self, finished_before):
+        """Deletes jobs finished before given time with their items, the last job of every user is kept."""
+        with self.unit_of_work() as session:
+            last_job_ids = select(func.max(SyncJobs.id)).group_by(SyncJobs.owner_id)
+            job_ids = session.scalars(
+                select(SyncJobs.id).where(SyncJobs.finished_time < finished_before, SyncJobs.id.not_in(last_job_ids))
+            ).all()
+            if len(job_ids) > 0:
+                session.query(SyncJobItems) \
+                    .filter(SyncJobItems.job_id.in_(job_ids)) \
+                    .delete(synchronize_session=False)
+                session.query(SyncJobs) \
+                    .filter(SyncJobs.id.in_(job_ids)) \
+                    .delete(synchronize_session=False)
+
+    def add_sync_job_items(self, job_id, presentations, presentations_delta):
+        created, modified = presentations_delta
+        created_ids = {pres.get('id') for pres in created}
+        modified_ids = {pres.get('id') for pres in modified}
+
+        with self.unit_of_work() as session:
+            for pres in presentations:
+                if pres.get('id') in created_ids:
+                    delta, state = SyncJobItems.Delta.CREATED, SyncJobItems.State.QUEUED
+                elif pres.get('id') in modified_ids:
+                    delta, state = SyncJobItems.Delta.MODIFIED, SyncJobItems.State.QUEUED
+                else:
+                    delta, state = SyncJobItems.Delta.SYNCED, SyncJobItems.State.DONE
+                session.add(SyncJobItems(job_id=job_id, pres_id=pres.get('id'), name=pres.get('name'),
+                                         delta=delta, state=state))
+
+    def set_sync_job_item_state(self, job_id, pres_id, state, error=None):
+        with self.unit_of_work() as session:
+            session.execute(
+                update(SyncJobItems)
+                .where(SyncJobItems.job_id == job_id, SyncJobItems.pres_id == pres_id)
+                .values(state=state, error=error)
             )
 
-    def set_sync_query(self, user_id, delta, synced):
-        self.sync_query[user_id] = {
-            'created': delta[0],
-            'modified': delta[1],
-            'synced': synced
+    def get_sync_status(self, user_id):
+        with self.unit_of_work() as session:
+            # Running job is shown while its follow-up job waits
+            job = session.query(SyncJobs) \
+                .filter(SyncJobs.owner_id == user_id) \
+                .order_by((SyncJobs.state == SyncJobs.State.RUNNING).desc(), SyncJobs.id.desc()) \
+                .first()
+            items = []
+            if job is not None:
+                items = session.query(SyncJobItems) \
+                    .filter(SyncJobItems.job_id == job.id) \
+                    .order_by(SyncJobItems.id) \
+                    .all()
+
+        in_progress = [item for item in items if item.state not in (SyncJobItems.State.DONE, SyncJobItems.State.FAILED)]
+        return {
+            'job': job.json() if job is not None else None,
+            'active': job is not None and job.state in (SyncJobs.State.QUEUED, SyncJobs.State.RUNNING),
+            'presentations': [item.json() for item in items],
+            # Presentations which are still being synced, grouped as expected by the client
+            'created': [item.json() for item in in_progress if item.delta == SyncJobItems.Delta.CREATED],
+            'modified': [item.json() for item in in_progress if item.delta == SyncJobItems.Delta.MODIFIED],
+            'synced': [item.json() for item in items]
         }
-
-    def get_sync_query(self, user_id):
-        if user_id in self.sync_query:
-            return self.sync_query[user_id]
-        else:
-            return {
-                'created': [],
-                'modified': [],
-                'synced': []
-            }
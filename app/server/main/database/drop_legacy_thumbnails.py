@@ -0,0 +1,28 @@
+"""Drops thumbnail bytes kept in slides.thumbnail by databases created before ThumbnailStore.
+
+Server startup copies them to the store and keeps the column. Once the store is
+verified, e.g. backed up, run from the repository root:
+    python -m app.server.main.database.drop_legacy_thumbnails
+"""
+from multiprocessing.pool import ThreadPool
+
+from app.definitions import db_user, db_password, db_url, db_name, thumbnails_path
+from app.server.main.database.database_handler import DatabaseHandler
+from app.server.main.utils.thumbnail_store import ThumbnailStore
+
+
+def main():
+    pool = ThreadPool(processes=1)
+    db_handler = DatabaseHandler(user=db_user, password=db_password, host=db_url, db=db_name, pool=pool, echo=False,
+                                 thumbnail_store=ThumbnailStore(thumbnails_path))
+    try:
+        if db_handler.drop_legacy_thumbnails():
+            print('slides.thumbnail is dropped')
+        else:
+            print('slides.thumbnail does not exist')
+    finally:
+        pool.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""Tag query language used to filter slides and presentations by their tags.
+
+    query      := or_expr
+    or_expr    := and_expr ('or' and_expr)*
+    and_expr   := not_expr ('and' not_expr)*
+    not_expr   := 'not' not_expr | comparison
+    comparison := sum (('==' | '!=' | '<' | '<=' | '>' | '>=') sum)*
+    sum        := term (('+' | '-') term)*
+    term       := unary ('*' unary)*
+    unary      := '-' unary | primary
+    primary    := NUMBER | TAG | '(' or_expr ')'
+
+A tag evaluates to its link value, to 1 (true) if the link has no value and
+to 0 (false) if the item is not linked to the tag. Operators follow Python
+semantics, e.g. chained comparisons and 'or' returning its first true operand.
+Queries are compiled once and translated into an SQL expression evaluated by the database.
+"""
+import operator
+import re
+
+from sqlalchemy import and_, case, literal
+
+KEYWORDS = ('and', 'or', 'not')
+
+TOKEN_PATTERN = re.compile(r'''
+    \s*(?:
+        (?P<number>\d+(?:\.\d+)?)
+      | (?P<name>[^\W\d]\w*)
+      | (?P<operator>==|!=|<=|>=|<|>|\+|-|\*|\(|\))
+    )''', re.VERBOSE)
+
+
+class Tag:
+    def __init__(self, name):
+        self.name = name
+
+
+class Number:
+    def __init__(self, value):
+        self.value = value
+
+
+class Not:
+    def __init__(self, operand):
+        self.operand = operand
+
+
+class BoolOp:
+    def __init__(self, op, operands):
+        self.op = op
+        self.operands = operands
+
+
+class Compare:
+    def __init__(self, left, ops, comparators):
+        self.left = left
+        self.ops = ops
+        self.comparators = comparators
+
+
+class BinOp:
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+
+class Neg:
+    def __init__(self, operand):
+        self.operand = operand
+
+
+def tokenize(query):
+    tokens = []
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = TOKEN_PATTERN.match(query, position)
+        if match is None:
+            raise AttributeError(f"Unexpected symbol '{query[position:].strip()[0]}' in tag query")
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'name' and value in KEYWORDS:
+            kind = 'keyword'
+        tokens.append((kind, value))
+    return tokens
+
+
+class Parser:
+    COMPARISON_OPS = ('==', '!=', '<', '<=', '>', '>=')
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def accept(self, *values):
+        kind, value = self.peek()
+        if kind in ('keyword', 'operator') and value in values:
+            self.position += 1
+            return value
+        return None
+
+    def expect(self, value):
+        if self.accept(value) is None:
+            raise AttributeError(f"Expected '{value}' in tag query")
+
+    def parse(self):
+        if len(self.tokens) == 0:
+            raise AttributeError("Tag query is empty")
+        node = self.parse_or()
+        if self.position != len(self.tokens):
+            raise AttributeError(f"Unexpected '{self.peek()[1]}' in tag query")
+        return node
+
+    def parse_or(self):
+        operands = [self.parse_and()]
+        while self.accept('or'):
+            operands.append(self.parse_and())
+        return operands[0] if len(operands) == 1 else BoolOp('or', operands)
+
+    def parse_and(self):
+        operands = [self.parse_not()]
+        while self.accept('and'):
+            operands.append(self.parse_not())
+        return operands[0] if len(operands) == 1 else BoolOp('and', operands)
+
+    def parse_not(self):
+        if self.accept('not'):
+            return Not(self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        left = self.parse_sum()
+        ops = []
+        comparators = []
+        while True:
+            op = self.accept(*self.COMPARISON_OPS)
+            if op is None:
+                break
+            ops.append(op)
+            comparators.append(self.parse_sum())
+        return left if len(ops) == 0 else Compare(left, ops, comparators)
+
+    def parse_sum(self):
+        node = self.parse_term()
+        while True:
+            op = self.accept('+', '-')
+            if op is None:
+                return node
+            node = BinOp(op, node, self.parse_term())
+
+    def parse_term(self):
+        node = self.parse_unary()
+        while self.accept('*'):
+            node = BinOp('*', node, self.parse_unary())
+        return node
+
+    def parse_unary(self):
+        if self.accept('-'):
+            return Neg(self.parse_unary())
+        return self.parse_primary()
+
+    def parse_primary(self):
+        if self.accept('('):
+            node = self.parse_or()
+            self.expect(')')
+            return node
+
+        kind, value = self.peek()
+        if kind == 'number':
+            self.position += 1
+            return Number(float(value))
+        if kind == 'name':
+            self.position += 1
+            return Tag(value)
+        raise AttributeError(f"Unexpected {'end' if value is None else repr(value)} in tag query")
+
+
+SQL_COMPARISONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge
+}
+
+SQL_ARITHMETIC = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul
+}
+
+
+class TagQuery:
+    """Tag query compiled into an AST, raises AttributeError if the query is invalid."""
+
+    def __init__(self, query):
+        self.root = Parser(tokenize(query)).parse()
+        self.tag_names = sorted(self.__collect_tags(self.root))
+
+    @classmethod
+    def __collect_tags(cls, node):
+        if isinstance(node, Tag):
+            return {node.name}
+        children = []
+        if isinstance(node, (Not, Neg)):
+            children = [node.operand]
+        elif isinstance(node, BoolOp):
+            children = node.operands
+        elif isinstance(node, Compare):
+            children = [node.left] + node.comparators
+        elif isinstance(node, BinOp):
+            children = [node.left, node.right]
+        names = set()
+        for child in children:
+            names |= cls.__collect_tags(child)
+        return names
+
+    def to_sql(self, columns):
+        """Translates query into SQL condition over expressions of tag values, missing tags are 0."""
+        return self.__to_sql(self.root, columns) != 0
+
+    def __to_sql(self, node, columns):
+        if isinstance(node, Number):
+            return literal(node.value)
+        if isinstance(node, Tag):
+            return columns.get(node.name, literal(0))
+        if isinstance(node, Not):
+            return case((self.__to_sql(node.operand, columns) == 0, 1), else_=0)
+        if isinstance(node, Neg):
+            return -self.__to_sql(node.operand, columns)
+        if isinstance(node, BinOp):
+            return SQL_ARITHMETIC[node.op](
+                self.__to_sql(node.left, columns),
+                self.__to_sql(node.right, columns)
+            )
+        if isinstance(node, Compare):
+            conditions = []
+            left = self.__to_sql(node.left, columns)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self.__to_sql(comparator, columns)
+                conditions.append(SQL_COMPARISONS[op](left, right))
+                left = right
+            return case((and_(*conditions), 1), else_=0)
+        if isinstance(node, BoolOp):
+            result = self.__to_sql(node.operands[-1], columns)
+            for operand in reversed(node.operands[:-1]):
+                value = self.__to_sql(operand, columns)
+                if node.op == 'or':
+                    result = case((value != 0, value), else_=result)
+                else:
+                    result = case((value == 0, value), else_=result)
+            return result
+        raise AttributeError("Unknown tag query node")
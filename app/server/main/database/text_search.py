@@ -0,0 +1,85 @@
+import re
+from sqlalchemy import func, literal_column, or_, text
+
+# Slides are written in Russian and English, words are stemmed with both configurations
+SEARCH_CONFIGS = ('russian', 'english')
+
+WORD_PATTERN = re.compile(r'\w+')
+
+# Share of common trigrams for a text word to be highlighted as a match of a phrase word
+WORD_SIMILARITY = 0.5
+
+
+def create_search_indexes(connection):
+    """Creates PostgreSQL trigram and full-text indexes on slides text."""
+    connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    connection.execute(text(
+        'CREATE INDEX IF NOT EXISTS slides_text_trgm_idx ON slides USING gin (text gin_trgm_ops)'
+    ))
+    vector = ' || '.join(f"to_tsvector('{config}'::regconfig, text)" for config in SEARCH_CONFIGS)
+    connection.execute(text(
+        f'CREATE INDEX IF NOT EXISTS slides_text_tsv_idx ON slides USING gin (({vector}))'
+    ))
+
+
+def trigram_extension_exists(connection):
+    return connection.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")).first() is not None
+
+
+def escape_like(phrase):
+    return phrase.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_vector(column):
+    # Must match the expression of slides_text_tsv_idx to be served by the index
+    vectors = [func.to_tsvector(literal_column(f"'{config}'::regconfig"), column) for config in SEARCH_CONFIGS]
+    vector = vectors[0]
+    for other in vectors[1:]:
+        vector = vector.op('||')(other)
+    return vector
+
+
+def search_query(phrase):
+    queries = [func.websearch_to_tsquery(literal_column(f"'{config}'::regconfig"), phrase) for config in SEARCH_CONFIGS]
+    query = queries[0]
+    for other in queries[1:]:
+        query = query.op('||')(other)
+    return query
+
+
+def substring_condition(column, phrase):
+    return column.ilike(f'%{escape_like(phrase)}%', escape='\\')
+
+
+def search_condition(column, phrase):
+    """Substring match served by the trigram index or a stemmed match of the phrase words."""
+    return or_(
+        substring_condition(column, phrase),
+        search_vector(column).op('@@')(search_query(phrase))
+    )
+
+
+def search_rank(column, phrase):
+    return func.ts_rank(search_vector(column), search_query(phrase)) + func.word_similarity(phrase, column)
+
+
+def word_trigrams(word):
+    # Words are padded as pg_trgm does, so their beginnings weigh more than endings
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def find_highlights(text_value, phrase):
+    """Returns [start, end) character offsets of phrase occurrences, or of words similar to its words if there are none."""
+    # Offsets are found in the original text, lowering may change its length
+    phrase = phrase.strip()
+    highlights = [[match.start(), match.end()]
+                  for match in re.finditer(re.escape(phrase), text_value, re.IGNORECASE)] if phrase else []
+    if len(highlights) == 0:
+        # Stemmed matches differ in endings, words sharing most of their trigrams with a phrase word are highlighted
+        phrase_trigrams = [word_trigrams(word) for word in set(WORD_PATTERN.findall(phrase.lower()))]
+        for match in WORD_PATTERN.finditer(text_value):
+            trigrams = word_trigrams(match.group().lower())
+            if any(len(trigrams & other) / len(trigrams | other) >= WORD_SIMILARITY for other in phrase_trigrams):
+                highlights.append([match.start(), match.end()])
+    return highlights
@@ -1,77 +1,343 @@
-import io
+import json
 import os
+import uuid
+from multiprocessing.pool import ThreadPool
+from threading import Lock, local
 
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
 
 from app.definitions import SERVER_ROOT
+from app.server.main.utils.workspace import Workspace
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+PRESENTATION_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.presentationml.presentation'
 
 
 class GoogleDriveHandler:
 
-    def __init__(self, pool):
+    def __init__(self, pool, state_path=None, build_drive_service=None, cache=None,
+                 max_concurrent_downloads=4, download_chunk_size=4 * 1024 * 1024):
         self.pool = pool
+        self.cache = cache
+        self.state_path = state_path or os.path.join(SERVER_ROOT, 'external_services/google/drive_state')
+        self.build_drive_service = build_drive_service or self.__build_drive_service
+        self.lock_mutex = Lock()
+        self.user_locks = {}
+
+        # Downloads wait for their own pool, so they never hold threads of the shared request pool
+        self.download_pool = ThreadPool(processes=max_concurrent_downloads)
+        self.download_chunk_size = download_chunk_size
+        self.download_progress = {}
+        self.drive_services = {}
+        self.thread_local = local()
+
+    @staticmethod
+    def __build_drive_service(user_flow):
+        return build('drive', 'v3', credentials=user_flow.credentials)
 
-    def get_user_file_tree(self, user_flow):
-        drive_service = build('drive', 'v3', credentials=user_flow.credentials)
+    def get_user_file_tree(self, user_flow, user_id=None):
+        drive_service = self.build_drive_service(user_flow)
+
+        # Without user id there is nowhere to persist the change token,
+        # so the whole drive is listed from scratch
+        if user_id is None:
+            return self.__build_file_tree(self.__list_drive(drive_service))
+
+        user_lock = self.__get_user_lock(user_id)
+        user_lock.acquire()
+        try:
+            state = self.__load_state(user_id)
+            if state is None:
+                state = self.__list_drive(drive_service)
+            else:
+                try:
+                    self.__apply_changes(drive_service, state)
+                except HttpError:
+                    # Expired or invalid page token - state is rebuilt from scratch
+                    state = self.__list_drive(drive_service)
+            self.__save_state(user_id, state)
+        finally:
+            user_lock.release()
+
+        return self.__build_file_tree(state)
+
+    def __list_drive(self, drive_service):
+        # Token is requested before listing, so changes made during
+        # the listing are replayed on the next call
+        start_page_token = drive_service.changes().getStartPageToken().execute().get('startPageToken')
 
         drive = drive_service.files().get(fileId='root', fields='id, name').execute()
-        folders = [drive]
-
-        presentations = drive_service.files().list(
-            q=f"mimeType='application/vnd.openxmlformats-officedocument.presentationml.presentation' " \
-              "and trashed = false",
-            fields='files(id, name, modifiedTime, parents)').execute().get('files')
-
-        def traverse(node):
-            children = drive_service.files().list(
-                q=f"mimeType='application/vnd.google-apps.folder' and not trashed and '{node.get('id')}' in parents",
-                fields='files(id, name)').execute().get('files')
-            for child in children:
-                traverse(child)
-                folders.append(child)
-            for pres in presentations:
-                if pres.get('parents')[0] == node.get('id'):
-                    children.append(pres)
-                    pres['type'] = 'presentation'
-            node['children'] = children
+
+        # Folders and presentations are fetched with a few paginated bulk queries
+        # instead of one query per folder, the tree is assembled from parent ids later
+        folders = self.__list_files(
+            drive_service,
+            q=f"mimeType='{FOLDER_MIME_TYPE}' and trashed = false",
+            fields='id, name, parents'
+        )
+        presentations = self.__list_files(
+            drive_service,
+            q=f"mimeType='{PRESENTATION_MIME_TYPE}' and trashed = false",
+            fields='id, name, modifiedTime, md5Checksum, parents'
+        )
+
+        return {
+            'start_page_token': start_page_token,
+            'root': {'id': drive.get('id'), 'name': drive.get('name')},
+            'folders': {folder.get('id'): folder for folder in folders},
+            'presentations': {pres.get('id'): pres for pres in presentations}
+        }
+
+    def __list_files(self, drive_service, q, fields, page_size=1000):
+        files = []
+        page_token = None
+        while True:
+            response = drive_service.files().list(
+                q=q,
+                pageSize=page_size,
+                pageToken=page_token,
+                fields=f'nextPageToken, files({fields})'
+            ).execute()
+            files.extend(response.get('files', []))
+            page_token = response.get('nextPageToken')
+            if page_token is None:
+                return files
+
+    def __apply_changes(self, drive_service, state):
+        page_token = state.get('start_page_token')
+        while page_token is not None:
+            response = drive_service.changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                includeRemoved=True,
+                fields='nextPageToken, newStartPageToken, '
+                       'changes(fileId, removed, file(id, name, mimeType, modifiedTime, md5Checksum, parents, trashed))'
+            ).execute()
+
+            for change in response.get('changes', []):
+                file_id = change.get('fileId')
+                file = change.get('file')
+
+                state['folders'].pop(file_id, None)
+                state['presentations'].pop(file_id, None)
+
+                if change.get('removed') or file is None or file.get('trashed'):
+                    continue
+
+                if file.get('mimeType') == FOLDER_MIME_TYPE:
+                    state['folders'][file_id] = {
+                        'id': file_id,
+                        'name': file.get('name'),
+                        'parents': file.get('parents')
+                    }
+                elif file.get('mimeType') == PRESENTATION_MIME_TYPE:
+                    state['presentations'][file_id] = {
+                        'id': file_id,
+                        'name': file.get('name'),
+                        'modifiedTime': file.get('modifiedTime'),
+                        'md5Checksum': file.get('md5Checksum'),
+                        'parents': file.get('parents')
+                    }
+
+            if 'newStartPageToken' in response:
+                state['start_page_token'] = response.get('newStartPageToken')
+            page_token = response.get('nextPageToken')
+
+    def __build_file_tree(self, state):
+        # Fresh node copies are created on every call, so callers are free
+        # to annotate the returned tree without touching the stored state
+        children_by_parent = {}
+
+        for folder in state.get('folders').values():
+            parents = folder.get('parents')
+            if parents:
+                node = {'id': folder.get('id'), 'name': folder.get('name')}
+                children_by_parent.setdefault(parents[0], ([], []))[0].append(node)
+
+        for pres in state.get('presentations').values():
+            parents = pres.get('parents')
+            if parents:
+                node = dict(pres, type='presentation')
+                children_by_parent.setdefault(parents[0], ([], []))[1].append(node)
+
+        drive = dict(state.get('root'))
+        folders = []
+        presentations = []
+
+        stack = [drive]
+        while stack:
+            node = stack.pop()
+            folders.append(node)
+            child_folders, child_presentations = children_by_parent.get(node.get('id'), ([], []))
+            node['children'] = [*child_folders, *child_presentations]
             node['type'] = 'folder'
+            presentations.extend(child_presentations)
+            stack.extend(child_folders)
 
-        traverse(drive)
         file_tree = drive
         return folders, presentations, file_tree
 
-    def __download_presentation(self, presentation, user_flow):
+    def __get_user_lock(self, user_id):
+        self.lock_mutex.acquire()
+        if user_id not in self.user_locks:
+            self.user_locks[user_id] = Lock()
+        user_lock = self.user_locks[user_id]
+        self.lock_mutex.release()
+        return user_lock
 
+    def __get_state_file(self, user_id):
+        return os.path.join(self.state_path, f'{user_id}.json')
+
+    def __load_state(self, user_id):
         try:
-            drive_service = build('drive', 'v3', credentials=user_flow.credentials)
-            request = drive_service.files().get_media(fileId=presentation.get('id'))
-            file = io.BytesIO()
-            downloader = MediaIoBaseDownload(file, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
+            with open(self.__get_state_file(user_id), 'r', encoding='utf-8') as state_file:
+                return json.load(state_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def __save_state(self, user_id, state):
+        if not os.path.exists(self.state_path):
+            os.makedirs(self.state_path)
+        state_file_path = self.__get_state_file(user_id)
+        with open(state_file_path + '.tmp', 'w', encoding='utf-8') as state_file:
+            json.dump(state, state_file)
+        os.replace(state_file_path + '.tmp', state_file_path)
+
+    def __get_drive_service(self, user_id, user_flow):
+        # Service is rebuilt only when the user logs in again with new credentials
+        self.lock_mutex.acquire()
+        try:
+            credentials, drive_service = self.drive_services.get(user_id, (None, None))
+            if drive_service is None or credentials is not user_flow.credentials:
+                drive_service = self.build_drive_service(user_flow)
+                self.drive_services[user_id] = (user_flow.credentials, drive_service)
+            return drive_service
+        finally:
+            self.lock_mutex.release()
+
+    def __get_authorized_http(self, user_id, user_flow):
+        # httplib2 connections are not thread-safe, so every worker thread keeps
+        # its own authorized client per user and reuses it for all downloads
+        user_http = getattr(self.thread_local, 'user_http', None)
+        if user_http is None:
+            user_http = self.thread_local.user_http = {}
+        credentials, http = user_http.get(user_id, (None, None))
+        if http is None or credentials is not user_flow.credentials:
+            http = AuthorizedHttp(user_flow.credentials, http=httplib2.Http())
+            user_http[user_id] = (user_flow.credentials, http)
+        return http
+
+    def __set_download_progress(self, user_id, presentation, **kwargs):
+        self.lock_mutex.acquire()
+        user_progress = self.download_progress.setdefault(user_id, {})
+        progress = user_progress.setdefault(presentation.get('id'), {
+            'id': presentation.get('id'),
+            'downloaded': 0,
+            'total': None,
+            'done': False
+        })
+        progress.update(kwargs)
+        self.lock_mutex.release()
+
+    def get_download_progress(self, user_id):
+        self.lock_mutex.acquire()
+        progress = [dict(pres_progress) for pres_progress in self.download_progress.get(user_id, {}).values()]
+        self.lock_mutex.release()
+        return progress
 
-            if not os.path.exists(os.path.join(SERVER_ROOT, f"presentation_processing/temp")):
-                os.mkdir(os.path.join(SERVER_ROOT, f"presentation_processing/temp"))
+    def __get_presentation_version(self, drive_service, http, presentation):
+        version = presentation.get('md5Checksum') or presentation.get('modifiedTime')
+        if version is None:
+            metadata = drive_service.files().get(
+                fileId=presentation.get('id'),
+                fields='md5Checksum, modifiedTime'
+            ).execute(http=http)
+            version = metadata.get('md5Checksum') or metadata.get('modifiedTime')
+        return version
 
-            pres_dir_path = os.path.join(SERVER_ROOT, f"presentation_processing/temp/{presentation.get('id')}")
-            if not os.path.exists(pres_dir_path):
-                os.mkdir(pres_dir_path)
+    def __download_presentation(self, presentation, user_id, user_flow, workspace):
+        pres_path = workspace.presentation_path(presentation.get('id'))
+        cache_key = None
+        part_path = None
 
-            with open(f"presentation_processing/temp/{presentation.get('id')}/{presentation.get('id')}.pptx",
-                      "wb") as f:
-                f.write(file.getvalue())
+        try:
+            drive_service = self.__get_drive_service(user_id, user_flow)
+            http = self.__get_authorized_http(user_id, user_flow)
+
+            if self.cache is not None:
+                version = self.__get_presentation_version(drive_service, http, presentation)
+                cache_key = self.cache.make_key(presentation.get('id'), version)
+                if self.cache.get(cache_key, pres_path):
+                    self.__set_download_progress(user_id, presentation, done=True, cached=True)
+                    return
+                part_path = self.cache.reserve(cache_key)
+            else:
+                part_path = f'{pres_path}.{uuid.uuid4().hex}.part'
+
+            request = drive_service.files().get_media(fileId=presentation.get('id'))
+            request.http = http
+
+            # Chunks are written straight into a part file, so a deck is never held
+            # in memory as a whole and a failed download never leaves a partial deck
+            with open(part_path, "wb") as file:
+                downloader = MediaIoBaseDownload(file, request, chunksize=self.download_chunk_size)
+                done = False
+                while done is False:
+                    status, done = downloader.next_chunk()
+                    self.__set_download_progress(
+                        user_id, presentation,
+                        downloaded=status.resumable_progress,
+                        total=status.total_size
+                    )
+
+            if cache_key is not None:
+                self.cache.commit(cache_key, part_path, pres_path)
+            else:
+                os.replace(part_path, pres_path)
+            part_path = None
+            self.__set_download_progress(user_id, presentation, done=True)
 
         except HttpError as error:
-            print(F'An error occurred: {error}')
+            if os.path.exists(pres_path):
+                os.remove(pres_path)
+            self.__set_download_progress(user_id, presentation, error=str(error))
+            raise
+
+        finally:
+            # Part file is left only by a failed download
+            if part_path is not None and os.path.exists(part_path):
+                os.remove(part_path)
+
+    def reset_download_progress(self, user_id):
+        self.lock_mutex.acquire()
+        self.download_progress[user_id] = {}
+        self.lock_mutex.release()
+
+    def download_presentations(self, presentations, user_flow, user_id, workspace=None, reset_progress=True):
+        workspace = workspace or Workspace.shared()
+
+        # Background sync downloads presentations one at a time, so it resets progress once per job
+        if reset_progress:
+            self.reset_download_progress(user_id)
+
+        # All downloads are finished before the first failure is raised,
+        # so none of them writes into a workspace the caller has already removed
+        results = [
+            self.download_pool.apply_async(self.__download_presentation, (pres, user_id, user_flow, workspace))
+            for pres in presentations
+        ]
+        for result in results:
+            result.wait()
+        for result in results:
+            result.get()
 
-    def download_presentations(self, presentations, user_flow):
-        temp_path = os.path.join(SERVER_ROOT, "presentation_processing/temp")
-        if not os.path.exists(temp_path):
-            os.mkdir(temp_path)
-        self.pool.starmap(self.__download_presentation, [(pres, user_flow) for pres in presentations])
+    def close(self):
+        self.download_pool.close()
+        self.download_pool.join()
 
     def upload_presentation(self, name, save_to, user_id, user_flow):
         credentials = user_flow.credentials
@@ -1,6 +1,9 @@
-from typing import List
+from typing import List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, conint
+
+# Largest page of slides returned by one request
+MAX_PAGE_SIZE = 500
 
 
 class Presentation(BaseModel):
@@ -11,4 +14,7 @@ class FilterModel(BaseModel):
     presentations: List['Presentation']
     tag_query: str
     text_phrase: str
-    ratio: str
\ No newline at end of file
+    ratio: str
+    # Slides are returned page by page when page_size is set, pages are numbered from 0
+    page: conint(ge=0) = 0
+    page_size: Optional[conint(gt=0, le=MAX_PAGE_SIZE)] = None
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Dict
 
 from pydantic import BaseModel
 
@@ -9,8 +9,12 @@ class SlideModel(BaseModel):
     index: int
     text: str
     thumbnail: str
+    # URLs of the thumbnail by size: small, medium and full
+    thumbnails: Dict[str, str]
     ratio: str
     label: str
+    # [start, end) offsets of text matched by the search phrase
+    highlights: List[List[int]] = []
 
 class FilteredSlidesModel(BaseModel):
     slides: List['SlideModel']
\ No newline at end of file
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Dict
 
 from pydantic import BaseModel
 
@@ -8,6 +8,7 @@ class Slide(BaseModel):
     pres_id: str
     index: int
     thumbnail: str
+    thumbnails: Dict[str, str]
     ratio: List[str]
     text: str
 
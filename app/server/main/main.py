@@ -1,14 +1,18 @@
 import os
 import re
+from datetime import timedelta
 from multiprocessing.pool import ThreadPool
 
 import fastapi
 import uvicorn as uvicorn
-from fastapi import Cookie
+from fastapi import Cookie, Header
 from starlette.middleware.cors import CORSMiddleware
 from starlette.responses import Response, FileResponse
 
-from app.definitions import ROOT, SERVER_ROOT, db_user, db_password, db_url, db_name, api_origin, frontend_origin
+from app.definitions import ROOT, SERVER_ROOT, db_user, db_password, db_url, db_name, api_origin, frontend_origin, \
+    db_pool_size, db_max_overflow, thumbnails_path, \
+    drive_max_concurrent_downloads, drive_cache_size_mb, renderer_name, renderer_workers, renderer_recycle_after, \
+    sync_workers, sync_job_retention_days
 from app.server.main.database.database_handler import DatabaseHandler, Users
 from app.server.main.external_services.google.google_auth_handler import GoogleAuthHandler
 from app.server.main.external_services.google.google_drive_handler import GoogleDriveHandler
@@ -24,6 +28,11 @@ from app.server.main.interfaces.presentations_list_model import PresentationsLis
 from app.server.main.interfaces.tags_list_model import TagListModel
 from app.server.main.interfaces.user_info_model import UserInfoModel
 from app.server.main.presentation_processing.presentation_process_handler import PresentationProcessHandler
+from app.server.main.presentation_processing.renderers import create_renderer, RendererPool
+from app.server.main.sync.sync_job_handler import SyncJobHandler
+from app.server.main.utils.file_cache import FileCache
+from app.server.main.utils.thumbnail_store import ThumbnailStore
+from app.server.main.utils.workspace import Workspace
 from dotenv import load_dotenv
 from utils import utils
 
@@ -47,14 +56,45 @@ db_handler = DatabaseHandler(
     user=db_user,
     password=db_password,
     host=db_url,
-    db=db_name
+    db=db_name,
+    pool_size=db_pool_size,
+    max_overflow=db_max_overflow,
+    thumbnail_store=ThumbnailStore(thumbnails_path)
 )
 
 db_handler.create_db()
 
 auth_handler = GoogleAuthHandler(pool=pool)
-drive_handler = GoogleDriveHandler(pool=pool)
-pres_handler = PresentationProcessHandler(pool=pool)
+drive_cache = FileCache(
+    path=os.path.join(SERVER_ROOT, 'presentation_processing/cache'),
+    max_size=drive_cache_size_mb * 1024 * 1024
+)
+drive_handler = GoogleDriveHandler(
+    pool=pool,
+    cache=drive_cache,
+    max_concurrent_downloads=drive_max_concurrent_downloads
+)
+renderer = create_renderer(renderer_name, workers=renderer_workers)
+renderer_pool = RendererPool(renderer, max_documents=renderer_recycle_after)
+pres_handler = PresentationProcessHandler(
+    pool=pool,
+    renderer=renderer,
+    renderer_pool=renderer_pool
+)
+sync_job_handler = SyncJobHandler(
+    db_handler=db_handler,
+    drive_handler=drive_handler,
+    pres_handler=pres_handler,
+    workers=sync_workers,
+    retention=timedelta(days=sync_job_retention_days)
+)
+
+
+@app.on_event('shutdown')
+def shutdown():
+    sync_job_handler.close()
+    renderer_pool.close()
+    drive_handler.close()
 
 
 # ---------- AUTH BLOCK ----------
@@ -95,7 +135,7 @@ def logout(pres_conf_user_state: str = Cookie(default=None)):
 @app.get('/files/tree', response_model=FolderModel)
 def file_tree(pres_conf_user_state: str = Cookie(default=None), only_folders=False):
     user_id, user_flow = auth_handler.get_user(pres_conf_user_state)
-    drive_folders, drive_presentations, user_file_tree = drive_handler.get_user_file_tree(user_flow)
+    drive_folders, drive_presentations, user_file_tree = drive_handler.get_user_file_tree(user_flow, user_id)
     user_file_tree['is_root'] = True
     marked_presentations = []
 
@@ -118,15 +158,9 @@ def file_tree(pres_conf_user_state: str = Cookie(default=None), only_folders=Fal
 
     traverse(user_file_tree)
 
+    # Presentations are synced in background, progress is polled through /files/sync-status
     if not only_folders:
-        try:
-            presentations_to_sync, delta = db_handler.sync_presentations(user_id, marked_presentations)
-            drive_handler.download_presentations(presentations_to_sync, user_flow)
-            presentations_ratio = pres_handler.crop_presentations(presentations_to_sync)
-            presentations_text = pres_handler.extract_text(presentations_to_sync)
-            db_handler.sync_presentation_slides(presentations_to_sync, delta, presentations_ratio, presentations_text, user_id)
-        finally:
-            utils.clear_temp()
+        sync_job_handler.enqueue(user_id, user_flow, marked_presentations)
 
     return user_file_tree
 
@@ -134,7 +168,9 @@ def file_tree(pres_conf_user_state: str = Cookie(default=None), only_folders=Fal
 @app.get('/files/sync-status')
 def get_sync_status(pres_conf_user_state: str = Cookie(default=None)):
     user_id, _ = auth_handler.get_user(pres_conf_user_state)
-    return db_handler.get_sync_query(user_id)
+    sync_status = sync_job_handler.get_sync_status(user_id)
+    sync_status['downloads'] = drive_handler.get_download_progress(user_id)
+    return sync_status
 
 
 @app.post('/files/folders/set-mark')
@@ -155,6 +191,31 @@ def get_pres_slides(pres_id, pres_conf_user_state: str = Cookie(default=None)):
     return {'slides': [slide.json() for slide in pres_slides]}
 
 
+@app.get('/slides/{slide_id}/thumbnail')
+def get_slide_thumbnail(slide_id: int, size: str = 'full', v: str = None, if_none_match: str = Header(default=None),
+                        pres_conf_user_state: str = Cookie(default=None)):
+    user_id, _ = auth_handler.get_user(pres_conf_user_state)
+    if size not in ThumbnailStore.SIZES:
+        return Response(status_code=400)
+    thumbnail_hash = db_handler.get_slide_thumbnail_hash(slide_id, user_id)
+    if thumbnail_hash is None:
+        return Response(status_code=404)
+
+    # Thumbnails are content-addressed, so their hash and size make a strong ETag.
+    # Versioned URLs never change their content and are cached for a year
+    headers = {
+        'ETag': f'"{thumbnail_hash}-{size}"',
+        'Cache-Control': 'private, max-age=31536000, immutable' if v == thumbnail_hash else 'private, no-cache'
+    }
+    if if_none_match is not None and (if_none_match.strip() == '*' or headers['ETag'] in
+                                      [etag.strip() for etag in if_none_match.split(',')]):
+        return Response(status_code=304, headers=headers)
+    thumbnail = db_handler.thumbnail_store.get(thumbnail_hash, size)
+    if thumbnail is None:
+        return Response(status_code=404)
+    return Response(thumbnail, media_type='image/webp', headers=headers)
+
+
 @app.post('/slides/by-filters', response_model=FilteredSlidesModel)
 def get_slides_by_filters(filters: FilterModel, pres_conf_user_state: str = Cookie(default=None)):
     user_id, _ = auth_handler.get_user(pres_conf_user_state)
@@ -163,7 +224,9 @@ def get_slides_by_filters(filters: FilterModel, pres_conf_user_state: str = Cook
         filters.tag_query,
         filters.text_phrase,
         filters.ratio,
-        user_id
+        user_id,
+        offset=filters.page * filters.page_size if filters.page_size is not None else 0,
+        limit=filters.page_size
     )
     return {'slides': slides_with_labels}
 
@@ -180,27 +243,23 @@ def get_presentations_by_tag_query(query, pres_conf_user_state: str = Cookie(def
 def generate_style_templates(slides: SlidesPoolModel, pres_conf_user_state: str = Cookie(default=None)):
     user_id, user_flow = auth_handler.get_user(pres_conf_user_state)
     presentations = [{'id': pres_id} for pres_id in set([slide.pres_id for slide in slides.slides])]
-    try:
-        drive_handler.download_presentations(presentations, user_flow)
-        templates = pres_handler.create_style_templates(presentations)
+    with Workspace() as workspace:
+        drive_handler.download_presentations(presentations, user_flow, user_id, workspace)
+        templates = pres_handler.create_style_templates(presentations, workspace)
         return {'templates': templates}
-    finally:
-        utils.clear_temp()
-        utils.clear_styles()
 
 
 @app.post('/presentations/build')
 def build_presentations(build_from: BuildPresentationModel, pres_conf_user_state: str = Cookie(default=None)):
     user_id, user_flow = auth_handler.get_user(pres_conf_user_state)
     presentations = [{'id': pres_id} for pres_id in set([slide.pres_id for slide in build_from.slides])]
-    try:
-        drive_handler.download_presentations(presentations, user_flow)
+    with Workspace() as workspace:
+        drive_handler.download_presentations(presentations, user_flow, user_id, workspace)
         seen_text, seen_thumbs, seen_slides = pres_handler.build_presentation(
-            build_from.name, build_from.slides, build_from.ratio, build_from.style_template, db_handler, user_id)
+            build_from.name, build_from.slides, build_from.ratio, build_from.style_template, db_handler, user_id,
+            workspace)
         pres = drive_handler.upload_presentation(build_from.name, build_from.save_to, user_id, user_flow)
         db_handler.pres_sync_uploaded(pres, seen_text, seen_thumbs, build_from.ratio, seen_slides, user_id)
-    finally:
-        utils.clear_temp()
 
 
 @app.get('/presentations/get-built-presentation')
@@ -1,24 +1,39 @@
 import base64
+import bisect
+import contextlib
 import os
 
-import pythoncom
-import win32com.client
 from aspose import slides
 
 from pptx import Presentation
 
-from app.server.main.utils import utils
-from app.definitions import SERVER_ROOT
+from app.server.main.utils import utils, fingerprint
+from app.server.main.utils.deck_cache import DeckCache
+from app.server.main.utils.workspace import Workspace
+from app.definitions import SERVER_ROOT, duplicate_slide_distance
 from app.server.main.database.database_handler import Slides
+from app.server.main.presentation_processing.renderers import PowerPointRenderer, SLIDE_IMAGE_NAME
 
 
 class PresentationProcessHandler:
 
-    def __init__(self, pool):
+    def __init__(self, pool, renderer=None, renderer_pool=None, duplicate_distance=duplicate_slide_distance,
+                 max_open_decks=8):
         self.pool = pool
-
-    def get_slide_ratio(self, slide):
-        slide_ratio = (slide.CustomLayout.Width / slide.CustomLayout.Height)
+        self.renderer = renderer or PowerPointRenderer()
+        self.renderer_pool = renderer_pool
+        self.duplicate_distance = duplicate_distance
+        # Source presentations kept open at once while building
+        self.max_open_decks = max_open_decks
+
+    def __open_renderer_session(self):
+        # Long-lived renderer pool is shared between requests and is never closed here
+        if self.renderer_pool is not None:
+            return contextlib.nullcontext(self.renderer_pool)
+        return self.renderer.open_session()
+
+    def get_slide_ratio(self, width, height):
+        slide_ratio = width / height
         if abs(slide_ratio - (4 / 3)) < 10e-2:
             return Slides.Ratio.STANDARD_4_TO_3
         elif abs(slide_ratio - (16 / 9)) < 10e-2:
@@ -26,43 +41,31 @@ class PresentationProcessHandler:
         else:
             raise AttributeError("Unknown slide ratio")
 
-    def crop_presentation(self, presentation, win32com_app_instance):
-        pres_path = os.path.join(SERVER_ROOT, f'presentation_processing/temp/{presentation.get("id")}/{presentation.get("id")}.pptx')
-        img_path = os.path.join(SERVER_ROOT, f'presentation_processing/temp/{presentation.get("id")}/images')
+    def crop_presentation(self, presentation, renderer_session, workspace=None):
+        workspace = workspace or Workspace.shared()
+        pres_path = workspace.presentation_path(presentation.get('id'))
+        img_path = workspace.images_dir(presentation.get('id'))
         os.mkdir(img_path)
 
-        presentation = win32com_app_instance.Presentations.Open(pres_path, WithWindow=False)
-        presentation.Export(img_path, 'PNG')
-
-        try:
-            presentation_ratio = self.get_slide_ratio(presentation.Slides[0])
-            return presentation_ratio
-        except IndexError:
-            raise AttributeError("Presentation is empty")
-        finally:
-            presentation.Close()
-            presentation = None
+        width, height = renderer_session.export(pres_path, img_path)
+        return self.get_slide_ratio(width, height)
 
-    def crop_presentations(self, presentations):
+    def crop_presentations(self, presentations, workspace=None):
         presentations_ratio = []
 
-        # Start of win32com Application takes significant amount of time
+        # Start of renderer (e.g. win32com Application) takes significant amount of time
         # so we should previously check if presentation array is not empty
         if len(presentations) > 0:
-            pythoncom.CoInitializeEx(0)
-            ApplicationPPTX = win32com.client.Dispatch("PowerPoint.Application")
-
-            for result in self.pool.starmap(
-                    self.crop_presentation, [(presentation, ApplicationPPTX) for presentation in presentations]):
-                presentations_ratio.append(result)
-
-            ApplicationPPTX.Quit()
-            ApplicationPPTX = None
+            with self.__open_renderer_session() as renderer_session:
+                for result in self.pool.starmap(
+                        self.crop_presentation,
+                        [(presentation, renderer_session, workspace) for presentation in presentations]):
+                    presentations_ratio.append(result)
 
         return presentations_ratio
 
-    def __extract_text(self, presentation):
-        pres_path = os.path.join(SERVER_ROOT, f'presentation_processing/temp/{presentation.get("id")}/{presentation.get("id")}.pptx')
+    def __extract_text(self, presentation, workspace):
+        pres_path = workspace.presentation_path(presentation.get('id'))
         pres = Presentation(pres_path)
         text = []
         for slide in pres.slides:
@@ -73,25 +76,21 @@ class PresentationProcessHandler:
             text.append(slide_text)
         return text
 
-    def extract_text(self, presentations):
+    def extract_text(self, presentations, workspace=None):
+        workspace = workspace or Workspace.shared()
         presentations_text = []
-        for result in self.pool.map(self.__extract_text, presentations):
+        for result in self.pool.starmap(self.__extract_text, [(presentation, workspace) for presentation in presentations]):
             presentations_text.append(result)
         return presentations_text
 
-    def create_style_template(self, presentation, win32com_app_instance):
-        pres_path = os.path.join(
-            SERVER_ROOT,
-            f"presentation_processing/temp/{presentation.get('id')}/{presentation.get('id')}.pptx"
-        )
+    def create_style_template(self, presentation, renderer_session, workspace=None):
+        workspace = workspace or Workspace.shared()
+        pres_path = workspace.presentation_path(presentation.get('id'))
         style_sample_path = os.path.join(
             SERVER_ROOT,
             f"presentation_processing/styles/style-sample.pptx"
         )
-        style_template_directory = os.path.join(
-            SERVER_ROOT,
-            f"presentation_processing/styles/temp/{presentation.get('id')}"
-        )
+        style_template_directory = workspace.style_dir(presentation.get('id'))
         style_template_path = os.path.join(style_template_directory, f"{presentation.get('id')}.pptx")
 
         with slides.Presentation(pres_path) as build_from_pres:
@@ -105,18 +104,13 @@ class PresentationProcessHandler:
                 sample_pres.masters.remove_at(0)
 
                 # Saving template presentation
-                if not os.path.exists(style_template_directory):
-                    os.mkdir(style_template_directory)
                 sample_pres.save(style_template_path, slides.export.SaveFormat.PPTX)
                 utils.clear_watermark(style_template_path)
 
         # Exporting as image
-        pres = win32com_app_instance.Presentations.Open(style_template_path, WithWindow=False)
-        pres.Export(style_template_directory, 'png')
-        pres.Close()
-        pres = None
+        renderer_session.export(style_template_path, style_template_directory)
 
-        with open(style_template_directory + '/Слайд1.PNG', "rb") as image:
+        with open(os.path.join(style_template_directory, SLIDE_IMAGE_NAME.format(1)), "rb") as image:
             style_thumbnail = base64.b64encode(image.read())
             style_template = {
                 'id': presentation.get('id'),
@@ -125,56 +119,70 @@ class PresentationProcessHandler:
 
         return style_template
 
-    def create_style_templates(self, presentations):
-        # Start of win32com Application takes significant amount of time
+    def create_style_templates(self, presentations, workspace=None):
+        # Start of renderer (e.g. win32com Application) takes significant amount of time
         # so we should previously check if presentation array is not empty
         if len(presentations) > 0:
-            pythoncom.CoInitializeEx(0)
-            ApplicationPPTX = win32com.client.Dispatch("PowerPoint.Application")
-
-            style_path = os.path.join(SERVER_ROOT, "presentation_processing/styles/temp")
-            if not os.path.exists(style_path):
-                os.mkdir(style_path)
-
             style_templates = []
 
-            for result in self.pool.starmap(self.create_style_template,
-                                            [(presentation, ApplicationPPTX) for presentation in presentations]):
-                style_templates.append(result)
-
-            ApplicationPPTX.Quit()
-            ApplicationPPTX = None
+            with self.__open_renderer_session() as renderer_session:
+                for result in self.pool.starmap(self.create_style_template,
+                                                [(presentation, renderer_session, workspace)
+                                                 for presentation in presentations]):
+                    style_templates.append(result)
 
             return style_templates
 
         return None
 
 
-    def build_presentation(self, name, slides_from, ratio, style_template, db_handler, user_id):
+    def build_presentation(self, name, slides_from, ratio, style_template, db_handler, user_id, workspace=None):
+        workspace = workspace or Workspace.shared()
         with slides.Presentation() as presentation:
             presentation.slides.remove_at(0)
 
+            seen_text = []
             seen_thumbs = []
+            seen_slides = []
+
+            # Stored hashes of all requested slides are fetched at once instead of comparing thumbnails
+            db_slides = db_handler.get_slides_by_ids([slide.id for slide in slides_from], user_id)
+            seen_hashes = set()
+            seen_fingerprints = fingerprint.BKTree()
 
             for slide in slides_from:
-                with slides.Presentation(f"{slide.pres_id}.pptx") as pres_from:
-                    unique = True
-                    slide_thumb = db_handler.get_slide_thumb_by_index(
-                        user_id,
-                        slide.pres_id,
-                        slide.index
-                    )
-                    for seen_thumb in seen_thumbs:
-                        if utils.img_eq(slide_thumb, seen_thumb):
-                            unique = False
-                            break
-                    if unique:
-                        presentation.slides.add_clone(pres_from.slides[slide.index])
-                        seen_thumbs.append(slide_thumb)
-
-            # Applying styles
-            if style_template:
-                with slides.Presentation(os.path.join(SERVER_ROOT, f"presentation_processing/temp/{style_template}/{style_template}.pptx")) as pres_from:
+                db_slide = db_slides.get(slide.id)
+                if db_slide is None or db_slide.thumbnail_hash in seen_hashes:
+                    continue
+                if db_slide.fingerprint is not None:
+                    if len(seen_fingerprints.search(db_slide.fingerprint, self.duplicate_distance)) > 0:
+                        continue
+                    seen_fingerprints.add(db_slide.fingerprint, slide.id)
+                seen_hashes.add(db_slide.thumbnail_hash)
+
+                seen_text.append(db_slide.text)
+                seen_thumbs.append(db_handler.thumbnail_store.get(db_slide.thumbnail_hash))
+                seen_slides.append(slide)
+
+            # Slides are cloned deck by deck, each inserted at its position in the built presentation
+            deck_positions = {}
+            for position, slide in enumerate(seen_slides):
+                deck_positions.setdefault(slide.pres_id, []).append(position)
+
+            with DeckCache(slides.Presentation, self.max_open_decks) as decks:
+                cloned_positions = []
+                for pres_id, positions in deck_positions.items():
+                    pres_from = decks.get(workspace.presentation_path(pres_id))
+                    for position in positions:
+                        presentation.slides.insert_clone(
+                            bisect.bisect(cloned_positions, position),
+                            pres_from.slides[seen_slides[position].index]
+                        )
+                        bisect.insort(cloned_positions, position)
+
+                # Applying styles
+                if style_template:
+                    pres_from = decks.get(workspace.presentation_path(style_template))
                     first_slide_master = pres_from.slides[0].layout_slide.master_slide
                     new_master = presentation.masters.add_clone(first_slide_master)
                     for slide in presentation.slides:
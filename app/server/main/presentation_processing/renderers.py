@@ -0,0 +1,309 @@
+import abc
+import logging
+import os
+import pathlib
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from pptx import Presentation
+
+SLIDE_IMAGE_NAME = 'Слайд{}.png'
+
+logger = logging.getLogger(__name__)
+
+
+class RendererSession(abc.ABC):
+    """Opened renderer instance which exports presentations as PNG images of their slides.
+
+    Exported images are named after SLIDE_IMAGE_NAME with 1-based slide numbers.
+    """
+
+    @abc.abstractmethod
+    def export(self, pres_path, img_dir):
+        """Exports slides of presentation to img_dir, returns (width, height) of its slides."""
+
+    def warm_up(self):
+        pass
+
+    def is_alive(self):
+        return True
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class Renderer(abc.ABC):
+    # Upper bound of sessions which can be opened at the same time, None if unlimited
+    max_sessions = None
+
+    def __init__(self, workers=1):
+        self.workers = workers
+
+    @abc.abstractmethod
+    def open_session(self, concurrency=None):
+        """Opens a session which runs up to concurrency exports at once, renderer workers if None."""
+
+
+class PowerPointSession(RendererSession):
+    def __init__(self, application):
+        self.application = application
+
+    def export(self, pres_path, img_dir):
+        presentation = self.application.Presentations.Open(pres_path, WithWindow=False)
+        try:
+            presentation.Export(img_dir, 'PNG')
+            first_slide = presentation.Slides[0]
+            return first_slide.CustomLayout.Width, first_slide.CustomLayout.Height
+        except IndexError:
+            raise AttributeError("Presentation is empty")
+        finally:
+            presentation.Close()
+            presentation = None
+
+    def is_alive(self):
+        try:
+            return self.application is not None and self.application.Version is not None
+        except Exception:
+            return False
+
+    def close(self):
+        try:
+            self.application.Quit()
+        except Exception:
+            # Application may have already crashed, which is why the session is being closed
+            pass
+        self.application = None
+
+
+class PowerPointRenderer(Renderer):
+    """Microsoft PowerPoint driven through win32com, available on Windows only."""
+
+    # PowerPoint runs as a single instance, every Dispatch returns the same application
+    max_sessions = 1
+
+    def open_session(self, concurrency=None):
+        import pythoncom
+        import win32com.client
+
+        pythoncom.CoInitializeEx(0)
+        return PowerPointSession(win32com.client.Dispatch("PowerPoint.Application"))
+
+
+class LibreOfficeSession(RendererSession):
+    def __init__(self, renderer, concurrency=None):
+        self.renderer = renderer
+        self.root = tempfile.mkdtemp(prefix='pres_conf_libreoffice_')
+
+        # soffice processes can run concurrently only with separate user profiles,
+        # the profile queue also bounds the number of running processes.
+        # LIFO order keeps a sequential user on the same, already initialized profile
+        self.profiles = queue.LifoQueue()
+        for i in range(concurrency or renderer.workers):
+            self.profiles.put(os.path.join(self.root, f'profile_{i}'))
+
+    def warm_up(self):
+        # First start with a fresh profile is the slowest one, so it is done ahead of the first job
+        profile = self.profiles.get()
+        try:
+            subprocess.run([
+                self.renderer.soffice_path, '--headless', '--norestore', '--terminate_after_init',
+                f'-env:UserInstallation={pathlib.Path(profile).as_uri()}'
+            ], check=True, capture_output=True, timeout=self.renderer.timeout)
+        finally:
+            self.profiles.put(profile)
+
+    def is_alive(self):
+        return os.path.exists(self.root)
+
+    def export(self, pres_path, img_dir):
+        pres = Presentation(pres_path)
+        if len(pres.slides) == 0:
+            raise AttributeError("Presentation is empty")
+
+        profile = self.profiles.get()
+        try:
+            with tempfile.TemporaryDirectory(dir=self.root) as pdf_dir:
+                subprocess.run([
+                    self.renderer.soffice_path, '--headless', '--norestore',
+                    f'-env:UserInstallation={pathlib.Path(profile).as_uri()}',
+                    '--convert-to', 'pdf', '--outdir', pdf_dir, pres_path
+                ], check=True, capture_output=True, timeout=self.renderer.timeout)
+
+                pdf_path = os.path.join(pdf_dir, f'{pathlib.Path(pres_path).stem}.pdf')
+                subprocess.run([
+                    self.renderer.pdftoppm_path, '-png', '-r', str(self.renderer.dpi),
+                    pdf_path, os.path.join(pdf_dir, 'slide')
+                ], check=True, capture_output=True, timeout=self.renderer.timeout)
+
+                # pdftoppm pads page numbers depending on the page count (slide-1.png or slide-01.png)
+                pages = sorted(
+                    (name for name in os.listdir(pdf_dir) if name.startswith('slide-') and name.endswith('.png')),
+                    key=lambda name: int(name[len('slide-'):-len('.png')])
+                )
+                os.makedirs(img_dir, exist_ok=True)
+                for number, page in enumerate(pages, start=1):
+                    shutil.move(os.path.join(pdf_dir, page), os.path.join(img_dir, SLIDE_IMAGE_NAME.format(number)))
+        finally:
+            self.profiles.put(profile)
+
+        return pres.slide_width, pres.slide_height
+
+    def close(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+class LibreOfficeRenderer(Renderer):
+    """Headless LibreOffice, slides are converted to PDF and rasterized with pdftoppm (poppler-utils)."""
+
+    def __init__(self, workers=4, soffice_path='soffice', pdftoppm_path='pdftoppm', dpi=96, timeout=600):
+        super().__init__(workers)
+        self.soffice_path = soffice_path
+        self.pdftoppm_path = pdftoppm_path
+        self.dpi = dpi
+        self.timeout = timeout
+
+    def open_session(self, concurrency=None):
+        return LibreOfficeSession(self, concurrency)
+
+
+class RendererPool(RendererSession):
+    """Long-lived pool of pre-warmed renderer sessions fed from a job queue.
+
+    Every worker thread owns one session (COM objects must stay in the thread that
+    created them), checks its health before each job and while idle, and recycles it
+    after max_documents exports or a failed export. A job taken while a session
+    cannot be opened fails with the error of opening it. The pool itself is a session,
+    export() blocks until one of the workers has rendered the presentation or export_timeout passes.
+    """
+
+    def __init__(self, renderer, workers=None, max_documents=50, health_check_interval=60, export_timeout=1800):
+        self.renderer = renderer
+        self.max_documents = max_documents
+        self.health_check_interval = health_check_interval
+        self.export_timeout = export_timeout
+        self.jobs = queue.Queue()
+
+        workers = workers or renderer.workers
+        if renderer.max_sessions is not None:
+            workers = min(workers, renderer.max_sessions)
+        self.threads = [
+            threading.Thread(target=self.__work, name=f'renderer-worker-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def __open_session(self):
+        # Every worker exports one presentation at a time, so there are no more renderer processes than workers
+        session = self.renderer.open_session(concurrency=1)
+        try:
+            session.warm_up()
+        except Exception:
+            session.close()
+            raise
+        return session
+
+    @staticmethod
+    def __close_session(session):
+        if session is not None:
+            session.close()
+
+    def __work(self):
+        session = None
+        rendered = 0
+        failing = False
+        while True:
+            if session is None:
+                try:
+                    session = self.__open_session()
+                    rendered = 0
+                    failing = False
+                except Exception as error:
+                    # Opening is retried while idle and for the next job, the failure is reported once
+                    # until a session is opened again, jobs fail with their own error
+                    if not failing:
+                        logger.warning('Renderer session could not be started: %s', error)
+                    failing = True
+
+            try:
+                job = self.jobs.get(timeout=self.health_check_interval)
+            except queue.Empty:
+                if session is not None and not session.is_alive():
+                    self.__close_session(session)
+                    session = None
+                continue
+
+            if job is None:
+                break
+
+            future, pres_path, img_dir = job
+            if not future.set_running_or_notify_cancel():
+                continue
+
+            if session is None or not session.is_alive():
+                self.__close_session(session)
+                session = None
+                try:
+                    session = self.__open_session()
+                    rendered = 0
+                    failing = False
+                except Exception as error:
+                    future.set_exception(error)
+                    continue
+
+            try:
+                future.set_result(session.export(pres_path, img_dir))
+                rendered += 1
+            except Exception as error:
+                future.set_exception(error)
+                # Failed export may leave the renderer in a broken state
+                if not session.is_alive():
+                    rendered = self.max_documents
+
+            if rendered >= self.max_documents:
+                self.__close_session(session)
+                session = None
+
+        self.__close_session(session)
+
+    def submit(self, pres_path, img_dir):
+        future = Future()
+        self.jobs.put((future, pres_path, img_dir))
+        return future
+
+    def export(self, pres_path, img_dir):
+        future = self.submit(pres_path, img_dir)
+        try:
+            return future.result(timeout=self.export_timeout)
+        except FutureTimeoutError:
+            # Job still waiting in the queue is skipped by the workers
+            future.cancel()
+            raise
+
+    def close(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+RENDERERS = {
+    'powerpoint': PowerPointRenderer,
+    'libreoffice': LibreOfficeRenderer
+}
+
+
+def create_renderer(name, **kwargs):
+    if name not in RENDERERS:
+        raise AttributeError(f"Unknown renderer '{name}'")
+    return RENDERERS[name](**kwargs)
@@ -0,0 +1,149 @@
+import logging
+import queue
+import threading
+import traceback
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+
+from app.server.main.database.database_handler import SyncJobs, SyncJobItems
+from app.server.main.utils import utils
+from app.server.main.utils.workspace import Workspace
+
+logger = logging.getLogger(__name__)
+
+
+class SyncJobHandler:
+    """Synchronizes marked Drive presentations with the database in background workers.
+
+    Jobs and per-presentation states are stored in the database, so sync status
+    can be polled by the client and survives server restarts. Jobs interrupted by
+    a restart are marked as failed, because user credentials are not persisted.
+
+    Jobs of a user run one at a time. A sync requested while a job of the user
+    is running is queued as a follow-up job, which runs after it with the
+    presentations of the latest request. Finished jobs are kept for retention.
+    """
+
+    def __init__(self, db_handler, drive_handler, pres_handler, workers=2, presentation_workers=4,
+                 retention=timedelta(days=7)):
+        self.db_handler = db_handler
+        self.drive_handler = drive_handler
+        self.pres_handler = pres_handler
+        self.retention = retention
+
+        # Separate pool, the handlers run their own work on the shared one
+        self.presentation_pool = ThreadPool(processes=presentation_workers)
+        self.lock_mutex = threading.Lock()
+        self.jobs = queue.Queue()
+        # Queued job of every user with arguments of the latest request, and users with a running job
+        self.queued_jobs = {}
+        self.job_args = {}
+        self.running_users = set()
+
+        self.db_handler.fail_unfinished_sync_jobs('Server was restarted')
+
+        self.threads = [
+            threading.Thread(target=self.__work, name=f'sync-worker-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def enqueue(self, user_id, user_flow, presentations):
+        """Enqueues sync of presentations, returns the queued job of the user which will sync them."""
+        self.lock_mutex.acquire()
+        try:
+            job = self.queued_jobs.get(user_id)
+            if job is None:
+                job = self.db_handler.create_sync_job(user_id)
+                self.queued_jobs[user_id] = job
+                # Follow-up job is put into the queue once the running job of the user is finished
+                if user_id not in self.running_users:
+                    self.jobs.put((job.id, user_id))
+            self.job_args[job.id] = (user_flow, presentations)
+            return job
+        finally:
+            self.lock_mutex.release()
+
+    def get_sync_status(self, user_id):
+        return self.db_handler.get_sync_status(user_id)
+
+    def __work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            job_id, user_id = job
+
+            self.lock_mutex.acquire()
+            self.queued_jobs.pop(user_id)
+            user_flow, presentations = self.job_args.pop(job_id)
+            self.running_users.add(user_id)
+            self.lock_mutex.release()
+
+            self.__run_job(job_id, user_id, user_flow, presentations)
+
+            self.lock_mutex.acquire()
+            self.running_users.discard(user_id)
+            follow_up = self.queued_jobs.get(user_id)
+            if follow_up is not None:
+                self.jobs.put((follow_up.id, user_id))
+            self.lock_mutex.release()
+
+            try:
+                self.db_handler.delete_finished_sync_jobs(datetime.utcnow() - self.retention)
+                # Synced slides may be deleted or get new thumbnails
+                self.db_handler.delete_unreferenced_thumbnails()
+            except Exception:
+                traceback.print_exc()
+
+    def __run_job(self, job_id, user_id, user_flow, presentations):
+        try:
+            self.db_handler.set_sync_job_state(job_id, SyncJobs.State.RUNNING)
+            self.drive_handler.reset_download_progress(user_id)
+            with Workspace() as workspace:
+                # New modification times are stored per presentation once its slides are,
+                # so presentations which fail to sync are synced again by the next job
+                synced, delta = self.db_handler.sync_presentations(user_id, presentations, defer_modified_time=True)
+                self.db_handler.add_sync_job_items(job_id, synced, delta)
+
+                # Only created and modified presentations have to be downloaded and rendered
+                created, modified = delta
+                self.presentation_pool.starmap(
+                    self.__sync_presentation,
+                    [(job_id, pres, delta, user_id, user_flow, workspace) for pres in created + modified]
+                )
+            self.db_handler.set_sync_job_state(job_id, SyncJobs.State.DONE)
+            # Images decoded to match slides are cached by the whole server, not per user
+            logger.debug('Sync job %s is done, image cache: %s', job_id, utils.image_cache.stats())
+        except Exception as error:
+            traceback.print_exc()
+            self.db_handler.set_sync_job_state(job_id, SyncJobs.State.FAILED, str(error))
+
+    def __sync_presentation(self, job_id, presentation, delta, user_id, user_flow, workspace):
+        pres_id = presentation.get('id')
+        try:
+            self.db_handler.set_sync_job_item_state(job_id, pres_id, SyncJobItems.State.DOWNLOADING)
+            self.drive_handler.download_presentations([presentation], user_flow, user_id, workspace,
+                                                      reset_progress=False)
+
+            self.db_handler.set_sync_job_item_state(job_id, pres_id, SyncJobItems.State.RENDERING)
+            ratio = self.pres_handler.crop_presentations([presentation], workspace)
+            text = self.pres_handler.extract_text([presentation], workspace)
+
+            self.db_handler.set_sync_job_item_state(job_id, pres_id, SyncJobItems.State.STORING)
+            self.db_handler.sync_presentation_slides([presentation], delta, ratio, text, user_id, workspace)
+            self.db_handler.finish_presentation_sync(presentation)
+
+            self.db_handler.set_sync_job_item_state(job_id, pres_id, SyncJobItems.State.DONE)
+        except Exception as error:
+            traceback.print_exc()
+            self.db_handler.discard_presentation_sync(presentation)
+            self.db_handler.set_sync_job_item_state(job_id, pres_id, SyncJobItems.State.FAILED, str(error))
+
+    def close(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.presentation_pool.close()
@@ -0,0 +1,39 @@
+from collections import OrderedDict
+
+
+class DeckCache:
+    """Presentations opened during a single build, each opened once.
+
+    At most max_decks are kept open, the least recently used one is disposed
+    when another is opened. Used as a context manager, decks left open are
+    disposed on exit. Not thread safe, a cache belongs to one build.
+    """
+
+    def __init__(self, open_deck, max_decks=8):
+        self.open_deck = open_deck
+        self.max_decks = max_decks
+        self.decks = OrderedDict()
+        self.opened = 0
+
+    def get(self, path):
+        deck = self.decks.get(path)
+        if deck is not None:
+            self.decks.move_to_end(path)
+            return deck
+
+        deck = self.open_deck(path)
+        self.opened += 1
+        self.decks[path] = deck
+        while len(self.decks) > self.max_decks:
+            self.decks.popitem(last=False)[1].dispose()
+        return deck
+
+    def clear(self):
+        while len(self.decks) > 0:
+            self.decks.popitem(last=False)[1].dispose()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.clear()
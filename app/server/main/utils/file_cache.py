@@ -0,0 +1,103 @@
+import hashlib
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+
+class FileCache:
+    """Persistent on-disk cache of files with size-bounded LRU eviction.
+
+    Entries are stored under the sha256 of their key, so any versioned
+    identifier (e.g. Drive file id + md5Checksum) can be used as a key.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.lock_mutex = Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        # Restoring LRU order of entries left from previous runs by access time
+        stored = []
+        for name in os.listdir(self.path):
+            entry_path = os.path.join(self.path, name)
+            if name.endswith('.part'):
+                os.remove(entry_path)
+            else:
+                stat = os.stat(entry_path)
+                stored.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(stored):
+            self.entries[name] = size
+            self.size += size
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256('\0'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def __get_entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key, target_path):
+        """Places cached file at target path, returns False on cache miss.
+
+        Target is hard linked to the entry when possible, so it must be treated as read-only.
+        """
+        self.lock_mutex.acquire()
+        try:
+            if key not in self.entries:
+                return False
+            self.entries.move_to_end(key)
+            entry_path = self.__get_entry_path(key)
+            os.utime(entry_path)
+            self.__place(entry_path, target_path)
+            return True
+        finally:
+            self.lock_mutex.release()
+
+    @staticmethod
+    def __place(entry_path, target_path):
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        try:
+            os.link(entry_path, target_path)
+        except OSError:
+            shutil.copyfile(entry_path, target_path)
+
+    def reserve(self, key):
+        """Returns a temporary path to write the entry to before it is committed."""
+        return os.path.join(self.path, f'{key}.{uuid.uuid4().hex}.part')
+
+    def commit(self, key, part_path, target_path=None):
+        """Moves reserved file into the cache and optionally places it at target path."""
+        self.lock_mutex.acquire()
+        try:
+            size = os.path.getsize(part_path)
+            entry_path = self.__get_entry_path(key)
+            os.replace(part_path, entry_path)
+            if target_path is not None:
+                self.__place(entry_path, target_path)
+
+            self.size -= self.entries.pop(key, 0)
+            self.entries[key] = size
+            self.size += size
+
+            # The entry which has just been committed is never evicted
+            while self.size > self.max_size and len(self.entries) > 1:
+                evicted_key, evicted_size = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                try:
+                    os.remove(self.__get_entry_path(evicted_key))
+                except FileNotFoundError:
+                    pass
+        finally:
+            self.lock_mutex.release()
+
+    def discard(self, part_path):
+        if os.path.exists(part_path):
+            os.remove(part_path)
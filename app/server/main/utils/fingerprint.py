@@ -0,0 +1,75 @@
+import cv2
+import numpy as np
+
+FINGERPRINT_BITS = 64
+
+# Renders of the same slide differ in a few bits. Slides on the same template differing only
+# in text can be as close, so candidates within this distance are only narrowed down by it
+MATCH_DISTANCE = 6
+
+
+def phash(image, crop_bottom=0.1):
+    """Returns 64-bit perceptual hash of encoded image as a signed integer, None if it cannot be decoded.
+
+    Bottom of the slide is cropped as in utils.img_eq, the rest is reduced to 32x32
+    grayscale and hashed by signs of its low frequency DCT coefficients against their median.
+    """
+    img = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    img = img[0:max(1, int((1 - crop_bottom) * len(img)))]
+    small = cv2.resize(img, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    # DC coefficient is the mean brightness, it does not describe the layout
+    bits = low > np.median(low[1:])
+
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    # Stored in a signed BIGINT column
+    return value - (1 << FINGERPRINT_BITS) if value >= (1 << (FINGERPRINT_BITS - 1)) else value
+
+
+def hamming_distance(fingerprint1, fingerprint2):
+    return bin((fingerprint1 ^ fingerprint2) & ((1 << FINGERPRINT_BITS) - 1)).count('1')
+
+
+class BKTree:
+    """Burkhard-Keller tree of fingerprints for lookups within a Hamming distance.
+
+    Children of a node are keyed by their distance to it, so by the triangle
+    inequality a search only descends into children at distances within the
+    radius of the distance between the query and the node.
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, fingerprint, value):
+        node = (fingerprint, value, {})
+        if self.root is None:
+            self.root = node
+            return
+
+        current = self.root
+        while True:
+            distance = hamming_distance(fingerprint, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, fingerprint, radius):
+        """Returns (distance, value) of fingerprints within radius, closest first."""
+        found = []
+        nodes = [self.root] if self.root is not None else []
+        while len(nodes) > 0:
+            node_fingerprint, value, children = nodes.pop()
+            distance = hamming_distance(fingerprint, node_fingerprint)
+            if distance <= radius:
+                found.append((distance, value))
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    nodes.append(child)
+        return sorted(found, key=lambda item: item[0])
@@ -0,0 +1,67 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class ImageCache:
+    """Bounded in-memory LRU cache of decoded images with hit and miss counters.
+
+    Keys are content hashes, so an entry never goes stale. Images are loaded
+    outside of the lock, so two threads missing the same key may both load it.
+    Cached arrays are shared between callers and are made read-only.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock_mutex = Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """Returns cached image, loading it with load() on miss."""
+        self.lock_mutex.acquire()
+        try:
+            image = self.entries.get(key)
+            if image is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return image
+            self.misses += 1
+        finally:
+            self.lock_mutex.release()
+
+        image = load()
+        image.flags.writeable = False
+
+        self.lock_mutex.acquire()
+        try:
+            self.entries[key] = image
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        finally:
+            self.lock_mutex.release()
+        return image
+
+    def stats(self):
+        self.lock_mutex.acquire()
+        try:
+            requests = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests > 0 else 0.0,
+                'size': len(self.entries),
+                'max_size': self.max_size
+            }
+        finally:
+            self.lock_mutex.release()
+
+    def clear(self):
+        self.lock_mutex.acquire()
+        try:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self.lock_mutex.release()
@@ -0,0 +1,144 @@
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+from app.server.main.utils import utils
+
+
+class ThumbnailStore:
+    """Content-addressed on-disk store of slide thumbnails.
+
+    Thumbnails are stored under the sha256 of their bytes, which is kept in
+    the slides table instead of the image itself. Equal thumbnails of
+    different slides share one file, so stored files are never overwritten.
+
+    Next to the rendered thumbnail, which is used to compare slides, a pyramid
+    of WebP images of every size is stored when the thumbnail is put, so
+    clients get the size they display. Missing sizes, e.g. of thumbnails
+    stored before, are made on first request.
+
+    Thumbnails are not removed when slides are, files of thumbnails which are
+    no longer referenced are removed by sweep.
+    """
+
+    # Width in pixels of each size, full keeps the width the thumbnail was rendered with
+    SIZES = {
+        'small': 160,
+        'medium': 480,
+        'full': None
+    }
+
+    def __init__(self, path):
+        self.path = path
+        # Reuse of a stored thumbnail and its removal by sweep are exclusive
+        self.lock_mutex = threading.Lock()
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    @staticmethod
+    def make_hash(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def get_path(self, thumbnail_hash, size=None):
+        if size is not None and size not in self.SIZES:
+            raise ValueError(f'Unknown thumbnail size: {size}')
+        # Two-level layout keeps directories small for large libraries
+        name = thumbnail_hash if size is None else f'{thumbnail_hash}.{size}.webp'
+        return os.path.join(self.path, thumbnail_hash[:2], name)
+
+    @staticmethod
+    def __write(entry_path, data):
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        # Written to a unique part file first, so concurrent writers never expose partial files
+        part_path = f'{entry_path}.{uuid.uuid4().hex}.part'
+        with open(part_path, 'wb') as file:
+            file.write(data)
+        os.replace(part_path, entry_path)
+
+    def __write_pyramid(self, thumbnail_hash, data, sizes):
+        pyramid = utils.make_image_pyramid(data, {size: self.SIZES[size] for size in sizes})
+        for size, image in pyramid.items():
+            self.__write(self.get_path(thumbnail_hash, size), image)
+        return pyramid
+
+    def put(self, data, pyramid=True):
+        """Stores rendered thumbnail bytes and its pyramid, returns their hash."""
+        thumbnail_hash = self.make_hash(data)
+        entry_path = self.get_path(thumbnail_hash)
+        self.lock_mutex.acquire()
+        try:
+            # Reused thumbnail is marked as recent, so sweep keeps it until its slide is committed
+            os.utime(entry_path)
+            return thumbnail_hash
+        except FileNotFoundError:
+            pass
+        finally:
+            self.lock_mutex.release()
+
+        # Pyramid is written first, so a stored thumbnail always has all its sizes
+        if pyramid:
+            self.__write_pyramid(thumbnail_hash, data, self.SIZES)
+        self.__write(entry_path, data)
+        return thumbnail_hash
+
+    def exists(self, thumbnail_hash):
+        return os.path.exists(self.get_path(thumbnail_hash))
+
+    def get(self, thumbnail_hash, size=None):
+        """Returns rendered thumbnail bytes, or WebP image of given size.
+
+        None is returned if there is no such thumbnail.
+        """
+        entry_path = self.get_path(thumbnail_hash, size)
+        try:
+            with open(entry_path, 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            if size is None:
+                return None
+
+        data = self.get(thumbnail_hash)
+        if data is None:
+            return None
+        return self.__write_pyramid(thumbnail_hash, data, [size]).get(size)
+
+    def sweep(self, referenced_hashes, modified_before):
+        """Removes files of thumbnails not in referenced_hashes, returns the number of removed thumbnails.
+
+        Thumbnails are stored before slides referencing them are committed, so
+        thumbnails modified after the modified_before timestamp are kept.
+        """
+        removed = 0
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+
+            # Rendered thumbnail, its sizes and part files of unfinished writes start with the hash
+            files = {}
+            for file in os.scandir(directory.path):
+                files.setdefault(file.name.split('.')[0], []).append(file.path)
+
+            for thumbnail_hash, paths in files.items():
+                if thumbnail_hash in referenced_hashes:
+                    continue
+                self.lock_mutex.acquire()
+                try:
+                    modified = [os.path.getmtime(path) for path in paths if os.path.exists(path)]
+                    if len(modified) == 0 or max(modified) >= modified_before:
+                        continue
+                    for path in paths:
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                    removed += 1
+                finally:
+                    self.lock_mutex.release()
+        return removed
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.makedirs(self.path)
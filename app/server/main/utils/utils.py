@@ -1,3 +1,4 @@
+import hashlib
 import os
 import shutil
 
@@ -5,7 +6,10 @@ import cv2
 import numpy as np
 from pptx import Presentation
 
-from app.definitions import SERVER_ROOT
+from app.definitions import SERVER_ROOT, image_cache_size
+from app.server.main.utils.image_cache import ImageCache
+
+image_cache = ImageCache(max_size=image_cache_size)
 
 
 def clear_temp():
@@ -26,34 +30,126 @@ def clear_user_built(user_id):
         shutil.rmtree(temp_path)
 
 
-def img_eq(db_thumbnail, upd_thumbnail, crop_bottom=0.1, threshold=0.3):
-    np_arr_db = np.frombuffer(db_thumbnail, np.uint8)
-    img_db = cv2.imdecode(np_arr_db, cv2.IMREAD_COLOR)
-    np_arr_upd = np.frombuffer(upd_thumbnail, np.uint8)
-    img_upd = cv2.imdecode(np_arr_upd, cv2.IMREAD_COLOR)
+def preprocess_image(image):
+    """Decodes image for comparison and converts it to Lab."""
+    img = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    return cv2.cvtColor(img, cv2.COLOR_RGB2Lab)
 
-    lab_img_db = cv2.cvtColor(img_db, cv2.COLOR_RGB2Lab)
-    lab_img_upd = cv2.cvtColor(img_upd, cv2.COLOR_RGB2Lab)
 
-    h, w, _ = lab_img_db.shape
+def get_preprocessed_image(image):
+    return image_cache.get(hashlib.sha256(image).hexdigest(), lambda: preprocess_image(image))
 
+
+def match_sizes(lab_img_db, lab_img_upd):
+    # Images are compared at their native size, the larger one is resized to the smaller one
     if lab_img_db.shape < lab_img_upd.shape:
         h, w, _ = lab_img_db.shape
         lab_img_upd = cv2.resize(lab_img_upd, (w, h))
     elif lab_img_upd.shape < lab_img_db.shape:
         h, w, _ = lab_img_upd.shape
         lab_img_db = cv2.resize(lab_img_db, (w, h))
+    return lab_img_db, lab_img_upd
+
 
+def img_eq(db_thumbnail, upd_thumbnail, crop_bottom=0.1, threshold=0.3):
+    lab_img_db, lab_img_upd = match_sizes(get_preprocessed_image(db_thumbnail), get_preprocessed_image(upd_thumbnail))
+
+    h, w, _ = lab_img_db.shape
     img_diff = cv2.subtract(lab_img_upd, lab_img_db)
 
     # Cropping
-    img_diff = img_diff[0:int((1-crop_bottom)*len(img_diff))]
+    img_diff = img_diff[0:int((1 - crop_bottom) * len(img_diff))]
 
-    mse = np.sum(img_diff ** 2) / (w * h)
+    # Squared in int32, uint8 squares wrap around and hide differences such as 16 ** 2
+    mse = np.sum(np.square(img_diff, dtype=np.int32), dtype=np.int64) / (w * h)
 
     return mse < threshold
 
 
+def stacked_img_mse(db_images, upd_images, crop_bottom, max_chunk_bytes):
+    # Images of one size are cropped and stacked, blocks of db images are broadcast
+    # against blocks of upd images in a reused int32 buffer of about max_chunk_bytes
+    h, w, _ = db_images[0].shape
+    rows = int((1 - crop_bottom) * h)
+    db = np.stack([image[:rows].reshape(-1) for image in db_images])
+    upd = np.stack([image[:rows].reshape(-1) for image in upd_images])
+
+    mse = np.zeros((len(db), len(upd)))
+    pairs = max(1, max_chunk_bytes // (upd.shape[1] * 4))
+    columns = min(len(upd), pairs)
+    block_rows = min(len(db), max(1, pairs // columns))
+    buffer = np.empty((block_rows, columns, upd.shape[1]), np.int32)
+
+    for i in range(0, len(db), block_rows):
+        db_block = db[i:i + block_rows, np.newaxis]
+        for j in range(0, len(upd), columns):
+            upd_block = upd[np.newaxis, j:j + columns]
+            img_diff = buffer[:db_block.shape[0], :upd_block.shape[1]]
+            # Saturated subtraction as cv2.subtract in img_eq
+            np.subtract(upd_block, db_block, out=img_diff, dtype=np.int32)
+            np.maximum(img_diff, 0, out=img_diff)
+            np.multiply(img_diff, img_diff, out=img_diff)
+            mse[i:i + block_rows, j:j + columns] = np.sum(img_diff, axis=2, dtype=np.int64) / (w * h)
+
+    return mse
+
+
+def img_mse_matrix(db_thumbnails, upd_thumbnails, crop_bottom=0.1, max_chunk_bytes=16 * 1024 * 1024):
+    """Returns matrix of img_eq MSE between every db thumbnail (rows) and every upd thumbnail (columns).
+
+    Images are grouped by size and every pair of groups is compared as stacked
+    arrays, images of the larger size are resized to the smaller one as in img_eq.
+    """
+    mse = np.zeros((len(db_thumbnails), len(upd_thumbnails)))
+    if mse.size == 0:
+        return mse
+
+    db_images = [get_preprocessed_image(image) for image in db_thumbnails]
+    upd_images = [get_preprocessed_image(image) for image in upd_thumbnails]
+    db_groups = {}
+    for i, image in enumerate(db_images):
+        db_groups.setdefault(image.shape, []).append(i)
+    upd_groups = {}
+    for j, image in enumerate(upd_images):
+        upd_groups.setdefault(image.shape, []).append(j)
+
+    for db_shape, db_indices in db_groups.items():
+        for upd_shape, upd_indices in upd_groups.items():
+            db_group = [db_images[i] for i in db_indices]
+            upd_group = [upd_images[j] for j in upd_indices]
+            if db_shape < upd_shape:
+                upd_group = [match_sizes(db_group[0], image)[1] for image in upd_group]
+            elif upd_shape < db_shape:
+                db_group = [match_sizes(image, upd_group[0])[0] for image in db_group]
+            mse[np.ix_(db_indices, upd_indices)] = stacked_img_mse(db_group, upd_group, crop_bottom, max_chunk_bytes)
+
+    return mse
+
+
+def img_eq_matrix(db_thumbnails, upd_thumbnails, crop_bottom=0.1, threshold=0.3):
+    """Returns boolean matrix of img_eq between every db thumbnail (rows) and every upd thumbnail (columns)."""
+    return img_mse_matrix(db_thumbnails, upd_thumbnails, crop_bottom) < threshold
+
+
+def make_image_pyramid(image, widths, quality=80):
+    """Encodes image as WebP downscaled to each width keeping aspect ratio.
+
+    widths maps names to widths in pixels, None or widths larger than the image keep its size.
+    Image is decoded once for all widths, nothing is returned if it cannot be decoded.
+    """
+    pyramid = {}
+    img = cv2.imdecode(np.frombuffer(image, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        return pyramid
+    h, w = img.shape[:2]
+    for name, width in widths.items():
+        resized = img
+        if width is not None and width < w:
+            resized = cv2.resize(img, (width, round(h * width / w)), interpolation=cv2.INTER_AREA)
+        pyramid[name] = cv2.imencode('.webp', resized, [cv2.IMWRITE_WEBP_QUALITY, quality])[1].tobytes()
+    return pyramid
+
+
 def clear_watermark(path):
     pres = Presentation(path)
     slides = [slide for slide in pres.slides]
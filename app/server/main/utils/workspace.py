@@ -0,0 +1,57 @@
+import os
+import shutil
+import uuid
+
+from app.definitions import SERVER_ROOT
+
+TEMP_ROOT = os.path.join(SERVER_ROOT, 'presentation_processing/temp')
+STYLES_TEMP_ROOT = os.path.join(SERVER_ROOT, 'presentation_processing/styles/temp')
+
+
+class Workspace:
+    """Working directory of a single request or job.
+
+    Every workspace gets its own directory under presentation_processing/temp,
+    so concurrent requests never see or remove each other's files.
+    Used as a context manager, the directory is removed on exit.
+    """
+
+    def __init__(self, path=None, styles_path=None):
+        self.path = path or os.path.join(TEMP_ROOT, uuid.uuid4().hex)
+        self.styles_path = styles_path or os.path.join(self.path, 'styles')
+        os.makedirs(self.path, exist_ok=True)
+
+    @classmethod
+    def shared(cls):
+        # Legacy layout, presentation_processing/temp/<pres_id>, cleaned up by utils.clear_temp()
+        return cls(path=TEMP_ROOT, styles_path=STYLES_TEMP_ROOT)
+
+    def presentation_dir(self, pres_id):
+        pres_dir = os.path.join(self.path, pres_id)
+        os.makedirs(pres_dir, exist_ok=True)
+        return pres_dir
+
+    def presentation_path(self, pres_id):
+        return os.path.join(self.presentation_dir(pres_id), f'{pres_id}.pptx')
+
+    def images_dir(self, pres_id):
+        return os.path.join(self.path, pres_id, 'images')
+
+    def image_path(self, pres_id, index):
+        return os.path.join(self.images_dir(pres_id), f'Слайд{index + 1}.png')
+
+    def style_dir(self, pres_id):
+        style_dir = os.path.join(self.styles_path, pres_id)
+        os.makedirs(style_dir, exist_ok=True)
+        return style_dir
+
+    def cleanup(self):
+        for path in (self.styles_path, self.path):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.cleanup()
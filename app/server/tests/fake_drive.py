@@ -0,0 +1,147 @@
+import re
+
+from app.server.main.external_services.google.google_drive_handler import FOLDER_MIME_TYPE, PRESENTATION_MIME_TYPE
+
+
+class FakeRequest:
+    def __init__(self, response):
+        self.response = response
+
+    def execute(self):
+        return self.response
+
+
+class FakeMediaRequest:
+    """Media request of a file, its content is requested by the handler through request.http."""
+
+    def __init__(self, file_id):
+        self.uri = f'https://www.googleapis.com/drive/v3/files/{file_id}?alt=media'
+        self.headers = {}
+        self.http = None
+
+
+class FakeFiles:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def get(self, fileId, fields=None):
+        self.drive.calls['files.get'] += 1
+        file_id = self.drive.root_id if fileId == 'root' else fileId
+        return FakeRequest(dict(self.drive.storage[file_id]))
+
+    def get_media(self, fileId):
+        self.drive.calls['files.get_media'] += 1
+        return FakeMediaRequest(fileId)
+
+    def list(self, q, fields=None, pageSize=100, pageToken=None):
+        self.drive.calls['files.list'] += 1
+
+        mime_type = re.search(r"mimeType\s*=\s*'(?P<mime>[^']*)'", q).group('mime')
+        parent = re.search(r"'(?P<parent>[^']*)' in parents", q)
+
+        if parent is None:
+            candidates = self.drive.storage.values()
+        else:
+            candidates = [self.drive.storage[file_id] for file_id in self.drive.children.get(parent.group('parent'), [])]
+
+        matched = [
+            file for file in candidates
+            if file.get('mimeType') == mime_type and not file.get('trashed')
+        ]
+
+        start = int(pageToken) if pageToken else 0
+        page = matched[start:start + pageSize]
+        response = {'files': [self.drive.public(file) for file in page]}
+        if start + pageSize < len(matched):
+            response['nextPageToken'] = str(start + pageSize)
+        return FakeRequest(response)
+
+
+class FakeChanges:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def getStartPageToken(self):
+        self.drive.calls['changes.getStartPageToken'] += 1
+        return FakeRequest({'startPageToken': str(len(self.drive.change_log))})
+
+    def list(self, pageToken, pageSize=100, **kwargs):
+        self.drive.calls['changes.list'] += 1
+
+        start = int(pageToken)
+        page = self.drive.change_log[start:start + pageSize]
+        response = {'changes': page}
+        if start + pageSize < len(self.drive.change_log):
+            response['nextPageToken'] = str(start + pageSize)
+        else:
+            response['newStartPageToken'] = str(len(self.drive.change_log))
+        return FakeRequest(response)
+
+
+class FakeDrive:
+    """In-memory stand-in for the Drive v3 service, supporting the calls used by GoogleDriveHandler."""
+
+    def __init__(self, root_id='ROOT_ID', root_name='My Drive'):
+        self.root_id = root_id
+        self.storage = {root_id: {'id': root_id, 'name': root_name, 'mimeType': FOLDER_MIME_TYPE}}
+        self.children = {}
+        self.change_log = []
+        self.calls = {
+            'files.get': 0,
+            'files.get_media': 0,
+            'files.list': 0,
+            'changes.getStartPageToken': 0,
+            'changes.list': 0
+        }
+
+    def files(self):
+        return FakeFiles(self)
+
+    def changes(self):
+        return FakeChanges(self)
+
+    @staticmethod
+    def public(file):
+        return {key: value for key, value in file.items() if key not in ('mimeType', 'trashed')}
+
+    def add_folder(self, folder_id, name, parent_id=None):
+        self.storage[folder_id] = {
+            'id': folder_id,
+            'name': name,
+            'mimeType': FOLDER_MIME_TYPE,
+            'parents': [parent_id or self.root_id]
+        }
+        self.__log_change(folder_id)
+
+    def add_presentation(self, pres_id, name, parent_id=None, modified_time='2023-05-01T00:00:00.000Z'):
+        self.storage[pres_id] = {
+            'id': pres_id,
+            'name': name,
+            'mimeType': PRESENTATION_MIME_TYPE,
+            'modifiedTime': modified_time,
+            'parents': [parent_id or self.root_id]
+        }
+        self.__log_change(pres_id)
+
+    def update(self, file_id, **kwargs):
+        self.__unlink(file_id)
+        self.storage[file_id].update(kwargs)
+        self.__log_change(file_id)
+
+    def remove(self, file_id):
+        self.__unlink(file_id)
+        self.storage.pop(file_id)
+        self.change_log.append({'fileId': file_id, 'removed': True})
+
+    def reset_calls(self):
+        for key in self.calls:
+            self.calls[key] = 0
+
+    def __unlink(self, file_id):
+        for parent_id in self.storage[file_id].get('parents', []):
+            self.children[parent_id].remove(file_id)
+
+    def __log_change(self, file_id):
+        for parent_id in self.storage[file_id].get('parents', []):
+            self.children.setdefault(parent_id, []).append(file_id)
+        self.change_log.append({'fileId': file_id, 'removed': False, 'file': dict(self.storage[file_id])})
@@ -1,6 +1,7 @@
 import unittest
 
-from app.server.tests import test_database, test_presentation_processing
+from app.server.tests import test_database, test_presentation_processing, test_google_drive, test_utils, \
+    test_renderers, test_tag_query
 
 if __name__ == '__main__':
     loader = unittest.TestLoader()
@@ -9,4 +10,16 @@ if __name__ == '__main__':
     unittest.TextTestRunner(verbosity=2).run(db_suite)
 
     pres_processing_suite = loader.loadTestsFromModule(test_presentation_processing)
-    unittest.TextTestRunner(verbosity=2).run(pres_processing_suite)
\ No newline at end of file
+    unittest.TextTestRunner(verbosity=2).run(pres_processing_suite)
+
+    google_drive_suite = loader.loadTestsFromModule(test_google_drive)
+    unittest.TextTestRunner(verbosity=2).run(google_drive_suite)
+
+    utils_suite = loader.loadTestsFromModule(test_utils)
+    unittest.TextTestRunner(verbosity=2).run(utils_suite)
+
+    renderers_suite = loader.loadTestsFromModule(test_renderers)
+    unittest.TextTestRunner(verbosity=2).run(renderers_suite)
+
+    tag_query_suite = loader.loadTestsFromModule(test_tag_query)
+    unittest.TextTestRunner(verbosity=2).run(tag_query_suite)
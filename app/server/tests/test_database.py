@@ -3,19 +3,28 @@ import datetime
 import ntpath
 import os
 import shutil
+import threading
+import time
 import typing
 import unittest
 
+import cv2
+import numpy as np
+
 from app.server.main.utils.utils import clear_temp
+from app.server.main.utils.workspace import Workspace
 
 unittest.TestLoader.sortTestMethodsUsing = None
 
 from multiprocessing.pool import ThreadPool
 
 
+from sqlalchemy import LargeBinary, inspect, text
+
 from app.definitions import db_user, db_password, db_url, db_name, SERVER_ROOT
 from app.server.main.database.database_handler import DatabaseHandler, Users, Presentations, Slides, Tags, SlideLinks, \
-    Folders, PresentationLinks
+    Folders, PresentationLinks, SyncJobs, SyncJobItems
+from app.server.main.sync.sync_job_handler import SyncJobHandler
 
 
 class DatabaseTestCase(unittest.TestCase):
@@ -73,6 +82,31 @@ class DatabaseTestCase(unittest.TestCase):
         usernames = [user.name for user in users]
         assert 'TEST_USER' not in usernames
 
+    def test_unit_of_work(self):
+        user = self.create_test_user()
+
+        with self.db_handler.unit_of_work() as session:
+            _, tag = self.db_handler.create(Tags, name='TEST_TAG', owner_id=user.id)
+            # Nested operations join the enclosing transaction
+            with self.db_handler.unit_of_work() as nested_session:
+                assert nested_session is session
+                assert self.db_handler.find(Tags, Tags.name == 'TEST_TAG') is not None
+
+        # Objects stay usable after the unit of work is committed
+        assert tag.name == 'TEST_TAG'
+        assert self.db_handler.find(Tags, Tags.name == 'TEST_TAG') is not None
+
+        try:
+            with self.db_handler.unit_of_work():
+                self.db_handler.create(Tags, name='TEST_TAG_2', owner_id=user.id)
+                self.db_handler.delete(Tags, tag.id)
+                raise AttributeError("Rollback")
+        except AttributeError:
+            pass
+
+        assert self.db_handler.find(Tags, Tags.name == 'TEST_TAG_2') is None
+        assert self.db_handler.find(Tags, Tags.name == 'TEST_TAG') is not None
+
     def test_find_or_create(self):
         created, user = self.db_handler.find_or_create(
             Users,
@@ -134,7 +168,9 @@ class DatabaseTestCase(unittest.TestCase):
         assert 'pres_id' in slide_json and slide_json['pres_id'] == 'TEST_PRESENTATION_ID'
         assert 'index' in slide_json and slide_json['index'] == 0
         assert 'text' in slide_json and slide_json['text'] == 'SLIDE_TEXT'
-        assert 'thumbnail' in slide_json
+        assert 'thumbnail' in slide_json and slide_json['thumbnail'] == \
+               f'/slides/{slide.id}/thumbnail?size=full&v={slide.thumbnail_hash}'
+        assert 'thumbnails' in slide_json and set(slide_json['thumbnails']) == {'small', 'medium', 'full'}
         assert 'ratio' in slide_json and slide_json['ratio'] == Slides.Ratio.STANDARD_4_TO_3.value
 
     def test_get_slides_index_asc(self):
@@ -153,6 +189,69 @@ class DatabaseTestCase(unittest.TestCase):
         assert len(slides_index_asc) == 3
         assert slides_index_asc[0].index < slides_index_asc[1].index < slides_index_asc[2].index
 
+    def test_create_slides(self):
+        self.create_test_user()
+        self.create_pres_sample()
+
+        slides = [
+            {
+                'pres_id': 'TEST_PRESENTATION_ID',
+                'index': i,
+                'thumbnail': b'THUMBNAIL',
+                'text': f'SLIDE_TEXT_{i}',
+                'ratio': Slides.Ratio.STANDARD_4_TO_3
+            }
+            for i in (2, 0, 1)
+        ]
+        slide_ids = self.db_handler.create_slides(slides, batch_size=2)
+
+        assert len(slide_ids) == 3
+        for slide, slide_id in zip(slides, slide_ids):
+            assert self.db_handler.read(Slides, slide_id).text == slide.get('text')
+
+        slides_index_asc = self.db_handler.get_slides_index_asc('TEST_PRESENTATION_ID')
+        assert [slide.index for slide in slides_index_asc] == [0, 1, 2]
+        assert self.db_handler.create_slides([]) == []
+
+    def test_delete_unreferenced_thumbnails(self):
+        self.create_test_user()
+        self.create_pres_sample()
+
+        with open('files/slide_thumbnail_2.png', 'rb') as file:
+            thumbnail = file.read()
+        slide = self.create_slide_sample(index=0)
+        deleted_slide = self.create_slide_sample(index=1, thumbnail=thumbnail)
+        self.db_handler.delete(Slides, deleted_slide.id)
+
+        # Recently stored thumbnails may be referenced by slides which are not committed yet
+        assert self.db_handler.delete_unreferenced_thumbnails() == 0
+        assert self.db_handler.delete_unreferenced_thumbnails(grace_period=datetime.timedelta(hours=-1)) == 1
+        assert self.db_handler.thumbnail_store.get(deleted_slide.thumbnail_hash) is None
+        assert self.db_handler.thumbnail_store.get(slide.thumbnail_hash) is not None
+
+    def test_drop_legacy_thumbnails(self):
+        self.create_test_user()
+        self.create_pres_sample()
+
+        with open('files/slide_thumbnail_2.png', 'rb') as file:
+            thumbnail = file.read()
+        slide = self.create_slide_sample(index=0, thumbnail=thumbnail)
+        assert not self.db_handler.drop_legacy_thumbnails()
+
+        column_type = LargeBinary().compile(dialect=self.db_handler.engine.dialect)
+        with self.db_handler.engine.begin() as connection:
+            connection.execute(text(f'ALTER TABLE slides ADD COLUMN thumbnail {column_type}'))
+
+        # Column is kept while thumbnails of slides are missing in the store
+        os.remove(self.db_handler.thumbnail_store.get_path(slide.thumbnail_hash))
+        with self.assertRaises(AttributeError):
+            self.db_handler.drop_legacy_thumbnails()
+        assert 'thumbnail' in [column['name'] for column in inspect(self.db_handler.engine).get_columns('slides')]
+
+        self.db_handler.thumbnail_store.put(thumbnail)
+        assert self.db_handler.drop_legacy_thumbnails()
+        assert 'thumbnail' not in [column['name'] for column in inspect(self.db_handler.engine).get_columns('slides')]
+
     def test_get_links_and_tags(self):
         self.create_test_user()
 
@@ -244,6 +343,22 @@ class DatabaseTestCase(unittest.TestCase):
         assert none_slide_thumb is None
 
 
+    def test_get_slide_thumbnail_hash(self):
+        user = self.create_test_user()
+        self.create_pres_sample()
+
+        with open('files/slide_thumbnail_1.png', 'rb') as file:
+            thumbnail = file.read()
+        slide = self.create_slide_sample(index=0, thumbnail=thumbnail)
+
+        thumbnail_hash = self.db_handler.get_slide_thumbnail_hash(slide.id, user.id)
+        assert thumbnail_hash == slide.thumbnail_hash
+        assert self.db_handler.thumbnail_store.get(thumbnail_hash) == thumbnail
+
+        assert self.db_handler.get_slide_thumbnail_hash(slide.id, 'NOT_EXISTING_USER_ID') is None
+        assert self.db_handler.get_slide_thumbnail_hash(-1, user.id) is None
+
+
     def test_sync_folders(self):
         user = self.create_test_user()
 
@@ -280,6 +395,30 @@ class DatabaseTestCase(unittest.TestCase):
         for db_folder in db_folders:
             assert folder1.get('id') != db_folder.id
 
+    def test_sync_folders_update(self):
+        user = self.create_test_user()
+
+        folder1 = {'id': 'TEST_FOLDER_1_ID', 'name': 'TEST_FOLDER_1_NAME'}
+        folder2 = {'id': 'TEST_FOLDER_2_ID', 'name': 'TEST_FOLDER_2_NAME', 'parents': ['TEST_FOLDER_1_ID']}
+
+        synced_folders = self.db_handler.sync_folders(user.id, [folder1, folder2])
+        assert [folder.id for folder in synced_folders] == [folder1.get('id'), folder2.get('id')]
+        assert self.db_handler.read(Folders, folder2.get('id')).parent == folder1.get('id')
+
+        self.db_handler.set_folder_mark(user.id, folder2.get('id'), True)
+
+        # Renamed and moved folder keeps its mark
+        folder2 = {'id': 'TEST_FOLDER_2_ID', 'name': 'TEST_FOLDER_2_RENAMED', 'parents': ['TEST_FOLDER_3_ID']}
+        synced_folders = self.db_handler.sync_folders(user.id, [folder1, folder2])
+
+        db_folder2 = [folder for folder in synced_folders if folder.id == folder2.get('id')][0]
+        assert db_folder2.name == 'TEST_FOLDER_2_RENAMED'
+        assert db_folder2.parent == 'TEST_FOLDER_3_ID'
+        assert db_folder2.mark
+
+        assert self.db_handler.sync_folders(user.id, []) == []
+        assert self.db_handler.findall(Folders, Folders.owner_id == user.id) == []
+
     def test_sync_presentations(self):
         user = self.create_test_user()
 
@@ -338,6 +477,29 @@ class DatabaseTestCase(unittest.TestCase):
                 break
         assert not found
 
+    def test_sync_presentations_unchanged(self):
+        user = self.create_test_user()
+
+        presentation1 = {
+            'id': 'TEST_PRESENTATION_1_ID',
+            'name': 'TEST_PRESENTATION_1_NAME',
+            'modifiedTime': '2023-05-01T00:00:00.000Z'
+        }
+        presentation2 = {
+            'id': 'TEST_PRESENTATION_2_ID',
+            'name': 'TEST_PRESENTATION_2_NAME',
+            'modifiedTime': '2023-05-01T00:00:00.000Z'
+        }
+        self.db_handler.sync_presentations(user.id, [presentation1, presentation2])
+
+        # Renamed presentation is not synced again, only its name is updated
+        presentation1 = dict(presentation1, name='TEST_PRESENTATION_1_RENAMED')
+        synced, (created, modified) = self.db_handler.sync_presentations(user.id, [presentation1, presentation2])
+
+        assert [pres.get('id') for pres in synced] == [presentation1.get('id'), presentation2.get('id')]
+        assert created == [] and modified == []
+        assert self.db_handler.read(Presentations, presentation1.get('id')).name == 'TEST_PRESENTATION_1_RENAMED'
+
     def test_sync_presentation_slides(self):
         user = self.create_test_user()
 
@@ -449,6 +611,254 @@ class DatabaseTestCase(unittest.TestCase):
         finally:
             clear_temp()
 
+    def test_sync_presentation_slides_duplicates(self):
+        user = self.create_test_user()
+
+        with Workspace() as workspace:
+            presentation = {
+                'id': 'TEST_PRESENTATION_ID',
+                'name': 'TEST_PRESENTATION_NAME',
+                'modifiedTime': '2023-05-01T00:00:00.0Z'
+            }
+            synced, delta = self.db_handler.sync_presentations(user.id, [presentation])
+
+            os.makedirs(workspace.images_dir(presentation.get('id')))
+            for i, thumbnail in enumerate([1, 2, 1]):
+                shutil.copyfile(f'files/slide_thumbnail_{thumbnail}.png', workspace.image_path(presentation.get('id'), i))
+            self.db_handler.sync_presentation_slides(synced, delta, [Slides.Ratio.STANDARD_4_TO_3],
+                                                     [['COPY 1', 'OTHER', 'COPY 2']], user.id, workspace)
+            old_slides = {slide.text: slide.id for slide in self.db_handler.get_slides_index_asc(presentation.get('id'))}
+
+            presentation = dict(presentation, modifiedTime='2023-05-02T00:00:00.0Z')
+            synced, delta = self.db_handler.sync_presentations(user.id, [presentation])
+
+            # Copies swapped places, one more copy added
+            shutil.rmtree(workspace.images_dir(presentation.get('id')))
+            os.makedirs(workspace.images_dir(presentation.get('id')))
+            for i, thumbnail in enumerate([1, 1, 2, 1]):
+                shutil.copyfile(f'files/slide_thumbnail_{thumbnail}.png', workspace.image_path(presentation.get('id'), i))
+
+            # Thumbnails are encoded before the transaction is opened
+            put = self.db_handler.thumbnail_store.put
+            put_in_transaction = []
+
+            def store_thumbnail(data, pyramid=True):
+                put_in_transaction.append(self.db_handler.in_unit_of_work())
+                return put(data, pyramid)
+
+            self.db_handler.thumbnail_store.put = store_thumbnail
+            try:
+                self.db_handler.sync_presentation_slides(synced, delta, [Slides.Ratio.STANDARD_4_TO_3],
+                                                         [['COPY 2', 'COPY 1', 'OTHER', 'COPY 3']], user.id, workspace)
+            finally:
+                del self.db_handler.thumbnail_store.put
+            assert len(put_in_transaction) > 0 and not any(put_in_transaction)
+
+            pres_slides = self.db_handler.get_slides_index_asc(presentation.get('id'))
+            assert [slide.index for slide in pres_slides] == [0, 1, 2, 3]
+            assert [slide.text for slide in pres_slides] == ['COPY 2', 'COPY 1', 'OTHER', 'COPY 3']
+            assert pres_slides[0].id == old_slides['COPY 2']
+            assert pres_slides[1].id == old_slides['COPY 1']
+            assert pres_slides[2].id == old_slides['OTHER']
+            assert pres_slides[3].id not in old_slides.values()
+
+    def test_sync_presentation_slides_text_changed(self):
+        user = self.create_test_user()
+
+        def create_slide_image(title):
+            # Slides on the same template differing only in title have close fingerprints
+            image = np.full((540, 960, 3), 255, np.uint8)
+            cv2.rectangle(image, (0, 0), (960, 60), (120, 60, 20), -1)
+            cv2.putText(image, title, (60, 160), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 0), 3)
+            for i, line in enumerate(['Goals of the project', 'Team and schedule']):
+                cv2.putText(image, line, (80, 260 + 50 * i), cv2.FONT_HERSHEY_SIMPLEX, 1, (40, 40, 40), 2)
+            return cv2.imencode('.png', image)[1].tobytes()
+
+        with Workspace() as workspace:
+            presentation = {
+                'id': 'TEST_PRESENTATION_ID',
+                'name': 'TEST_PRESENTATION_NAME',
+                'modifiedTime': '2023-05-01T00:00:00.0Z'
+            }
+            os.makedirs(workspace.images_dir(presentation.get('id')))
+
+            for modified_time, title in (('2023-05-01T00:00:00.0Z', 'Introduction'),
+                                         ('2023-05-02T00:00:00.0Z', 'Conclusion')):
+                presentation = dict(presentation, modifiedTime=modified_time)
+                synced, delta = self.db_handler.sync_presentations(user.id, [presentation])
+                with open(workspace.image_path(presentation.get('id'), 0), 'wb') as file:
+                    file.write(create_slide_image(title))
+                self.db_handler.sync_presentation_slides(synced, delta, [Slides.Ratio.WIDESCREEN_16_TO_9],
+                                                         [[title]], user.id, workspace)
+                if title == 'Introduction':
+                    old_slide = self.db_handler.get_slides_index_asc(presentation.get('id'))[0]
+                    self.db_handler.create_slide_link(old_slide.id, 'TEST_TAG', None, user.id)
+
+            # Replaced slide is a new slide, it does not take over the old one with its tags
+            pres_slides = self.db_handler.get_slides_index_asc(presentation.get('id'))
+            assert len(pres_slides) == 1
+            assert pres_slides[0].text == 'Conclusion'
+            assert self.db_handler.get_slide_links(pres_slides[0].id, user.id) == []
+
+    def test_sync_jobs(self):
+        user = self.create_test_user()
+
+        status = self.db_handler.get_sync_status(user.id)
+        assert status.get('job') is None
+        assert not status.get('active')
+
+        job = self.db_handler.create_sync_job(user.id)
+        assert self.db_handler.get_active_sync_job(user.id).id == job.id
+
+        presentation1 = {'id': 'TEST_PRESENTATION_1_ID', 'name': 'TEST_PRESENTATION_1_NAME'}
+        presentation2 = {'id': 'TEST_PRESENTATION_2_ID', 'name': 'TEST_PRESENTATION_2_NAME'}
+        presentation3 = {'id': 'TEST_PRESENTATION_3_ID', 'name': 'TEST_PRESENTATION_3_NAME'}
+        self.db_handler.set_sync_job_state(job.id, SyncJobs.State.RUNNING)
+        self.db_handler.add_sync_job_items(
+            job.id, [presentation1, presentation2, presentation3], ([presentation1], [presentation2]))
+        self.db_handler.set_sync_job_item_state(job.id, presentation1.get('id'), SyncJobItems.State.RENDERING)
+
+        status = self.db_handler.get_sync_status(user.id)
+        assert status.get('active')
+        assert [pres.get('id') for pres in status.get('created')] == [presentation1.get('id')]
+        assert [pres.get('id') for pres in status.get('modified')] == [presentation2.get('id')]
+        assert [pres.get('state') for pres in status.get('presentations')] == ['rendering', 'queued', 'done']
+
+        self.db_handler.set_sync_job_item_state(job.id, presentation1.get('id'), SyncJobItems.State.DONE)
+        self.db_handler.fail_unfinished_sync_jobs('Server was restarted')
+
+        status = self.db_handler.get_sync_status(user.id)
+        assert not status.get('active')
+        assert status.get('job').get('state') == 'failed'
+        assert status.get('created') == [] and status.get('modified') == []
+        assert [pres.get('state') for pres in status.get('presentations')] == ['done', 'failed', 'done']
+        assert self.db_handler.get_active_sync_job(user.id) is None
+
+    def test_sync_job_failed_presentation(self):
+        user = self.create_test_user()
+
+        class FakeDriveHandler:
+            def reset_download_progress(self, user_id):
+                pass
+
+            def download_presentations(self, presentations, user_flow, user_id, workspace=None, reset_progress=True):
+                pass
+
+        class FailingPresHandler:
+            def crop_presentations(self, presentations, workspace=None):
+                raise RuntimeError('Rendering failed')
+
+        presentation1 = {
+            'id': 'TEST_PRESENTATION_1_ID',
+            'name': 'TEST_PRESENTATION_1_NAME',
+            'modifiedTime': '2023-05-01T00:00:00.0Z'
+        }
+        self.db_handler.sync_presentations(user.id, [presentation1])
+
+        presentation1 = dict(presentation1, modifiedTime='2023-05-02T00:00:00.0Z')
+        presentation2 = {
+            'id': 'TEST_PRESENTATION_2_ID',
+            'name': 'TEST_PRESENTATION_2_NAME',
+            'modifiedTime': '2023-05-02T00:00:00.0Z'
+        }
+
+        sync_job_handler = SyncJobHandler(self.db_handler, FakeDriveHandler(), FailingPresHandler(), workers=1)
+        try:
+            sync_job_handler.enqueue(user.id, None, [presentation1, presentation2])
+            for _ in range(100):
+                if not sync_job_handler.get_sync_status(user.id).get('active'):
+                    break
+                time.sleep(0.1)
+
+            status = sync_job_handler.get_sync_status(user.id)
+            assert not status.get('active')
+            assert [pres.get('state') for pres in status.get('presentations')] == ['failed', 'failed']
+            assert 'image_cache' not in status
+        finally:
+            sync_job_handler.close()
+
+        # Failed presentations are left as before the job, so the next sync retries them
+        assert self.db_handler.read(Presentations, presentation1.get('id')).modified_time == \
+               datetime.datetime.fromisoformat('2023-05-01')
+        assert self.db_handler.read(Presentations, presentation2.get('id')) is None
+
+        synced, (created, modified) = self.db_handler.sync_presentations(user.id, [presentation1, presentation2])
+        assert created == [presentation2]
+        assert modified == [presentation1]
+
+    def test_sync_job_follow_up(self):
+        user = self.create_test_user()
+        started = threading.Event()
+        release = threading.Event()
+
+        class BlockingDriveHandler:
+            def reset_download_progress(self, user_id):
+                started.set()
+                release.wait(10)
+
+            def download_presentations(self, presentations, user_flow, user_id, workspace=None, reset_progress=True):
+                pass
+
+        class FakePresHandler:
+            def crop_presentations(self, presentations, workspace=None):
+                return [Slides.Ratio.STANDARD_4_TO_3]
+
+            def extract_text(self, presentations, workspace=None):
+                return [[]]
+
+        presentation1 = {
+            'id': 'TEST_PRESENTATION_1_ID',
+            'name': 'TEST_PRESENTATION_1_NAME',
+            'modifiedTime': '2023-05-01T00:00:00.0Z'
+        }
+        presentation2 = dict(presentation1, id='TEST_PRESENTATION_2_ID', name='TEST_PRESENTATION_2_NAME')
+
+        sync_job_handler = SyncJobHandler(self.db_handler, BlockingDriveHandler(), FakePresHandler(), workers=2)
+        try:
+            job1 = sync_job_handler.enqueue(user.id, None, [presentation1])
+            assert started.wait(10)
+
+            # Requests made during a running job are merged into one follow-up job
+            job2 = sync_job_handler.enqueue(user.id, None, [presentation1])
+            assert sync_job_handler.enqueue(user.id, None, [presentation1, presentation2]).id == job2.id
+            assert job2.id != job1.id
+            assert sync_job_handler.get_sync_status(user.id).get('job').get('id') == job1.id
+
+            release.set()
+            for _ in range(100):
+                if not sync_job_handler.get_sync_status(user.id).get('active'):
+                    break
+                time.sleep(0.1)
+
+            status = sync_job_handler.get_sync_status(user.id)
+            assert status.get('job').get('id') == job2.id
+            assert status.get('job').get('state') == 'done'
+            assert [pres.get('id') for pres in status.get('presentations')] == \
+                   [presentation1.get('id'), presentation2.get('id')]
+        finally:
+            release.set()
+            sync_job_handler.close()
+
+    def test_delete_finished_sync_jobs(self):
+        user = self.create_test_user()
+        presentation = {'id': 'TEST_PRESENTATION_ID', 'name': 'TEST_PRESENTATION_NAME'}
+
+        jobs = []
+        for _ in range(3):
+            job = self.db_handler.create_sync_job(user.id)
+            self.db_handler.add_sync_job_items(job.id, [presentation], ([], []))
+            self.db_handler.set_sync_job_state(job.id, SyncJobs.State.DONE)
+            jobs.append(job)
+
+        self.db_handler.delete_finished_sync_jobs(datetime.datetime.utcnow() - datetime.timedelta(days=1))
+        assert len(self.db_handler.findall(SyncJobs)) == 3
+
+        # Last job of the user is kept for its status
+        self.db_handler.delete_finished_sync_jobs(datetime.datetime.utcnow() + datetime.timedelta(seconds=1))
+        assert [job.id for job in self.db_handler.findall(SyncJobs)] == [jobs[-1].id]
+        assert [item.job_id for item in self.db_handler.findall(SyncJobItems)] == [jobs[-1].id]
+        assert self.db_handler.get_sync_status(user.id).get('job').get('id') == jobs[-1].id
+
     def test_set_folder_mark(self):
         user = self.create_test_user()
 
@@ -867,6 +1277,73 @@ class DatabaseTestCase(unittest.TestCase):
         )
         assert len(found_slides) == 0
         
+    def test_get_slides_by_filters_paged(self):
+        user = self.create_test_user()
+        pres = self.create_pres_sample(name='TEST_PRESENTATION')
+
+        slides = [self.create_slide_sample(index=i, text=f'50% off {i}') for i in range(5)]
+        self.create_slide_sample(index=5, text='500 off')
+
+        found_slides = self.db_handler.get_slides_by_filters(
+            presentations=[pres],
+            tag_query='',
+            text_phrase='50%',
+            ratio='auto',
+            user_id=user.id,
+            offset=2,
+            limit=2
+        )
+        assert [slide.get('id') for slide in found_slides] == [slides[2].id, slides[3].id]
+        assert found_slides[0].get('label') == 'TEST_PRESENTATION 3'
+
+    def test_get_slides_by_filters_text_search(self):
+        user = self.create_test_user()
+        pres = self.create_pres_sample()
+
+        slide1 = self.create_slide_sample(index=0, text='План презентации')
+        slide2 = self.create_slide_sample(index=1, text='Презентация: презентация проекта')
+        self.create_slide_sample(index=2, text='Slide without the phrase')
+
+        found_slides = self.db_handler.get_slides_by_filters(
+            presentations=[pres],
+            tag_query='',
+            text_phrase='презентация',
+            ratio='auto',
+            user_id=user.id
+        )
+
+        # Stemmed match is found, slides with more occurrences are ranked higher
+        assert [slide.get('id') for slide in found_slides] == [slide2.id, slide1.id]
+        assert found_slides[0].get('highlights') == [[0, 11], [13, 24]]
+        assert found_slides[1].get('highlights') == [[5, 16]]
+
+    def test_get_slides_by_filters_text_search_substring(self):
+        user = self.create_test_user()
+        pres = self.create_pres_sample()
+
+        slide1 = self.create_slide_sample(index=0, text='İstanbul: проект')
+        slide2 = self.create_slide_sample(index=1, text='Проект: план проекта')
+        self.create_slide_sample(index=2, text='Slide without the phrase')
+
+        # Databases without pg_trgm are matched by substring, slides keep their order
+        text_search_indexed = self.db_handler.text_search_indexed
+        self.db_handler.text_search_indexed = False
+        try:
+            found_slides = self.db_handler.get_slides_by_filters(
+                presentations=[pres],
+                tag_query='',
+                text_phrase='проект',
+                ratio='auto',
+                user_id=user.id
+            )
+        finally:
+            self.db_handler.text_search_indexed = text_search_indexed
+
+        assert [slide.get('id') for slide in found_slides] == [slide1.id, slide2.id]
+        # Offsets point into the original text, even where lowering it changes its length
+        assert found_slides[0].get('highlights') == [[10, 16]]
+        assert found_slides[1].get('highlights') == [[0, 6], [13, 19]]
+
     def test_pres_sync_uploaded(self):
         user = self.create_test_user()
         
@@ -940,7 +1417,7 @@ class DatabaseTestCase(unittest.TestCase):
             }
             
             pres_text = [slide1.text, slide2.text, slide3.text]
-            pres_thumbs = [slide1.thumbnail, slide2.thumbnail, slide3.thumbnail]
+            pres_thumbs = [slide1_thumb, slide2_thumb, slide3_thumb]
             ratio = 'standard_4_to_3'
             slides_from = [slide1, slide2, slide3]
             
@@ -955,7 +1432,7 @@ class DatabaseTestCase(unittest.TestCase):
             db_slide3 = new_pres_slides[2]
             
             assert slide1.text == db_slide1.text
-            assert slide1.thumbnail == db_slide1.thumbnail
+            assert slide1.thumbnail_hash == db_slide1.thumbnail_hash
             
             slide1_links = self.db_handler.get_slide_links(slide1.id, user.id)
             db_slide1_links = self.db_handler.get_slide_links(db_slide1.id, user.id)
@@ -970,7 +1447,7 @@ class DatabaseTestCase(unittest.TestCase):
                 assert found
 
             assert slide2.text == db_slide2.text
-            assert slide2.thumbnail == db_slide2.thumbnail
+            assert slide2.thumbnail_hash == db_slide2.thumbnail_hash
 
             slide2_links = self.db_handler.get_slide_links(slide2.id, user.id)
             db_slide2_links = self.db_handler.get_slide_links(db_slide2.id, user.id)
@@ -985,7 +1462,7 @@ class DatabaseTestCase(unittest.TestCase):
                 assert found
 
             assert slide3.text == db_slide3.text
-            assert slide3.thumbnail == db_slide3.thumbnail
+            assert slide3.thumbnail_hash == db_slide3.thumbnail_hash
 
             slide3_links = self.db_handler.get_slide_links(slide3.id, user.id)
             db_slide3_links = self.db_handler.get_slide_links(db_slide3.id, user.id)
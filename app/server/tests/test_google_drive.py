@@ -0,0 +1,148 @@
+import os
+import shutil
+import unittest
+from multiprocessing.pool import ThreadPool
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from app.definitions import SERVER_ROOT
+from app.server.main.external_services.google.google_drive_handler import GoogleDriveHandler
+from app.server.main.utils.workspace import Workspace
+from app.server.tests.fake_drive import FakeDrive
+
+
+class FailingCredentials:
+    """Credentials whose requests fail with given error after the download is started."""
+
+    def __init__(self, error=None):
+        self.error = error or ConnectionResetError('Connection reset by peer')
+
+    def before_request(self, request, method, url, headers):
+        raise self.error
+
+
+class FakeUserFlow:
+    def __init__(self, credentials):
+        self.credentials = credentials
+
+
+class GoogleDriveTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = ThreadPool(processes=20)
+        cls.state_path = os.path.join(SERVER_ROOT, 'external_services/google/test_drive_state')
+
+    def setUp(self):
+        self.drive = FakeDrive()
+        self.drive_handler = GoogleDriveHandler(
+            pool=self.pool,
+            state_path=self.state_path,
+            build_drive_service=lambda user_flow: self.drive
+        )
+
+    def tearDown(self):
+        self.drive_handler.close()
+        if os.path.exists(self.state_path):
+            shutil.rmtree(self.state_path)
+
+    def test_get_user_file_tree(self):
+        self.drive.add_folder('FOLDER_1_ID', 'FOLDER_1')
+        self.drive.add_folder('FOLDER_2_ID', 'FOLDER_2', parent_id='FOLDER_1_ID')
+        self.drive.add_presentation('PRES_1_ID', 'PRES_1')
+        self.drive.add_presentation('PRES_2_ID', 'PRES_2', parent_id='FOLDER_2_ID')
+
+        folders, presentations, file_tree = self.drive_handler.get_user_file_tree(None)
+
+        assert file_tree.get('id') == 'ROOT_ID'
+        assert file_tree.get('type') == 'folder'
+        assert sorted(folder.get('id') for folder in folders) == ['FOLDER_1_ID', 'FOLDER_2_ID', 'ROOT_ID']
+        assert sorted(pres.get('id') for pres in presentations) == ['PRES_1_ID', 'PRES_2_ID']
+
+        root_children = {child.get('id'): child for child in file_tree.get('children')}
+        assert root_children['PRES_1_ID'].get('type') == 'presentation'
+
+        folder1 = root_children['FOLDER_1_ID']
+        folder2 = folder1.get('children')[0]
+        assert folder2.get('id') == 'FOLDER_2_ID'
+        assert folder2.get('children')[0].get('id') == 'PRES_2_ID'
+
+    def test_get_user_file_tree_paginated(self):
+        for i in range(30):
+            self.drive.add_folder(f'FOLDER_{i}_ID', f'FOLDER_{i}', parent_id=f'FOLDER_{i - 1}_ID' if i else None)
+        for i in range(2500):
+            self.drive.add_presentation(f'PRES_{i}_ID', f'PRES_{i}', parent_id=f'FOLDER_{i % 30}_ID')
+
+        folders, presentations, file_tree = self.drive_handler.get_user_file_tree(None)
+
+        assert len(folders) == 31
+        assert len(presentations) == 2500
+        # Folders and presentations are listed in bulk, not once per folder
+        assert self.drive.calls['files.list'] == 1 + 3
+
+    def test_get_user_file_tree_incremental(self):
+        self.drive.add_folder('FOLDER_1_ID', 'FOLDER_1')
+        self.drive.add_folder('FOLDER_2_ID', 'FOLDER_2')
+        self.drive.add_presentation('PRES_1_ID', 'PRES_1', parent_id='FOLDER_1_ID')
+        self.drive.add_presentation('PRES_2_ID', 'PRES_2', parent_id='FOLDER_2_ID')
+
+        self.drive_handler.get_user_file_tree(None, 'TEST_USER_ID')
+
+        self.drive.reset_calls()
+        self.drive.add_presentation('PRES_3_ID', 'PRES_3', parent_id='FOLDER_2_ID')
+        self.drive.update('PRES_1_ID', name='PRES_1_RENAMED', parents=['FOLDER_2_ID'])
+        self.drive.remove('FOLDER_1_ID')
+        self.drive.update('PRES_2_ID', trashed=True)
+
+        folders, presentations, file_tree = self.drive_handler.get_user_file_tree(None, 'TEST_USER_ID')
+
+        # Only the changes feed is read, the drive is not listed again
+        assert self.drive.calls['files.list'] == 0
+        assert self.drive.calls['changes.list'] == 1
+
+        assert sorted(folder.get('id') for folder in folders) == ['FOLDER_2_ID', 'ROOT_ID']
+        assert sorted(pres.get('name') for pres in presentations) == ['PRES_1_RENAMED', 'PRES_3']
+
+        # Annotating returned tree does not leak into the persisted state
+        file_tree['is_root'] = True
+        self.drive.reset_calls()
+        _, _, file_tree = self.drive_handler.get_user_file_tree(None, 'TEST_USER_ID')
+        assert 'is_root' not in file_tree
+        assert self.drive.calls['files.list'] == 0
+
+    def test_download_presentations_failed(self):
+        self.drive.add_presentation('PRES_1_ID', 'PRES_1')
+        self.drive.add_presentation('PRES_2_ID', 'PRES_2')
+        presentations = [self.drive.public(self.drive.storage[pres_id]) for pres_id in ('PRES_1_ID', 'PRES_2_ID')]
+
+        with Workspace() as workspace:
+            with self.assertRaises(ConnectionResetError):
+                self.drive_handler.download_presentations(
+                    presentations, FakeUserFlow(FailingCredentials()), 'TEST_USER_ID', workspace
+                )
+
+            # Failed download leaves neither a partial deck nor its part file
+            assert self.drive.calls['files.get_media'] > 0
+            for pres_id in ('PRES_1_ID', 'PRES_2_ID'):
+                assert os.listdir(workspace.presentation_dir(pres_id)) == []
+
+    def test_download_presentations_http_error(self):
+        self.drive.add_presentation('PRES_1_ID', 'PRES_1')
+        presentations = [self.drive.public(self.drive.storage['PRES_1_ID'])]
+        error = HttpError(httplib2.Response({'status': 404}), b'File not found')
+
+        with Workspace() as workspace:
+            # Callers don't go on to render a presentation which is not downloaded
+            with self.assertRaises(HttpError):
+                self.drive_handler.download_presentations(
+                    presentations, FakeUserFlow(FailingCredentials(error)), 'TEST_USER_ID', workspace
+                )
+            assert os.listdir(workspace.presentation_dir('PRES_1_ID')) == []
+
+        progress, = self.drive_handler.get_download_progress('TEST_USER_ID')
+        assert progress['id'] == 'PRES_1_ID' and not progress['done'] and 'File not found' in progress['error']
+
+
+if __name__ == '__main__':
+    unittest.main()
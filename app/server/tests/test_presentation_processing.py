@@ -4,14 +4,14 @@ import shutil
 import unittest
 from multiprocessing.pool import ThreadPool
 
-import pythoncom
-import win32com.client
 from aspose import slides
 
 from app.definitions import SERVER_ROOT, db_user, db_password, db_url, db_name
 from app.server.main.database.database_handler import Slides, DatabaseHandler, Users, Presentations
 from app.server.main.presentation_processing.presentation_process_handler import PresentationProcessHandler
+from app.server.main.presentation_processing.renderers import LibreOfficeRenderer
 from app.server.main.utils.utils import clear_temp, clear_styles, clear_user_built
+from app.server.main.utils.workspace import Workspace
 
 
 class PresentationProcessingTestCase(unittest.TestCase):
@@ -70,12 +70,11 @@ class PresentationProcessingTestCase(unittest.TestCase):
                 os.mkdir(pres3_path)
             shutil.copyfile('files/pres3id.pptx', os.path.join(pres3_path, 'pres3id.pptx'))
 
-            pythoncom.CoInitializeEx(0)
-            ApplicationPPTX = win32com.client.Dispatch("PowerPoint.Application")
+            renderer_session = self.pres_handler.renderer.open_session()
 
-            ratio1 = self.pres_handler.crop_presentation(presentation1, ApplicationPPTX)
-            ratio2 = self.pres_handler.crop_presentation(presentation2, ApplicationPPTX)
-            ratio3 = self.pres_handler.crop_presentation(presentation3, ApplicationPPTX)
+            ratio1 = self.pres_handler.crop_presentation(presentation1, renderer_session)
+            ratio2 = self.pres_handler.crop_presentation(presentation2, renderer_session)
+            ratio3 = self.pres_handler.crop_presentation(presentation3, renderer_session)
 
             assert len(os.listdir(os.path.join(pres1_path, 'images'))) == 2
             assert ratio1 == Slides.Ratio.WIDESCREEN_16_TO_9
@@ -84,11 +83,28 @@ class PresentationProcessingTestCase(unittest.TestCase):
             assert len(os.listdir(os.path.join(pres3_path, 'images'))) == 2
             assert ratio3 == Slides.Ratio.STANDARD_4_TO_3
 
-            ApplicationPPTX.Quit()
-            ApplicationPPTX = None
+            renderer_session.close()
         finally:
             clear_temp()
 
+    @unittest.skipIf(shutil.which('soffice') is None or shutil.which('pdftoppm') is None,
+                     'LibreOffice or poppler-utils is not installed')
+    def test_crop_presentations_libreoffice(self):
+        pres_handler = PresentationProcessHandler(self.pres_handler.pool, renderer=LibreOfficeRenderer(workers=2))
+        with Workspace() as workspace:
+            presentations = [{'id': 'pres1id'}, {'id': 'pres3id'}]
+            for presentation in presentations:
+                shutil.copyfile(f'files/{presentation.get("id")}.pptx',
+                                workspace.presentation_path(presentation.get('id')))
+
+            ratio1, ratio3 = pres_handler.crop_presentations(presentations, workspace)
+
+            assert len(os.listdir(workspace.images_dir('pres1id'))) == 2
+            assert os.path.exists(workspace.image_path('pres1id', 1))
+            assert ratio1 == Slides.Ratio.WIDESCREEN_16_TO_9
+            assert len(os.listdir(workspace.images_dir('pres3id'))) == 2
+            assert ratio3 == Slides.Ratio.STANDARD_4_TO_3
+
     def test_extract_text(self):
         try:
             temp_path = os.path.join(SERVER_ROOT, 'presentation_processing/temp')
@@ -183,23 +199,21 @@ class PresentationProcessingTestCase(unittest.TestCase):
             if not os.path.exists(style_path):
                 os.mkdir(style_path)
 
-            pythoncom.CoInitializeEx(0)
-            ApplicationPPTX = win32com.client.Dispatch("PowerPoint.Application")
+            renderer_session = self.pres_handler.renderer.open_session()
 
-            style_template_1 = self.pres_handler.create_style_template(presentation1, ApplicationPPTX)
+            style_template_1 = self.pres_handler.create_style_template(presentation1, renderer_session)
             assert style_template_1 is not None
             assert style_template_1.get('id') == presentation1.get('id')
 
-            style_template_2 = self.pres_handler.create_style_template(presentation2, ApplicationPPTX)
+            style_template_2 = self.pres_handler.create_style_template(presentation2, renderer_session)
             assert style_template_2 is not None
             assert style_template_2.get('id') == presentation2.get('id')
 
-            style_template_3 = self.pres_handler.create_style_template(presentation3, ApplicationPPTX)
+            style_template_3 = self.pres_handler.create_style_template(presentation3, renderer_session)
             assert style_template_3 is not None
             assert style_template_3.get('id') == presentation3.get('id')
 
-            ApplicationPPTX.Quit()
-            ApplicationPPTX = None
+            renderer_session.close()
 
         finally:
             clear_temp()
@@ -253,11 +267,13 @@ class PresentationProcessingTestCase(unittest.TestCase):
             pres2_slides = self.db_handler.get_slides_index_asc(presentation2.get('id'))
 
             name = 'NEW_PRESENTATION'
-            slides_from = [*pres1_slides, *pres2_slides]
             ratio = Slides.Ratio.STANDARD_4_TO_3
             style_template = None
 
-            self.pres_handler.build_presentation(name, slides_from, ratio, style_template, self.db_handler, user.id)
+            # Repeated slide is built once
+            slides_from = [*pres1_slides, *pres2_slides, pres1_slides[0]]
+            seen_text, seen_thumbs, seen_slides = self.pres_handler.build_presentation(
+                name, slides_from, ratio, style_template, self.db_handler, user.id)
 
             pres_path = os.path.join(SERVER_ROOT, f"presentation_processing/built/{user.id}/{name}.pptx")
             assert os.path.exists(pres_path)
@@ -265,6 +281,9 @@ class PresentationProcessingTestCase(unittest.TestCase):
             with slides.Presentation(pres_path) as new_pres:
                 assert len(new_pres.slides) == 4
 
+            assert [slide.id for slide in seen_slides] == [slide.id for slide in slides_from[:4]]
+            assert len(seen_text) == len(seen_thumbs) == 4
+
         finally:
             clear_temp()
             clear_user_built(user.id)
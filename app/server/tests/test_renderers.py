@@ -0,0 +1,128 @@
+import threading
+import time
+import unittest
+from concurrent import futures
+
+from app.server.main.presentation_processing.renderers import Renderer, RendererSession, RendererPool, \
+    LibreOfficeRenderer
+
+
+class FakeSession(RendererSession):
+
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.alive = True
+        self.thread = None
+
+    def warm_up(self):
+        self.renderer.warmed_up += 1
+
+    def is_alive(self):
+        return self.alive
+
+    def export(self, pres_path, img_dir):
+        # Session must only be used by the worker thread which opened it
+        self.thread = self.thread or threading.current_thread()
+        assert self.thread is threading.current_thread()
+        if pres_path == 'broken.pptx':
+            self.alive = False
+            raise AttributeError("Renderer crashed")
+        if pres_path == 'slow.pptx':
+            self.renderer.release.wait(10)
+        return 16, 9
+
+    def close(self):
+        self.renderer.closed += 1
+
+
+class FakeRenderer(Renderer):
+
+    def __init__(self, workers=1):
+        super().__init__(workers)
+        self.sessions = []
+        self.warmed_up = 0
+        self.closed = 0
+        self.release = threading.Event()
+
+    def open_session(self, concurrency=None):
+        session = FakeSession(self)
+        session.concurrency = concurrency
+        self.sessions.append(session)
+        return session
+
+
+class UnavailableRenderer(Renderer):
+
+    def open_session(self, concurrency=None):
+        raise OSError("Renderer is not installed")
+
+
+class RenderersTestCase(unittest.TestCase):
+
+    def test_renderer_pool(self):
+        renderer = FakeRenderer(workers=2)
+        renderer_pool = RendererPool(renderer, max_documents=3, health_check_interval=0.1)
+
+        submitted = [renderer_pool.submit(f'pres{i}.pptx', f'images{i}') for i in range(6)]
+        assert all(future.result() == (16, 9) for future in submitted)
+
+        # Workers are started ahead of the first job and reused between jobs
+        assert len(renderer_pool.threads) == 2
+        assert renderer.warmed_up == len(renderer.sessions)
+
+        # Crashed session is replaced and the pool keeps serving jobs
+        with self.assertRaises(AttributeError):
+            renderer_pool.export('broken.pptx', 'images')
+        assert renderer_pool.export('pres.pptx', 'images') == (16, 9)
+
+        renderer_pool.close()
+        assert renderer.closed == len(renderer.sessions)
+        # 7 successful exports with recycling after 3 and one crashed session need at least 4 sessions
+        assert len(renderer.sessions) >= 4
+        # Every worker runs one export at a time
+        assert all(session.concurrency == 1 for session in renderer.sessions)
+
+    def test_libreoffice_session_profiles(self):
+        renderer = LibreOfficeRenderer(workers=3)
+        # Standalone session is shared by concurrent exports, pooled session gets one profile
+        for concurrency, profiles in ((None, 3), (1, 1)):
+            with renderer.open_session(concurrency) as session:
+                assert session.profiles.qsize() == profiles
+            assert not session.is_alive()
+
+    def test_renderer_pool_single_instance(self):
+        renderer = FakeRenderer(workers=4)
+        renderer.max_sessions = 1
+        renderer_pool = RendererPool(renderer)
+        assert len(renderer_pool.threads) == 1
+        renderer_pool.close()
+
+    def test_renderer_pool_unavailable(self):
+        with self.assertLogs('app.server.main.presentation_processing.renderers', level='WARNING') as logs:
+            renderer_pool = RendererPool(UnavailableRenderer(workers=2), health_check_interval=0.1)
+
+            # Jobs fail with the error of opening a session instead of waiting forever
+            with self.assertRaises(OSError):
+                renderer_pool.export('pres.pptx', 'images')
+            time.sleep(0.5)
+            renderer_pool.close()
+
+        # Retries while idle don't report the failure again
+        assert len(logs.output) == 2
+
+    def test_renderer_pool_timeout(self):
+        renderer = FakeRenderer(workers=1)
+        renderer_pool = RendererPool(renderer, export_timeout=0.1)
+
+        slow_future = renderer_pool.submit('slow.pptx', 'images')
+        with self.assertRaises(futures.TimeoutError):
+            renderer_pool.export('pres.pptx', 'images')
+
+        renderer.release.set()
+        assert slow_future.result() == (16, 9)
+        renderer_pool.close()
+        assert renderer.closed == len(renderer.sessions)
+
+
+if __name__ == '__main__':
+    unittest.main()
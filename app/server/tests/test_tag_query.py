@@ -0,0 +1,79 @@
+import unittest
+
+from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, select, insert, func, case
+
+from app.server.main.database.tag_query import TagQuery
+
+
+class TagQueryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        metadata = MetaData()
+        self.links = Table('links', metadata, Column('item_id', Integer), Column('tag_name', String),
+                           Column('value', Integer))
+        self.engine = create_engine('sqlite://', future=True)
+        metadata.create_all(self.engine)
+        self.insert_links([
+            (1, 'tag1', 100),
+            (2, 'tag2', None),
+            (3, 'tag1', 200),
+            (4, 'tag3', None),
+            (4, 'tag1', 0),
+        ])
+
+    def insert_links(self, links):
+        with self.engine.begin() as connection:
+            connection.execute(insert(self.links), [
+                {'item_id': item_id, 'tag_name': tag_name, 'value': value} for item_id, tag_name, value in links
+            ])
+
+    def filter(self, query):
+        # Links are grouped by item as DatabaseHandler does, so every tag becomes a column of its value
+        tag_query = TagQuery(query)
+        columns = {
+            tag_name: func.coalesce(
+                func.max(case((self.links.c.tag_name == tag_name, func.coalesce(self.links.c.value, 1)))), 0
+            )
+            for tag_name in tag_query.tag_names
+        }
+        with self.engine.connect() as connection:
+            return connection.execute(
+                select(self.links.c.item_id)
+                .where(self.links.c.tag_name.in_(tag_query.tag_names))
+                .group_by(self.links.c.item_id)
+                .having(tag_query.to_sql(columns))
+                .order_by(self.links.c.item_id)
+            ).scalars().all()
+
+    def test_to_sql(self):
+        assert self.filter('tag1') == [1, 3]
+        assert self.filter('tag1 > 100') == [3]
+        assert self.filter('tag2 or tag3') == [2, 4]
+        assert self.filter('not tag1') == [4]
+        assert self.filter('tag3 and not tag1') == [4]
+        assert self.filter('(tag1 + 50) * 2 >= 300') == [1, 3]
+        assert self.filter('50 < tag1 <= 100') == [1]
+        assert self.filter('-tag1 < -150') == [3]
+
+        # Items without links to the queried tags are not considered
+        assert self.filter('not tag4') == []
+
+    def test_python_semantics(self):
+        self.insert_links([(5, 'tag4', 0), (5, 'tag5', 7), (6, 'tag4', 5), (6, 'tag5', 0)])
+        # 'or' returns the first true operand, so the comparison is made on tag4 for the second item
+        assert self.filter('(tag4 or tag5) > 6') == [5]
+        assert self.filter('(tag4 and tag5) == 0') == [5, 6]
+        assert self.filter('not tag4 or tag5 == 7') == [5]
+        assert self.filter('-tag5 < -tag4') == [5]
+
+    def test_invalid_query(self):
+        for query in ('', 'tag1 >', 'tag1 ** 2', '(tag1', 'tag1 tag2', 'INVALID_TAG_QUERY + 10 == "Hello"'):
+            with self.assertRaises(AttributeError):
+                TagQuery(query)
+
+    def test_tag_names(self):
+        assert TagQuery('тег1 > 1 or not (tag_2 and tag1)').tag_names == ['tag1', 'tag_2', 'тег1']
+
+
+if __name__ == '__main__':
+    unittest.main()
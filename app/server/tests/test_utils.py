@@ -0,0 +1,299 @@
+import os
+import shutil
+import unittest
+
+import cv2
+import numpy as np
+
+from app.definitions import ROOT, SERVER_ROOT
+from app.server.main.utils import fingerprint, utils
+from app.server.main.utils.deck_cache import DeckCache
+from app.server.main.utils.file_cache import FileCache
+from app.server.main.utils.image_cache import ImageCache
+from app.server.main.utils.thumbnail_store import ThumbnailStore
+from app.server.main.utils.workspace import Workspace
+
+
+def baseline_img_mse(db_thumbnail, upd_thumbnail, crop_bottom=0.1):
+    # Comparison img_eq was introduced with, larger image is resized to the smaller one.
+    # Its differences were squared in uint8 and wrapped around, here they are squared in int32
+    lab_img_db = cv2.cvtColor(cv2.imdecode(np.frombuffer(db_thumbnail, np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_RGB2Lab)
+    lab_img_upd = cv2.cvtColor(cv2.imdecode(np.frombuffer(upd_thumbnail, np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_RGB2Lab)
+    h, w, _ = lab_img_db.shape
+    if lab_img_db.shape < lab_img_upd.shape:
+        lab_img_upd = cv2.resize(lab_img_upd, (w, h))
+    elif lab_img_upd.shape < lab_img_db.shape:
+        h, w, _ = lab_img_upd.shape
+        lab_img_db = cv2.resize(lab_img_db, (w, h))
+    img_diff = cv2.subtract(lab_img_upd, lab_img_db)[0:int((1 - crop_bottom) * h)]
+    return np.sum(img_diff.astype(np.int32) ** 2) / (w * h)
+
+
+class UtilsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_path = os.path.join(SERVER_ROOT, 'presentation_processing/test_utils_temp')
+        os.makedirs(self.temp_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path)
+
+    def test_file_cache(self):
+        cache = FileCache(os.path.join(self.temp_path, 'cache'), max_size=25)
+        target_path = os.path.join(self.temp_path, 'target.pptx')
+
+        key1 = cache.make_key('PRES_1_ID', 'MD5_1')
+        assert not cache.get(key1, target_path)
+
+        part_path = cache.reserve(key1)
+        with open(part_path, 'wb') as file:
+            file.write(b'1' * 10)
+        cache.commit(key1, part_path, target_path)
+
+        with open(target_path, 'rb') as file:
+            assert file.read() == b'1' * 10
+
+        # New version of the same file is a different entry
+        key2 = cache.make_key('PRES_1_ID', 'MD5_2')
+        assert key2 != key1
+        assert not cache.get(key2, target_path)
+
+        for key, content in ((key2, b'2' * 10), (cache.make_key('PRES_2_ID', 'MD5_1'), b'3' * 10)):
+            part_path = cache.reserve(key)
+            with open(part_path, 'wb') as file:
+                file.write(content)
+            cache.commit(key, part_path)
+
+        # Least recently used entry is evicted once size limit is exceeded
+        assert cache.size <= 25
+        assert not cache.get(key1, target_path)
+        assert cache.get(key2, target_path)
+        with open(target_path, 'rb') as file:
+            assert file.read() == b'2' * 10
+
+        # Entries survive restart
+        restored_cache = FileCache(os.path.join(self.temp_path, 'cache'), max_size=25)
+        assert restored_cache.get(key2, target_path)
+        assert restored_cache.size == cache.size
+
+    def test_thumbnail_store(self):
+        store = ThumbnailStore(os.path.join(self.temp_path, 'thumbnails'))
+
+        with open(os.path.join(ROOT, 'server/tests/files/slide_thumbnail_1.png'), 'rb') as file:
+            thumbnail = file.read()
+
+        thumbnail_hash = store.put(thumbnail)
+        assert thumbnail_hash == store.make_hash(thumbnail)
+        assert store.get(thumbnail_hash) == thumbnail
+
+        # Pyramid is made at put, smaller sizes are downscaled keeping aspect ratio
+        rendered = cv2.imdecode(np.frombuffer(thumbnail, np.uint8), cv2.IMREAD_COLOR)
+        for size, width in ThumbnailStore.SIZES.items():
+            assert os.path.exists(store.get_path(thumbnail_hash, size))
+            image = cv2.imdecode(np.frombuffer(store.get(thumbnail_hash, size), np.uint8), cv2.IMREAD_COLOR)
+            assert image.shape[1] == (width or rendered.shape[1])
+            assert abs(image.shape[0] / image.shape[1] - rendered.shape[0] / rendered.shape[1]) < 0.01
+        assert len(store.get(thumbnail_hash, 'small')) < len(thumbnail) / 10
+
+        # Equal thumbnails are stored once
+        assert store.put(thumbnail) == thumbnail_hash
+        assert len(os.listdir(os.path.dirname(store.get_path(thumbnail_hash)))) == 1 + len(ThumbnailStore.SIZES)
+
+        # Sizes of thumbnails stored without pyramid are made on request
+        with open(os.path.join(ROOT, 'server/tests/files/slide_thumbnail_2.png'), 'rb') as file:
+            other_hash = store.put(file.read(), pyramid=False)
+        assert not os.path.exists(store.get_path(other_hash, 'medium'))
+        assert store.get(other_hash, 'medium') is not None
+        assert os.path.exists(store.get_path(other_hash, 'medium'))
+
+        assert store.get(store.make_hash(b'MISSING')) is None
+        assert store.get(store.make_hash(b'MISSING'), 'small') is None
+        with self.assertRaises(ValueError):
+            store.get(thumbnail_hash, 'huge')
+
+        # Only thumbnails which are not referenced and not recently stored are swept
+        for path in (store.get_path(other_hash), store.get_path(other_hash, 'medium')):
+            os.utime(path, (0, 0))
+        assert store.sweep({thumbnail_hash}, modified_before=1) == 1
+        assert store.get(other_hash) is None
+        assert not os.path.exists(store.get_path(other_hash, 'medium'))
+        assert store.get(thumbnail_hash, 'small') is not None
+        assert store.sweep(set(), modified_before=1) == 0
+
+        # Reused thumbnail is marked as recent
+        for size in [None] + list(ThumbnailStore.SIZES):
+            os.utime(store.get_path(thumbnail_hash, size), (0, 0))
+        store.put(thumbnail)
+        assert store.sweep(set(), modified_before=1) == 0
+
+        store.clear()
+        assert store.get(thumbnail_hash) is None
+
+    def test_fingerprint(self):
+        thumbnails = []
+        for i in range(1, 5):
+            with open(os.path.join(ROOT, f'server/tests/files/slide_thumbnail_{i}.png'), 'rb') as file:
+                thumbnails.append(file.read())
+        fingerprints = [fingerprint.phash(thumbnail) for thumbnail in thumbnails]
+
+        # Slightly changed render of a slide is close to it, other slides are far
+        img = cv2.imdecode(np.frombuffer(thumbnails[0], np.uint8), cv2.IMREAD_COLOR)
+        img[5:15, 5:15] = 0
+        changed = fingerprint.phash(cv2.imencode('.png', img)[1].tobytes())
+        assert fingerprint.hamming_distance(changed, fingerprints[0]) <= fingerprint.MATCH_DISTANCE
+        for other in fingerprints[1:]:
+            assert fingerprint.hamming_distance(changed, other) > fingerprint.MATCH_DISTANCE
+
+        assert all(-2 ** 63 <= value < 2 ** 63 for value in fingerprints)
+        assert fingerprint.phash(b'NOT_AN_IMAGE') is None
+
+        tree = fingerprint.BKTree()
+        for i, value in enumerate(fingerprints):
+            tree.add(value, i)
+        assert tree.search(changed, fingerprint.MATCH_DISTANCE)[0][1] == 0
+        for radius in (0, 10, 30, 64):
+            expected = sorted(i for i, value in enumerate(fingerprints)
+                              if fingerprint.hamming_distance(fingerprints[1], value) <= radius)
+            assert sorted(i for _, i in tree.search(fingerprints[1], radius)) == expected
+
+    def test_image_cache(self):
+        cache = ImageCache(max_size=2)
+        loads = []
+
+        def load(value):
+            loads.append(value)
+            return np.full(4, value)
+
+        assert cache.get('KEY_1', lambda: load(1))[0] == 1
+        assert cache.get('KEY_1', lambda: load(-1))[0] == 1
+        cache.get('KEY_2', lambda: load(2))
+        cache.get('KEY_1', lambda: load(-1))
+        # Least recently used entry is evicted once size limit is exceeded
+        cache.get('KEY_3', lambda: load(3))
+        assert cache.get('KEY_2', lambda: load(4))[0] == 4
+        assert loads == [1, 2, 3, 4]
+
+        stats = cache.stats()
+        assert stats['hits'] == 2 and stats['misses'] == 4 and stats['size'] == 2
+
+        with self.assertRaises(ValueError):
+            cache.get('KEY_2', lambda: load(-1))[0] = 0
+
+    def test_deck_cache(self):
+        disposed = []
+
+        class Deck:
+            def __init__(self, path):
+                self.path = path
+
+            def dispose(self):
+                disposed.append(self.path)
+
+        with DeckCache(Deck, max_decks=2) as decks:
+            deck1 = decks.get('PRES_1_PATH')
+            assert decks.get('PRES_1_PATH') is deck1
+            decks.get('PRES_2_PATH')
+            decks.get('PRES_1_PATH')
+            # Least recently used deck is disposed once more decks are open
+            decks.get('PRES_3_PATH')
+            assert disposed == ['PRES_2_PATH']
+            assert decks.opened == 3
+
+        assert sorted(disposed) == ['PRES_1_PATH', 'PRES_2_PATH', 'PRES_3_PATH']
+
+    def test_img_eq(self):
+        thumbnails = []
+        for i in range(1, 4):
+            with open(os.path.join(ROOT, f'server/tests/files/slide_thumbnail_{i}.png'), 'rb') as file:
+                thumbnails.append(file.read())
+
+        utils.image_cache.clear()
+        for i, thumbnail1 in enumerate(thumbnails):
+            for j, thumbnail2 in enumerate(thumbnails):
+                assert utils.img_eq(thumbnail1, thumbnail2) == (i == j)
+
+        # Every thumbnail is decoded once
+        stats = utils.image_cache.stats()
+        assert stats['misses'] == len(thumbnails)
+        assert stats['hits'] == 2 * len(thumbnails) ** 2 - len(thumbnails)
+
+    def test_img_eq_matrix(self):
+        thumbnails = []
+        for i in range(1, 4):
+            with open(os.path.join(ROOT, f'server/tests/files/slide_thumbnail_{i}.png'), 'rb') as file:
+                thumbnails.append(file.read())
+
+        matrix = utils.img_eq_matrix(thumbnails[:2], thumbnails)
+        assert matrix.shape == (2, 3)
+        for i, thumbnail1 in enumerate(thumbnails[:2]):
+            for j, thumbnail2 in enumerate(thumbnails):
+                assert matrix[i, j] == utils.img_eq(thumbnail1, thumbnail2)
+
+        # Blocks of a single pair and partial blocks of several rows give the same distances
+        mse = utils.img_mse_matrix(thumbnails * 3, thumbnails * 3, max_chunk_bytes=128 * 1024 * 1024)
+        for max_chunk_bytes in (1, 10 * 1024 * 1024, 30 * 1024 * 1024):
+            assert (utils.img_mse_matrix(thumbnails * 3, thumbnails * 3, max_chunk_bytes=max_chunk_bytes) == mse).all()
+        assert utils.img_eq_matrix([], thumbnails).shape == (0, 3)
+
+    def test_img_eq_baseline(self):
+        pairs = []
+        for i in range(2, 4):
+            with open(os.path.join(ROOT, f'server/tests/files/slide_thumbnail_{i}.png'), 'rb') as file:
+                thumbnail = file.read()
+            img = cv2.imdecode(np.frombuffer(thumbnail, np.uint8), cv2.IMREAD_COLOR)
+
+            boxed = img.copy()
+            boxed[5:15, 5:15] = 0
+            titled = img.copy()
+            cv2.putText(titled, 'Edited', (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
+            noisy = np.clip(img.astype(int) + np.random.RandomState(i).randint(0, 2, img.shape), 0, 255)
+            downscaled = cv2.resize(img, (img.shape[1] // 2, img.shape[0] // 2), interpolation=cv2.INTER_AREA)
+            brightened = img.copy()
+            brightened[:, :img.shape[1] // 2] = np.clip(img[:, :img.shape[1] // 2].astype(int) + 16, 0, 255)
+            for edited in (img, boxed, titled, noisy.astype(np.uint8), downscaled):
+                pairs.append((thumbnail, cv2.imencode('.png', edited)[1].tobytes()))
+
+            # Squared in uint8, differences of 16 and its multiples gave 0 and were lost
+            brightened = cv2.imencode('.png', brightened)[1].tobytes()
+            assert abs(utils.img_mse_matrix([thumbnail], [brightened])[0, 0] -
+                       baseline_img_mse(thumbnail, brightened)) < 1e-9
+            assert not utils.img_eq(thumbnail, brightened)
+            pairs.append((thumbnail, brightened))
+
+        # Near-identical and slightly edited slides compare as they did at native size
+        for db_thumbnail, upd_thumbnail in pairs:
+            mse = baseline_img_mse(db_thumbnail, upd_thumbnail)
+            assert utils.img_eq(db_thumbnail, upd_thumbnail) == (mse < 0.3)
+            assert abs(utils.img_mse_matrix([db_thumbnail], [upd_thumbnail])[0, 0] - mse) < 1e-9
+
+        # Thumbnails of different sizes are compared in one matrix
+        db_thumbnails = [db_thumbnail for db_thumbnail, _ in pairs[::6]]
+        upd_thumbnails = [upd_thumbnail for _, upd_thumbnail in pairs]
+        matrix = utils.img_mse_matrix(db_thumbnails, upd_thumbnails)
+        for i, db_thumbnail in enumerate(db_thumbnails):
+            for j, upd_thumbnail in enumerate(upd_thumbnails):
+                assert abs(matrix[i, j] - baseline_img_mse(db_thumbnail, upd_thumbnail)) < 1e-9
+
+    def test_workspace(self):
+        with Workspace() as workspace1, Workspace() as workspace2:
+            assert workspace1.path != workspace2.path
+
+            pres_path = workspace1.presentation_path('PRES_1_ID')
+            with open(pres_path, 'wb') as file:
+                file.write(b'PRES')
+
+            assert os.path.dirname(pres_path) == workspace1.presentation_dir('PRES_1_ID')
+            assert workspace1.image_path('PRES_1_ID', 0).endswith(os.path.join('PRES_1_ID', 'images', 'Слайд1.png'))
+            assert os.path.exists(workspace1.style_dir('PRES_1_ID'))
+
+            # Cleaning one workspace does not affect the other
+            workspace2.presentation_path('PRES_1_ID')
+            workspace2.cleanup()
+            assert not os.path.exists(workspace2.path)
+            assert os.path.exists(pres_path)
+
+        assert not os.path.exists(workspace1.path)
+
+
+if __name__ == '__main__':
+    unittest.main()